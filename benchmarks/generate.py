@@ -0,0 +1,84 @@
+import argparse
+import json
+import os
+import random
+import time
+import typing as t
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+# Generates synthetic xtask projects for benchmarking: a number of task files, each in its own directory and declaring a
+# number of tasks. Every task has a tree of input files and writes one output, and depends on tasks declared before it
+# (in its own task file or in earlier ones), so the project is always a valid graph.
+
+
+@dataclass
+class ProjectShape():
+
+	task_files: int = 50
+	tasks_per_file: int = 10
+	# How many tasks each task depends on, at most. Dependencies are picked among the tasks declared before it.
+	fan_in: int = 3
+	# How far back dependencies may be picked from, in tasks. Smaller windows make for deeper, narrower graphs.
+	dependency_window: int = 50
+	inputs_per_task: int = 20
+	input_size: int = 1024
+	# How many directories each task's inputs are spread over.
+	input_directories: int = 4
+	seed: int = 0
+
+	@property
+	def total_tasks(self) -> int:
+		return self.task_files * self.tasks_per_file
+
+def generate_project(root_path: Path, shape: ProjectShape) -> t.List[str]:
+	# Writes the project under root_path, returning the labels of its tasks in declaration order.
+	random.seed(shape.seed)
+	root_path.mkdir(parents=True, exist_ok=True)
+	(root_path / 'xtask.project').write_text(json.dumps({'log_level': 'warning'}))
+	labels = list()
+	for file_index in range(shape.task_files):
+		group = f'pkg{file_index}'
+		directory_path = root_path / group
+		directory_path.mkdir(exist_ok=True)
+		lines = ['from pathlib import Path', '', 'from xtask import *', '']
+		for task_index in range(shape.tasks_per_file):
+			name = f'task{task_index}'
+			candidates = labels[-shape.dependency_window:]
+			dependencies = random.sample(candidates, min(len(candidates), random.randint(0, shape.fan_in)))
+			if dependencies:
+				lines.append(f'@dependencies({", ".join(repr(dependency) for dependency in dependencies)})')
+			lines.append(f"@outputs(include=['out/{name}.txt'])")
+			lines.append(f"@inputs(include=['src/{name}/**/*.txt'])")
+			lines.append(f"@task('{name}', use_cache=True)")
+			lines.append(f'def {name}(ctx):')
+			lines.append(f"\tPath('out').mkdir(exist_ok=True)")
+			lines.append(f"\tPath('out/{name}.txt').write_text(str(len(ctx.this_task.inputs())))")
+			lines.append('')
+			_generate_inputs(directory_path / 'src' / name, shape)
+			labels.append(f'{group}:{name}')
+		(directory_path / f'{group}.tasks').write_text('\n'.join(lines))
+	return labels
+
+def _generate_inputs(directory_path: Path, shape: ProjectShape) -> None:
+	for input_index in range(shape.inputs_per_task):
+		file_path = directory_path / f'dir{input_index % shape.input_directories}' / f'input{input_index}.txt'
+		file_path.parent.mkdir(parents=True, exist_ok=True)
+		file_path.write_bytes(random.randbytes(shape.input_size))
+		# Backdated, since xtask doesn't trust the digests of files modified within the last few seconds.
+		os.utime(file_path, (time.time() - 60, time.time() - 60))
+
+def add_shape_arguments(parser: argparse.ArgumentParser) -> None:
+	for field_name, default in asdict(ProjectShape()).items():
+		parser.add_argument(f'--{field_name.replace("_", "-")}', type=int, default=default)
+
+def shape_from_arguments(args: argparse.Namespace) -> ProjectShape:
+	return ProjectShape(**{field_name: getattr(args, field_name) for field_name in asdict(ProjectShape())})
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Generates a synthetic xtask project for benchmarking.')
+	parser.add_argument('directory', type=str)
+	add_shape_arguments(parser)
+	args = parser.parse_args()
+	labels = generate_project(Path(args.directory), shape_from_arguments(args))
+	print(f'Generated {len(labels)} tasks under "{args.directory}"')
@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import typing as t
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+import xtask
+from xtask.file_digest import FileDigestCache
+from xtask.path_matcher import DirectoryListingCache
+from xtask.task import Task
+from xtask.task_cache import DirectoryTaskCache
+from xtask.task_graph import TaskGraph
+from xtask.task_manifest import TaskLoader
+from xtask.util import xglob
+
+from generate import ProjectShape, add_shape_arguments, generate_project, shape_from_arguments
+
+# Times xtask's own overhead on a synthetic project: startup, discovery, graph construction, hashing, globbing and the
+# task cache. Every benchmark is run several times and reported in seconds, as JSON, so results can be compared between
+# releases (and between project shapes).
+
+
+@dataclass
+class BenchmarkProject():
+
+	root_path: Path
+	labels: t.List[str]
+	shape: ProjectShape
+	scratch_path: Path
+
+	def load_tasks(self) -> t.List[Task]:
+		return TaskLoader(self.root_path).full_graph().all_tasks
+
+# Each benchmark gets the project and returns a function to time, plus an optional function to run before every timing.
+Benchmark = t.Callable[[BenchmarkProject], t.Tuple[t.Callable[[], t.Any], t.Optional[t.Callable[[], t.Any]]]]
+
+def startup_cold(project: BenchmarkProject):
+	# A full xtask invocation without a task manifest, so every task file is discovered and executed.
+	manifest_path = project.root_path / '.xtask' / 'tasks.json'
+	return lambda: _run_xtask(project, '--help'), lambda: manifest_path.unlink(missing_ok=True)
+
+def startup_warm(project: BenchmarkProject):
+	# A full xtask invocation with an up to date task manifest, so no task file is executed.
+	_run_xtask(project, '--help')
+	return lambda: _run_xtask(project, '--help'), None
+
+def discovery(project: BenchmarkProject):
+	return lambda: TaskLoader(project.root_path), None
+
+def graph_construction(project: BenchmarkProject):
+	tasks = project.load_tasks()
+	return lambda: TaskGraph(tasks), None
+
+def subgraph(project: BenchmarkProject):
+	# The last task declared has the deepest closure of dependencies.
+	graph = TaskGraph(project.load_tasks())
+	last_task = graph.task(project.labels[-1])
+	return lambda: graph.subgraph(last_task), None
+
+def input_hash_cold(project: BenchmarkProject):
+	tasks = project.load_tasks()
+	return lambda: [task.input_hash() for task in tasks], None
+
+def input_hash_warm(project: BenchmarkProject):
+	# With every file's digest already known, so only globbing and stat calls remain.
+	tasks = project.load_tasks()
+	digest_cache = FileDigestCache()
+	for task in tasks:
+		task.input_hash(digest_cache)
+	return lambda: [task.input_hash(digest_cache) for task in tasks], None
+
+def glob(project: BenchmarkProject):
+	tasks = project.load_tasks()
+	return lambda: [xglob(task._include_src_patterns, task._exclude_src_patterns, str(task.working_directory_path)) for task in tasks], None
+
+def glob_shared_listings(project: BenchmarkProject):
+	# As a run does: every task's inputs are globbed with the same directory listing cache.
+	tasks = project.load_tasks()
+	return lambda: [task.inputs(listing_cache) for listing_cache in [DirectoryListingCache()] for task in tasks], None
+
+def cache_miss(project: BenchmarkProject):
+	# Putting every task's inputs into an empty cache, as if they were its outputs.
+	tasks = project.load_tasks()
+	cache_path = project.scratch_path / 'cache-miss'
+	def reset():
+		shutil.rmtree(cache_path, ignore_errors=True)
+		cache_path.mkdir(parents=True)
+	def put_all():
+		cache = DirectoryTaskCache(str(cache_path))
+		for input_hash, task in enumerate(tasks):
+			cache.put(input_hash, [(str(Path(file_name).relative_to(task.working_directory_path)), Path(file_name)) for file_name in task.inputs()])
+		cache.close()
+	return put_all, reset
+
+def cache_hit(project: BenchmarkProject):
+	# Looking up and restoring every task's entry from a populated cache.
+	tasks = project.load_tasks()
+	cache_path = project.scratch_path / 'cache-hit'
+	target_path = project.scratch_path / 'restored'
+	shutil.rmtree(cache_path, ignore_errors=True)
+	cache_path.mkdir(parents=True)
+	cache = DirectoryTaskCache(str(cache_path))
+	for input_hash, task in enumerate(tasks):
+		cache.put(input_hash, [(str(Path(file_name).relative_to(task.working_directory_path)), Path(file_name)) for file_name in task.inputs()])
+	def restore_all():
+		for input_hash in range(len(tasks)):
+			if input_hash in cache:
+				cache.copy_to(input_hash, str(target_path / str(input_hash)))
+	return restore_all, lambda: shutil.rmtree(target_path, ignore_errors=True)
+
+BENCHMARKS: t.Dict[str, Benchmark] = {
+	'startup_cold': startup_cold,
+	'startup_warm': startup_warm,
+	'discovery': discovery,
+	'graph_construction': graph_construction,
+	'subgraph': subgraph,
+	'input_hash_cold': input_hash_cold,
+	'input_hash_warm': input_hash_warm,
+	'glob': glob,
+	'glob_shared_listings': glob_shared_listings,
+	'cache_miss': cache_miss,
+	'cache_hit': cache_hit,
+}
+
+def run_benchmarks(project: BenchmarkProject, names: t.Iterable[str], repeat: int) -> t.Dict[str, t.Dict[str, t.Any]]:
+	results = dict()
+	for name in names:
+		function, setup = BENCHMARKS[name](project)
+		timings = list()
+		for _ in range(repeat):
+			if setup is not None:
+				setup()
+			start = time.perf_counter()
+			function()
+			timings.append(time.perf_counter() - start)
+		results[name] = {'min': min(timings), 'median': statistics.median(timings), 'mean': statistics.mean(timings), 'runs': timings}
+		print(f'{name:>24}: {results[name]["median"] * 1000:10.1f} ms (median of {repeat})', file=sys.stderr)
+	return results
+
+def _run_xtask(project: BenchmarkProject, *args: str) -> None:
+	# Runs the same xtask that is being benchmarked, even if another one is installed.
+	environment = dict(os.environ, PYTHONPATH=os.pathsep.join([str(Path(xtask.__file__).parent.parent), os.environ.get('PYTHONPATH', '')]))
+	subprocess.run([sys.executable, '-m', 'xtask', *args], cwd=str(project.root_path), env=environment, check=True, stdout=subprocess.DEVNULL)
+
+def main() -> None:
+	parser = argparse.ArgumentParser(description='Benchmarks xtask on a synthetic project.')
+	parser.add_argument('--output', type=str, default=None, help='Where to write the results as JSON. Defaults to stdout.')
+	parser.add_argument('--repeat', type=int, default=5, help='How many times to run each benchmark.')
+	parser.add_argument('--benchmarks', nargs='*', choices=list(BENCHMARKS), default=list(BENCHMARKS), help='The benchmarks to run. Defaults to all of them.')
+	parser.add_argument('--project', type=str, default=None, help='Where to generate the project. Defaults to a temporary directory that is deleted afterwards.')
+	add_shape_arguments(parser)
+	args = parser.parse_args()
+
+	shape = shape_from_arguments(args)
+	root_path = Path(args.project).resolve() if args.project else Path(tempfile.mkdtemp(prefix='xtask-benchmark-'))
+	try:
+		print(f'Generating {shape.total_tasks} tasks under "{root_path}"', file=sys.stderr)
+		labels = generate_project(root_path / 'project', shape)
+		project = BenchmarkProject(root_path / 'project', labels, shape, root_path / 'scratch')
+		results = run_benchmarks(project, args.benchmarks, args.repeat)
+	finally:
+		if not args.project:
+			shutil.rmtree(root_path, ignore_errors=True)
+
+	report = json.dumps({
+		'xtask_version': xtask.__version__,
+		'python_version': platform.python_version(),
+		'platform': platform.platform(),
+		'cpu_count': os.cpu_count(),
+		'shape': asdict(shape),
+		'results': results,
+	}, indent='\t')
+	if args.output:
+		Path(args.output).write_text(report)
+	else:
+		print(report)
+
+if __name__ == '__main__':
+	main()
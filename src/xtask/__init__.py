@@ -1,5 +1,5 @@
 __version__ = '0.3.0'
 
 from xtask.context import Context
-from xtask.task import Task, dependencies, inputs, outputs, task
+from xtask.task import Task, compression, dependencies, inputs, outputs, task
 from xtask.util import copy, delete, move, run, working_dir, xglob
@@ -1,60 +1,31 @@
 import logging
+import os
+import socket
+import subprocess
+import time
 import sys
+import typing as t
 from argparse import Action, ArgumentParser
 from pathlib import Path
 
 import xtask.constants as const
-from xtask.context import Context
-from xtask.settings import Settings
+import xtask.daemon as daemon
+import xtask.metrics as metrics
+import xtask.task_output as task_output
+import xtask.trace as trace
+from xtask.affected import AffectedTaskIndex
+from xtask.context import FAILED, Context, TaskFailedError
+from xtask.http_cache import CacheServer
+from xtask.project import Project
+from xtask.scheduler import critical_paths, simulate
+from xtask.settings import parse_size
 from xtask.task import Task
 from xtask.task_cache import DirectoryTaskCache
-from xtask.task_file import TaskFile
 from xtask.task_graph import TaskGraph
-from xtask.util import *
-
-# Search upwards in directories for a root settings file. If one is not found, then just use the current directory as the root.
-current_path: Path = Path.cwd()
-while not (current_path / const.ROOT_SETTINGS_FILE_NAME).exists():
-	if current_path == current_path.parent:
-		break
-	current_path = current_path.parent
-
-if not (current_path / const.ROOT_SETTINGS_FILE_NAME).exists():
-	current_path = Path.cwd()
-
-root_project_path = current_path
-
-settings_file_path = current_path / const.ROOT_SETTINGS_FILE_NAME
-if settings_file_path.exists():
-	settings = Settings.load(settings_file_path)
-else:
-	settings = Settings()
-
-if settings.cache_location and Path(settings.cache_location).is_dir():
-	task_cache = DirectoryTaskCache(settings.cache_location)
-else:
-	task_cache = None
-	
-if settings.extension_location and Path(settings.extension_location).is_dir():
-	sys.path.insert(0, settings.extension_location)
-
-logging.basicConfig(format='[xtask] %(levelname)s: %(message)s', level=logging._nameToLevel.get(settings.log_level.upper()))
-
-# Create the task graph by loading the tasks from each file
-search_pattern = str(Path('**', const.TASKS_FILE_PATTERN))
-task_file_paths: t.List[Path] = list(root_project_path.glob(search_pattern))
-tasks: t.List[Task] = list()
-visited_directories = set()
-for task_file_path in task_file_paths:
-	logging.debug(f'Loading task file from path: "{task_file_path}"')
-	task_file = TaskFile.load(task_file_path)
-	if task_file_path.parent in visited_directories:
-		raise RuntimeError(f'Unable to load the task file "{task_file_path}" because a task file from the same directory has already been loaded.')
-	visited_directories.add(task_file_path.parent)
-	tasks.extend(task_file.tasks)
-	logging.debug(f'Successfully loaded a task file from "{task_file_path}" with tasks: {",".join([str(task) for task in task_file.tasks])}')
-
-task_graph = TaskGraph(tasks)
+from xtask.watch import Watch
+
+# Commands built into xtask. Tasks in the current directory whose names collide with these are only available by their label.
+BUILTIN_COMMANDS = {'affected', 'cache', 'daemon', 'plan', 'stats', 'watch'}
 
 # Build the cmd line parser
 class ParseKwargs(Action):
@@ -64,28 +35,339 @@ class ParseKwargs(Action):
 			key, value = value.split('=')
 			getattr(namespace, self.dest)[key] = value
 
-def main():
+def add_failure_arguments(parser: ArgumentParser) -> None:
+	failure_group = parser.add_mutually_exclusive_group()
+	failure_group.add_argument('--fail-fast', dest='keep_going', action='store_false', help='Stops at the first failed task, cancelling every other task (the default).')
+	failure_group.add_argument('--keep-going', dest='keep_going', action='store_true', help='Keeps executing every task that does not depend on a failed task.')
+	# Both options share a destination, whose default would otherwise be the first one's.
+	parser.set_defaults(keep_going=False)
+
+def add_output_argument(parser: ArgumentParser) -> None:
+	parser.add_argument('--output', type=str, choices=task_output.MODES, default=None, help='Shows the output of each task line by line, prefixed with its label, or grouped once the task is done. Overrides the "task_output" setting.')
+
+def add_metrics_arguments(parser: ArgumentParser) -> None:
+	parser.add_argument('--metrics', type=str, default=None, metavar='FILE', help='Writes the metrics of this run (cache hits, bytes moved, hashing, time by phase) to FILE as JSON.')
+	parser.add_argument('--prometheus', type=str, default=None, metavar='FILE', help='Writes the metrics of this run to FILE in the Prometheus text format, e.g. for the textfile collector of node_exporter.')
+
+def save_metrics(project: Project, args, context: Context, targets: t.List[str], succeeded: bool) -> None:
+	# Every run executing tasks is added to the project's metrics history, which "xtask stats" aggregates.
+	run_metrics = metrics.current()
+	if run_metrics is None:
+		return
+	run = run_metrics.as_dict(targets, succeeded, {task.label: (result.status, result.duration) for task, result in context.results.items()})
+	metrics.save_run(run, project.state_directory_path / const.METRICS_FILE_NAME)
+	if args.metrics is not None:
+		metrics.save_json(run, Path(args.metrics).resolve())
+	if args.prometheus is not None:
+		metrics.save_prometheus(run, Path(args.prometheus).resolve())
+
+def execute_task(project: Project, args) -> int:
+	# Every target is executed from a single graph, so dependencies they share are only executed (or restored) once. Only
+	# the task files declaring the targets and their dependencies are loaded.
+	labels = list(dict.fromkeys([args.task_to_execute, *(resolve_label(project, target) for target in args.targets)]))
+	task_graph = project.task_loader.graph(*labels)
+	tasks = [task_graph.task(label) for label in labels]
+	context = project.create_context(tasks[0], task_graph, args.properties, jobs=args.jobs, lazy=args.lazy, keep_going=args.keep_going, output_mode=args.output)
+	failure = None
+	try:
+		context.execute(*tasks, use_cache=True, with_dependencies=True)
+	except TaskFailedError as e:
+		failure = e
+	finally:
+		project.close()
+	save_metrics(project, args, context, labels, failure is None)
+	if len(tasks) > 1:
+		print_summary(context, task_graph, tasks)
+	if failure is not None:
+		logging.error(str(failure))
+		return 1
+	return 0
+
+def print_summary(context: Context, task_graph: TaskGraph, tasks: t.List[Task]) -> None:
+	# How each target ended, and which of its dependencies failed, if any.
+	width = max(len(task.label) for task in tasks)
+	print('Summary:')
+	for task in tasks:
+		result = context.result(task)
+		failed_dependencies = sorted(dependency.label for dependency in task_graph.closure(task) if dependency != task and context.result(dependency) is not None and context.result(dependency).status == FAILED)
+		status = f'{result.status:<20} {result.duration:8.2f} s' if result is not None else 'not executed'
+		print(f'\t{task.label:<{width}}  {status}' + (f'  (failed dependencies: {", ".join(failed_dependencies)})' if failed_dependencies else ''))
+
+def affected(project: Project, args) -> int:
+	# Prints (or executes) the tasks having any of the changed files as an input, and every task depending on them.
+	changed_paths = [Path(path) for path in args.paths]
+	if args.git_diff is not None:
+		top_level = subprocess.run(['git', 'rev-parse', '--show-toplevel'], check=True, capture_output=True, text=True).stdout.strip()
+		diff = subprocess.run(['git', 'diff', '--name-only', *args.git_diff.split()], check=True, capture_output=True, text=True).stdout
+		changed_paths.extend(Path(top_level) / line for line in diff.splitlines() if line.strip())
+	if args.file is not None:
+		lines = sys.stdin.read() if args.file == '-' else Path(args.file).read_text()
+		changed_paths.extend(Path(line.strip()) for line in lines.splitlines() if line.strip())
+	if not args.paths and args.git_diff is None and args.file is None:
+		changed_paths.extend(Path(line.strip()) for line in sys.stdin if line.strip())
+
+	task_graph = project.task_loader.full_graph()
+	tasks = sorted(AffectedTaskIndex(task_graph).affected_tasks_and_dependents(changed_paths), key=lambda task: task.label)
+	if not args.execute:
+		for task in tasks:
+			print(task.label)
+		return 0
+	if not tasks:
+		logging.info('No task is affected by the changed files')
+		return 0
+	context = project.create_context(tasks[0], task_graph, args.properties, jobs=args.jobs, keep_going=args.keep_going, output_mode=args.output)
+	failure = None
+	try:
+		context.execute(*tasks, use_cache=True, with_dependencies=True)
+	except TaskFailedError as e:
+		failure = e
+	finally:
+		project.close()
+	save_metrics(project, args, context, [task.label for task in tasks], failure is None)
+	if failure is not None:
+		logging.error(str(failure))
+		return 1
+	return 0
+
+def cache_gc(project: Project, args) -> int:
+	if project.task_cache is None:
+		logging.error(f'Cannot collect garbage because no task cache is configured in "{project.settings_file_path}".')
+		return 1
+	max_size = parse_size(args.max_size) if args.max_size is not None else None
+	max_age = args.max_age_days * 24 * 60 * 60 if args.max_age_days is not None else None
+	project.task_cache.gc(max_size=max_size, max_age=max_age)
+	project.close()
+	return 0
+
+def cache_serve(project: Project, args) -> int:
+	directory_path = Path(args.directory).resolve() if args.directory else project.cache_path
+	if directory_path is None:
+		logging.error(f'Cannot serve a task cache because no directory was given and no cache location is configured in "{project.settings_file_path}".')
+		return 1
+	directory_path.mkdir(parents=True, exist_ok=True)
+	max_size = parse_size(args.max_size) if args.max_size is not None else project.settings.cache_max_size_bytes
+	max_age = args.max_age_days * 24 * 60 * 60 if args.max_age_days is not None else project.settings.cache_max_age_seconds
+	cache = DirectoryTaskCache(str(directory_path), max_size=max_size, max_age=max_age)
+	server = CacheServer((args.host, args.port), cache)
+	logging.info(f'Serving the task cache "{directory_path}" at http://{args.host}:{server.server_address[1]}. Press Ctrl+C to stop.')
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		cache.close()
+	return 0
+
+def daemon_start(project: Project, args) -> int:
+	if os.name == 'nt':
+		logging.error('The daemon is not available on Windows.')
+		return 1
+	status = daemon.request(project.root_path, 'status')
+	if status is not None:
+		logging.info(f'A daemon is already serving "{project.root_path}" with process {status["pid"]}')
+		return 0
+	project.state_directory_path.mkdir(parents=True, exist_ok=True)
+	with open(project.state_directory_path / const.DAEMON_LOG_FILE_NAME, 'a') as log_file:
+		subprocess.Popen([sys.executable, '-m', 'xtask', 'daemon', 'run'], cwd=str(project.root_path), stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT, start_new_session=True)
+	# Wait for the daemon to load the project and listen.
+	deadline = time.monotonic() + args.timeout
+	while time.monotonic() < deadline:
+		status = daemon.request(project.root_path, 'status')
+		if status is not None:
+			logging.info(f'Started a daemon serving "{project.root_path}" with process {status["pid"]}')
+			return 0
+		time.sleep(0.1)
+	logging.error(f'The daemon did not start within {args.timeout} seconds, see "{project.state_directory_path / const.DAEMON_LOG_FILE_NAME}"')
+	return 1
+
+def daemon_run(project: Project, args) -> int:
+	listener = socket.socket(fileno=args.listen_fd) if args.listen_fd is not None else None
+	daemon.Daemon(project, listener).serve_forever()
+	return 0
+
+def daemon_stop(project: Project, args) -> int:
+	if daemon.request(project.root_path, 'stop') is None:
+		logging.info(f'No daemon is serving "{project.root_path}"')
+	return 0
+
+def daemon_status(project: Project, args) -> int:
+	status = daemon.request(project.root_path, 'status')
+	if status is None:
+		print(f'No daemon is serving "{project.root_path}"')
+	else:
+		print(f'A daemon is serving "{status["root"]}" with process {status["pid"]}, executing {status["running"]} invocations')
+	return 0
+
+def watch(project: Project, args) -> int:
+	label = resolve_label(project, args.task)
+	try:
+		Watch(project, label, args.properties, args.jobs, debounce=args.debounce).run(poll=args.poll, poll_interval=args.poll_interval)
+	finally:
+		project.close()
+	return 0
+
+def stats(project: Project, args) -> int:
+	# Aggregates the last runs from the project's metrics history, or from the given files (e.g. collected from CI machines).
+	file_paths = [Path(file) for file in args.files] if args.files else [project.state_directory_path / const.METRICS_FILE_NAME]
+	runs = metrics.load_runs(file_paths)
+	print(metrics.summary(runs[-args.runs:] if args.runs > 0 else runs))
+	return 0
+
+def plan(project: Project, args) -> int:
+	# Shows how long executing a task and its dependencies is estimated to take, from how long each task took before.
+	label = resolve_label(project, args.task)
+	task_graph = project.task_loader.graph(label)
+	estimates = project.history.estimates(task_graph.all_tasks)
+	remaining = critical_paths(task_graph, estimates)
+	# The critical path starts at the dependency-free task with the longest remaining path, then follows whichever
+	# dependent continues it.
+	task = max((task for task in task_graph.all_tasks if not task_graph.dependencies(task)), key=lambda task: remaining[task])
+	path = [task]
+	while task_graph.direct_dependents(task):
+		task = max(task_graph.direct_dependents(task), key=lambda dependent: remaining[dependent])
+		path.append(task)
+	unknown = [task for task in task_graph.all_tasks if project.history.duration(task) is None]
+
+	print(f'Critical path of [{label}]:')
+	for task in path:
+		print(f'\t{estimates[task]:10.2f} s  {task.label}{" (no history)" if project.history.duration(task) is None else ""}')
+	print(f'Total work:         {sum(estimates.values()):10.2f} s over {len(estimates)} tasks')
+	print(f'Critical path:      {remaining[path[0]]:10.2f} s')
+	print(f'Estimated with -j {args.jobs}: {simulate(task_graph, estimates, args.jobs):8.2f} s')
+	if unknown:
+		print(f'{len(unknown)} of {len(estimates)} tasks have never executed, and are estimated to take as long as the average task.')
+	return 0
+
+def resolve_label(project: Project, label_or_alias: str) -> str:
+	for label, aliases in task_aliases(project).items():
+		if label_or_alias == label or label_or_alias in aliases:
+			return label
+	raise RuntimeError(f'Could not find a task named "{label_or_alias}".')
+
+def task_aliases(project: Project) -> t.Dict[str, t.List[str]]:
+	# Tasks defined in the current directory can also be run by their name alone.
+	current_working_directory = str(Path.cwd())
+	aliases = dict()
+	for label, entry in project.task_loader.manifest.tasks.items():
+		name = label.split(':', 1)[1]
+		aliases[label] = [name] if entry['working_directory'] == current_working_directory and name not in BUILTIN_COMMANDS else list()
+	return aliases
+
+def build_parser(project: Project) -> ArgumentParser:
 	parser = ArgumentParser()
 	subparsers = parser.add_subparsers()
 
-	current_working_directory_path = Path.cwd()
-	tasks_in_current_dir = {task for task in tasks if task.working_directory_path == current_working_directory_path}
+	cache_parser = subparsers.add_parser('cache', help='Manages the task cache.')
+	cache_subparsers = cache_parser.add_subparsers(required=True)
+	gc_parser = cache_subparsers.add_parser('gc', help='Evicts the least recently used entries from the task cache until it fits within its size and age limits.')
+	gc_parser.set_defaults(command=cache_gc)
+	gc_parser.add_argument('--max-size', type=str, default=None, help='Overrides the "cache_max_size" setting, e.g. "10GB".')
+	gc_parser.add_argument('--max-age-days', type=float, default=None, help='Overrides the "cache_max_age_days" setting.')
+	serve_parser = cache_subparsers.add_parser('serve', help='Serves a task cache directory over HTTP, for use as a remote "http" task cache.')
+	serve_parser.set_defaults(command=cache_serve)
+	serve_parser.add_argument('--directory', type=str, default=None, help='The directory to store entries in. Defaults to the "cache_location" setting.')
+	serve_parser.add_argument('--host', type=str, default='127.0.0.1', help='The address to listen on. Use 0.0.0.0 to accept connections from other machines.')
+	serve_parser.add_argument('--port', type=int, default=8080)
+	serve_parser.add_argument('--max-size', type=str, default=None, help='Overrides the "cache_max_size" setting, e.g. "10GB".')
+	serve_parser.add_argument('--max-age-days', type=float, default=None, help='Overrides the "cache_max_age_days" setting.')
 
-	for task in task_graph.all_tasks:
-		if task in tasks_in_current_dir:
-			aliases=[task.name]
-		else:
-			aliases=list()
-		task_parser = subparsers.add_parser(task.label, aliases=aliases, help=f'Runs the {task} task and all of its dependencies.' if not task.doc else task.doc)
-		task_parser.set_defaults(task_to_execute=task)
+	daemon_parser = subparsers.add_parser('daemon', help='Manages a daemon keeping the project loaded between invocations, which makes them start much faster.')
+	daemon_subparsers = daemon_parser.add_subparsers(required=True)
+	daemon_start_parser = daemon_subparsers.add_parser('start', help='Starts a daemon in the background, unless one is already serving the project.')
+	daemon_start_parser.set_defaults(command=daemon_start)
+	daemon_start_parser.add_argument('--timeout', type=float, default=60, help='How many seconds to wait for the daemon to load the project.')
+	daemon_run_parser = daemon_subparsers.add_parser('run', help='Runs a daemon in the foreground.')
+	daemon_run_parser.set_defaults(command=daemon_run)
+	daemon_run_parser.add_argument('--listen-fd', type=int, default=None, help='Serves an already listening socket, as the daemon does when it restarts itself.')
+	daemon_stop_parser = daemon_subparsers.add_parser('stop', help='Stops the daemon serving the project.')
+	daemon_stop_parser.set_defaults(command=daemon_stop)
+	daemon_status_parser = daemon_subparsers.add_parser('status', help='Shows whether a daemon is serving the project.')
+	daemon_status_parser.set_defaults(command=daemon_status)
+
+	watch_parser = subparsers.add_parser('watch', help='Runs a task, then runs it again whenever the inputs of it or its dependencies change.')
+	watch_parser.set_defaults(command=watch)
+	watch_parser.add_argument('task', type=str, help='The label (or, in its own directory, the name) of the task to watch.')
+	watch_parser.add_argument('-p', '--properties', nargs='*', type=str, action=ParseKwargs, default=dict())
+	watch_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='The maximum number of tasks to execute concurrently. Defaults to the number of CPUs.')
+	watch_parser.add_argument('--debounce', type=float, default=0.2, help='How many seconds to wait for changes to settle before executing.')
+	watch_parser.add_argument('--poll', action='store_true', help='Poll for changes instead of using inotify.')
+	watch_parser.add_argument('--poll-interval', type=float, default=1.0, help='How many seconds to wait between polls.')
+
+	affected_parser = subparsers.add_parser('affected', help='Lists the tasks having any of the changed files as an input, and every task depending on them. Changed files are read from stdin unless given otherwise.')
+	affected_parser.set_defaults(command=affected)
+	affected_parser.add_argument('paths', nargs='*', type=str, help='Changed files, relative to the current directory.')
+	affected_parser.add_argument('--file', type=str, default=None, help='Reads changed files from FILE, one per line, or from stdin if FILE is "-".')
+	affected_parser.add_argument('--git-diff', type=str, default=None, metavar='REVISIONS', help='Takes the changed files from "git diff --name-only REVISIONS", e.g. "origin/main...HEAD".')
+	affected_parser.add_argument('-x', '--execute', action='store_true', help='Executes the affected tasks (and their dependencies) instead of listing them.')
+	affected_parser.add_argument('-p', '--properties', nargs='*', type=str, action=ParseKwargs, default=dict())
+	affected_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='The maximum number of tasks to execute concurrently. Defaults to the number of CPUs.')
+	add_failure_arguments(affected_parser)
+	add_output_argument(affected_parser)
+	add_metrics_arguments(affected_parser)
+
+	stats_parser = subparsers.add_parser('stats', help='Shows cache hit rates, bytes moved, hashing throughput, time by phase and unstable input hashes across the last runs.')
+	stats_parser.set_defaults(command=stats)
+	stats_parser.add_argument('files', nargs='*', type=str, help='Metrics histories or files written with --metrics to aggregate, instead of the project\'s own history.')
+	stats_parser.add_argument('-n', '--runs', type=int, default=20, help='How many of the latest runs to aggregate, or 0 for all of them.')
+
+	plan_parser = subparsers.add_parser('plan', help='Shows the estimated critical path and duration of a task and its dependencies, from how long they took before.')
+	plan_parser.set_defaults(command=plan)
+	plan_parser.add_argument('task', type=str, help='The label (or, in its own directory, the name) of the task to plan.')
+	plan_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='The number of jobs to estimate the duration with. Defaults to the number of CPUs.')
+
+	# The parser is built from the task manifest, so no task files need to be loaded to build it.
+	aliases = task_aliases(project)
+	for label, entry in sorted(project.task_loader.manifest.tasks.items()):
+		task_parser = subparsers.add_parser(label, aliases=aliases[label], help=f'Runs the [{label}] task and all of its dependencies.' if not entry['doc'] else entry['doc'])
+		task_parser.set_defaults(command=execute_task, task_to_execute=label)
+		task_parser.add_argument('targets', nargs='*', type=str, help='More tasks to execute along with this one, by label (or, in their own directory, by name).')
 		task_parser.add_argument('-p', '--properties', nargs='*', type=str, action=ParseKwargs, default=dict())
+		task_parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='The maximum number of tasks to execute concurrently. Defaults to the number of CPUs.')
+		task_parser.add_argument('--lazy', action='store_true', help='Only restore the cached outputs of dependencies when a task depending on them has to execute.')
+		task_parser.add_argument('--trace', type=str, default=None, metavar='FILE', help='Writes a Chrome trace of where time was spent to FILE, and prints a summary of the slowest tasks and phases.')
+		add_failure_arguments(task_parser)
+		add_output_argument(task_parser)
+		add_metrics_arguments(task_parser)
+	return parser
+
+def main(argv: t.List[str] = None, project: Project = None):
+	argv = sys.argv[1:] if argv is None else argv
+	# Tracing starts before anything else, so that finding and loading task files is traced too.
+	trace_parser = ArgumentParser(add_help=False)
+	trace_parser.add_argument('--trace', type=str, default=None)
+	trace_path = trace_parser.parse_known_args(argv)[0].trace
+	tracer = trace.start_tracing() if trace_path else None
+	# So do the metrics of the run, which are only saved by commands executing tasks.
+	metrics.start()
+
+	# The daemon passes the project it keeps loaded.
+	if project is None:
+		with trace.span('load project', 'startup'):
+			project = Project.find(Path.cwd())
+	logging.basicConfig(format='[xtask] %(levelname)s: %(message)s', level=logging._nameToLevel.get(project.settings.log_level.upper()))
 
-	args = parser.parse_args()
+	# A command that isn't known may be a task from a task file added since the task manifest was saved.
+	command = next((arg for arg in argv if not arg.startswith('-')), None)
+	if command is not None and not project.task_loader.is_up_to_date:
+		known_commands = BUILTIN_COMMANDS.union(project.task_loader.manifest.tasks, *task_aliases(project).values())
+		if command not in known_commands:
+			project.task_loader.discover()
 
-	context = Context(args.task_to_execute, task_graph, task_cache, args.properties)
-	context.execute(args.task_to_execute, use_cache=True, with_dependencies=True)
+	with trace.span('build parser', 'startup'):
+		parser = build_parser(project)
+	args = parser.parse_args(argv)
+	if not hasattr(args, 'command'):
+		parser.print_help()
+		exit(1)
 
-	exit(0)
+	try:
+		result = args.command(project, args)
+	finally:
+		if tracer is not None:
+			tracer.save(Path(trace_path).resolve())
+			logging.info(f'Wrote a trace to "{trace_path}"\n{tracer.summary()}')
+	exit(result)
 
 if __name__ == '__main__':
-	main()
\ No newline at end of file
+	main()
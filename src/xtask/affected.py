@@ -0,0 +1,64 @@
+import os
+import typing as t
+from pathlib import Path
+
+from xtask.path_matcher import PathMatcher, path_matcher
+from xtask.task import Task
+from xtask.task_graph import TaskGraph
+
+
+class AffectedTaskIndex():
+	# Maps changed files to the tasks whose inputs they are, without globbing anything: every input pattern is indexed by the
+	# directory its literal prefix names (e.g. "<working directory>/src" for "src/**/*.c"), so a changed file is only
+	# matched against the patterns of the tasks indexed under one of its parent directories. Changing a task file affects
+	# every task it declares.
+
+	_task_graph: TaskGraph
+	_tasks_by_directory: t.Dict[str, t.List[Task]]
+	_tasks_by_file: t.Dict[str, t.List[Task]]
+	# Tasks with patterns that may match anywhere, which are matched against every changed file.
+	_unindexed_tasks: t.List[Task]
+	_matchers: t.Dict[Task, PathMatcher]
+
+	def __init__(self, task_graph: TaskGraph):
+		self._task_graph = task_graph
+		self._tasks_by_directory = dict()
+		self._tasks_by_file = dict()
+		self._unindexed_tasks = list()
+		self._matchers = dict()
+		for task in task_graph.all_tasks:
+			if task.file_path:
+				self._tasks_by_file.setdefault(os.path.normpath(os.path.abspath(str(task.file_path))), list()).append(task)
+			if not task._include_src_patterns:
+				continue
+			matcher = path_matcher(tuple(task._include_src_patterns), tuple(task._exclude_src_patterns))
+			self._matchers[task] = matcher
+			prefixes = matcher.literal_prefixes()
+			if prefixes is None:
+				self._unindexed_tasks.append(task)
+				continue
+			root = os.path.normpath(os.path.abspath(str(task.working_directory_path)))
+			for directory in {os.path.join(root, *prefix) for prefix in prefixes}:
+				self._tasks_by_directory.setdefault(directory, list()).append(task)
+
+	def affected_tasks(self, changed_paths: t.Iterable[Path]) -> t.Set[Task]:
+		# The tasks having any of the changed files as an input, or declared in any of them.
+		affected = set()
+		for changed_path in changed_paths:
+			path = os.path.normpath(os.path.abspath(str(changed_path)))
+			affected.update(self._tasks_by_file.get(path, ()))
+			candidates = set(self._unindexed_tasks)
+			directory = os.path.dirname(path)
+			while True:
+				candidates.update(self._tasks_by_directory.get(directory, ()))
+				parent = os.path.dirname(directory)
+				if parent == directory:
+					break
+				directory = parent
+			for task in candidates - affected:
+				if self._matchers[task].matches(task.working_directory_path, Path(path)):
+					affected.add(task)
+		return affected
+
+	def affected_tasks_and_dependents(self, changed_paths: t.Iterable[Path]) -> t.Set[Task]:
+		return self._task_graph.dependents(*self.affected_tasks(changed_paths))
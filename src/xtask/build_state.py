@@ -0,0 +1,87 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import typing as t
+from pathlib import Path
+
+from xtask.task import Task
+
+
+class BuildState():
+	# Remembers, for every task built in the project, the input hash it was last built with and a fingerprint of the outputs
+	# it left on disk. A task whose input hash and outputs both still match is up to date and doesn't need to run again, or
+	# even to be restored from the task cache.
+
+	_file_path: t.Optional[Path]
+	_entries: t.Optional[t.Dict[str, t.Dict[str, str]]]
+	_dirty: bool
+	_lock: threading.Lock
+
+	def __init__(self, file_path: str | Path = None):
+		self._file_path = Path(file_path) if file_path else None
+		self._entries = None
+		self._dirty = False
+		self._lock = threading.Lock()
+
+	def is_up_to_date(self, task: Task, input_hash: int) -> bool:
+		with self._lock:
+			entry = self._load().get(task.label)
+		if entry is None or entry['input_hash'] != str(input_hash):
+			return False
+		return entry['outputs'] == self.outputs_fingerprint(task)
+
+	def record(self, task: Task, input_hash: int) -> None:
+		fingerprint = self.outputs_fingerprint(task)
+		with self._lock:
+			self._load()[task.label] = {'input_hash': str(input_hash), 'outputs': fingerprint}
+			self._dirty = True
+
+	def forget(self, task: Task) -> None:
+		with self._lock:
+			if self._load().pop(task.label, None) is not None:
+				self._dirty = True
+
+	def preload(self) -> None:
+		# Reads the build state now, rather than when the first task is checked. The daemon does so before forking
+		# invocations, so that none of them has to.
+		with self._lock:
+			self._load()
+
+	def save(self) -> None:
+		with self._lock:
+			if not self._dirty or self._file_path is None:
+				return
+			self._file_path.parent.mkdir(parents=True, exist_ok=True)
+			file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(self._file_path.parent), prefix='.tmp-')
+			with os.fdopen(file_descriptor, 'w') as temp_file:
+				json.dump(self._entries, temp_file, indent='\t')
+			os.replace(temp_file_name, str(self._file_path))
+			self._dirty = False
+
+	@staticmethod
+	def outputs_fingerprint(task: Task) -> str:
+		# Outputs are fingerprinted by their stat rather than their content, which is enough to notice that an output was
+		# deleted, modified or replaced since the task last ran.
+		fingerprint = hashlib.md5()
+		for output_file in sorted(task.outputs()):
+			try:
+				stat_result = os.stat(output_file)
+			except FileNotFoundError:
+				continue
+			fingerprint.update(f'{output_file}\0{stat_result.st_size}\0{stat_result.st_mtime_ns}\0{stat_result.st_ino}\n'.encode('utf-8'))
+		return fingerprint.hexdigest()
+
+	def _load(self) -> t.Dict[str, t.Dict[str, str]]:
+		if self._entries is None:
+			self._entries = dict()
+			if self._file_path is not None:
+				try:
+					self._entries = json.loads(self._file_path.read_text())
+				except FileNotFoundError:
+					pass
+				except ValueError:
+					logging.warning(f'Ignoring the corrupt build state "{self._file_path}"')
+		return self._entries
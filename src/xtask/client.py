@@ -0,0 +1,134 @@
+import json
+import os
+import signal
+import socket
+import stat
+import struct
+import sys
+import typing as t
+
+import xtask.constants as const
+
+# The command line entry point. When a daemon is serving the project (see xtask.daemon), the invocation is handed to it
+# along with this process's stdin, stdout and stderr, and only its exit code comes back. Otherwise xtask runs in this
+# process as usual. Beyond what the package itself exports to task files, imports are kept to a minimum until then (paths
+# are plain strings, and nothing here imports the project, the task loader or the caches), since importing is all the
+# time the daemon can't save.
+
+# Unix socket paths are limited to around 100 characters.
+_MAX_SOCKET_PATH_LENGTH = 100
+
+
+def main() -> None:
+	argv = sys.argv[1:]
+	# The daemon's own commands always run here, and so does everything when XTASK_NO_DAEMON is set.
+	if os.name != 'nt' and not os.environ.get('XTASK_NO_DAEMON') and (not argv or argv[0] != 'daemon'):
+		exit_code = forward(find_root_path(os.getcwd()), argv)
+		if exit_code is not None:
+			sys.exit(exit_code)
+	from xtask.__main__ import main as xtask_main
+	xtask_main(argv)
+
+def find_root_path(start_path: str) -> str:
+	# The same search as Project.find, without importing it.
+	current_path = start_path
+	while not os.path.exists(os.path.join(current_path, const.ROOT_SETTINGS_FILE_NAME)):
+		if current_path == os.path.dirname(current_path):
+			return start_path
+		current_path = os.path.dirname(current_path)
+	return current_path
+
+def daemon_socket_path(root_path: str) -> str:
+	socket_path = os.path.join(root_path, const.STATE_DIRECTORY_NAME, const.DAEMON_SOCKET_FILE_NAME)
+	if len(socket_path) <= _MAX_SOCKET_PATH_LENGTH:
+		return socket_path
+	import hashlib
+	return os.path.join(runtime_directory(), f'xtask-{hashlib.md5(root_path.encode()).hexdigest()}.sock')
+
+def runtime_directory() -> str:
+	# A directory only the current user can access, for sockets that don't fit in the project's state directory. Raises a
+	# RuntimeError if it exists but could be accessed (or replaced) by another user.
+	directory_path = os.environ.get('XDG_RUNTIME_DIR')
+	if not directory_path:
+		import tempfile
+		directory_path = os.path.join(tempfile.gettempdir(), f'xtask-{os.getuid()}')
+		try:
+			os.mkdir(directory_path, 0o700)
+		except FileExistsError:
+			pass
+	stat_result = os.lstat(directory_path)
+	if not stat.S_ISDIR(stat_result.st_mode) or stat_result.st_uid != os.getuid() or stat_result.st_mode & 0o077:
+		raise RuntimeError(f'The directory "{directory_path}" must be owned by the current user and only accessible to them')
+	return directory_path
+
+def peer_uid(connection: socket.socket) -> t.Optional[int]:
+	# The user of the process at the other end of a Unix socket, where the platform tells.
+	if not hasattr(socket, 'SO_PEERCRED'):
+		return None
+	credentials = struct.Struct('3i')
+	_, uid, _ = credentials.unpack(connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, credentials.size))
+	return uid
+
+def connect(root_path: str) -> t.Optional[socket.socket]:
+	# Returns a connection to the daemon serving the project, or None if there isn't one. Only a daemon run by the current
+	# user is trusted with the invocation, since it gets the environment and the terminal.
+	try:
+		socket_path = daemon_socket_path(root_path)
+	except (OSError, RuntimeError) as e:
+		print(f'[xtask] WARNING: Not using the daemon: {e}', file=sys.stderr)
+		return None
+	try:
+		stat_result = os.lstat(socket_path)
+	except FileNotFoundError:
+		return None
+	if not stat.S_ISSOCK(stat_result.st_mode) or stat_result.st_uid != os.getuid():
+		print(f'[xtask] WARNING: Not using the daemon, since "{socket_path}" is not a socket created by the current user', file=sys.stderr)
+		return None
+	connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		connection.connect(socket_path)
+	except OSError:
+		connection.close()
+		return None
+	uid = peer_uid(connection)
+	if uid is not None and uid != os.getuid():
+		print(f'[xtask] WARNING: Not using the daemon, since it is run by another user ({uid})', file=sys.stderr)
+		connection.close()
+		return None
+	return connection
+
+def send_request(connection: socket.socket, request: t.Dict[str, t.Any], fds: t.List[int] = ()) -> None:
+	# A request is its length, sent along with any file descriptors, then the request itself as JSON.
+	body = json.dumps(request).encode()
+	socket.send_fds(connection, [struct.pack('!I', len(body))], list(fds))
+	connection.sendall(body)
+
+def forward(root_path: str, argv: t.List[str]) -> t.Optional[int]:
+	# Runs the invocation in the daemon, returning its exit code, or None if no daemon is serving the project.
+	connection = connect(root_path)
+	if connection is None:
+		return None
+	with connection:
+		send_request(connection, {'argv': argv, 'cwd': os.getcwd(), 'environment': dict(os.environ)}, [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+		# The daemon answers with the process executing the invocation, then with its exit code once it is done.
+		process_id = None
+		replies = connection.makefile('r')
+		while True:
+			try:
+				line = replies.readline()
+			except KeyboardInterrupt:
+				# Interrupt the invocation and everything it started, as if it ran in this terminal.
+				if process_id is not None:
+					os.killpg(process_id, signal.SIGINT)
+				continue
+			if not line:
+				print('[xtask] ERROR: The daemon closed the connection before the invocation finished.', file=sys.stderr)
+				return 1
+			reply = json.loads(line)
+			if 'pid' in reply:
+				process_id = reply['pid']
+			elif 'exit_code' in reply:
+				return reply['exit_code']
+
+if __name__ == '__main__':
+	main()
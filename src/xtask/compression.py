@@ -0,0 +1,98 @@
+import threading
+import typing as t
+import zipfile
+import zlib
+from pathlib import Path
+
+import xtask.metrics as metrics
+
+# The compression methods of cache archives, by name. "auto" picks between "stored" and "deflate" for each file.
+_COMPRESS_TYPES = {
+	'stored': zipfile.ZIP_STORED,
+	'deflate': zipfile.ZIP_DEFLATED,
+	'bz2': zipfile.ZIP_BZIP2,
+	'lzma': zipfile.ZIP_LZMA,
+}
+_LEVELS = {
+	'deflate': range(0, 10),
+	'bz2': range(1, 10),
+}
+METHODS = [*_COMPRESS_TYPES, 'auto']
+
+
+class CompressionPolicy():
+	# How files are compressed in cache archives. With "auto", the start of each file is compressed with the fastest deflate
+	# level first: files that shrink by at least AUTO_MIN_SAVINGS are deflated (at the policy's level), and the rest, which
+	# are usually compressed already, are stored as they are.
+
+	SAMPLE_SIZE = 64 * 1024
+	AUTO_MIN_SAVINGS = 0.1
+
+	method: str
+	level: t.Optional[int]
+
+	def __init__(self, method: str = 'stored', level: int = None):
+		if method not in METHODS:
+			raise RuntimeError(f'Unknown compression method "{method}". Valid values are: {", ".join(METHODS)}')
+		levels = _LEVELS.get('deflate' if method == 'auto' else method)
+		if level is not None and (levels is None or level not in levels):
+			raise RuntimeError(f'Invalid compression level {level} for "{method}".' + (f' Valid levels are {levels.start} to {levels.stop - 1}.' if levels is not None else ' It takes no level.'))
+		self.method = method
+		self.level = level
+
+	def choose(self, file_path: Path) -> t.Tuple[str, int, t.Optional[int]]:
+		# Returns the method for a file, and the zipfile compression type and level to write it with.
+		method = self.method
+		if method == 'auto':
+			method = 'deflate' if self._is_compressible(file_path) else 'stored'
+		return method, _COMPRESS_TYPES[method], self.level if method != 'stored' else None
+
+	def _is_compressible(self, file_path: Path) -> bool:
+		with open(str(file_path), 'rb') as file:
+			sample = file.read(self.SAMPLE_SIZE)
+		if not sample:
+			return False
+		return len(zlib.compress(sample, 1)) <= len(sample) * (1 - self.AUTO_MIN_SAVINGS)
+
+	def __str__(self) -> str:
+		return self.method if self.level is None else f'{self.method} (level {self.level})'
+
+class CompressionStats():
+	# Counts the files written to cache archives, their size before and after compression, and the time spent writing them,
+	# per compression method. Logged once a run is done, and recorded in the run's metrics for xtask stats, to help pick a
+	# policy.
+
+	_totals: t.Dict[str, t.List[float]]
+	_lock: threading.Lock
+
+	def __init__(self):
+		# Per method: [files, original bytes, compressed bytes, seconds].
+		self._totals = dict()
+		self._lock = threading.Lock()
+
+	def record(self, method: str, original_size: int, compressed_size: int, seconds: float) -> None:
+		metrics.record_compression(method, original_size, compressed_size, seconds)
+		with self._lock:
+			totals = self._totals.setdefault(method, [0, 0, 0, 0.0])
+			totals[0] += 1
+			totals[1] += original_size
+			totals[2] += compressed_size
+			totals[3] += seconds
+
+	def as_dict(self) -> t.Dict[str, t.Dict[str, float]]:
+		with self._lock:
+			return {method: {'files': totals[0], 'original_bytes': totals[1], 'compressed_bytes': totals[2], 'seconds': totals[3]} for method, totals in self._totals.items()}
+
+	def summary(self) -> t.Optional[str]:
+		totals = self.as_dict()
+		if not totals:
+			return None
+		original_size = sum(method_totals['original_bytes'] for method_totals in totals.values())
+		compressed_size = sum(method_totals['compressed_bytes'] for method_totals in totals.values())
+		seconds = sum(method_totals['seconds'] for method_totals in totals.values())
+		methods = ', '.join(f'{method}: {int(method_totals["files"])} files, {_megabytes(method_totals["original_bytes"])} -> {_megabytes(method_totals["compressed_bytes"])}' for method, method_totals in sorted(totals.items()))
+		ratio = compressed_size / original_size if original_size else 1.0
+		return f'Wrote {_megabytes(original_size)} of outputs to the task cache as {_megabytes(compressed_size)} ({ratio:.0%}) in {seconds:.2f} s ({methods})'
+
+def _megabytes(size: float) -> str:
+	return f'{size / (1024 * 1024):.1f} MB'
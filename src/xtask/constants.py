@@ -1,5 +1,17 @@
 ROOT_SETTINGS_FILE_NAME='xtask.project'
 
+# Local state (digests, build state, ...) is kept in this directory under the project root.
+STATE_DIRECTORY_NAME='.xtask'
+DIGEST_CACHE_FILE_NAME='digests.json'
+TASK_MANIFEST_FILE_NAME='tasks.json'
+BUILD_STATE_FILE_NAME='build_state.json'
+TASK_HISTORY_FILE_NAME='history.json'
+METRICS_FILE_NAME='metrics.jsonl'
+# The local tier of a remote task cache, when no cache location is configured.
+REMOTE_CACHE_DIRECTORY_NAME='remote-cache'
+DAEMON_SOCKET_FILE_NAME='daemon.sock'
+DAEMON_LOG_FILE_NAME='daemon.log'
+
 TASKS_FILE_EXTENSION='.tasks'
 TASKS_FILE_PATTERN=f'*{TASKS_FILE_EXTENSION}'
 
@@ -1,26 +1,109 @@
+import hashlib
 import logging
+import sys
+import threading
+import time
 import typing as t
+from contextlib import ExitStack
+from dataclasses import dataclass
 from pathlib import Path
 
+import xtask.jobserver as jobserver
+import xtask.metrics as metrics
+import xtask.trace as trace
+from xtask.build_state import BuildState
+from xtask.file_digest import FileDigestCache
+from xtask.path_matcher import DirectoryListingCache
+from xtask.scheduler import Scheduler, critical_paths
 from xtask.task import Task
 from xtask.task_cache import TaskCache
 from xtask.task_graph import TaskGraph
-from xtask.util import working_dir
+from xtask.task_history import TaskHistory
+from xtask.task_output import PREFIXED, TaskOutput
+from xtask.util import cancellation, task_directory, working_dir
+
+if t.TYPE_CHECKING:
+	from xtask.task_manifest import TaskLoader
+
+# Task actions run inside of their working directory, which is process-wide state. Only one such action may run at a time,
+# while hashing and cache operations (which only use absolute paths) are free to run concurrently on the scheduler's
+# workers, and so are the actions of thread-safe tasks, which resolve paths against their task's directory instead.
+_action_lock = threading.RLock()
+_action_state = threading.local()
+
+# How a task's execution ended.
+EXECUTED = 'executed'
+FAILED = 'failed'
+RESTORED = 'restored from cache'
+UP_TO_DATE = 'up to date'
+# Not executed because a dependency failed.
+SKIPPED = 'skipped'
+# Not executed (or interrupted) because another task failed.
+CANCELLED = 'cancelled'
+
+
+class TaskFailedError(RuntimeError):
+	# Raised by Context.execute once the tasks it executed are done, if any of them failed.
+
+	failed_tasks: t.List[Task]
+
+	def __init__(self, failed_tasks: t.List[Task]):
+		super().__init__(f'Failed to execute: {", ".join(str(task) for task in failed_tasks)}')
+		self.failed_tasks = failed_tasks
+
+
+@dataclass
+class TaskResult():
+
+	status: str
+	# Seconds from when the task started until it was done, including hashing and the task cache.
+	duration: float
 
 
 class Context():
 
 	this_task: Task
 	properties: t.Dict[str, str]
+	jobs: int
+	lazy: bool
+	keep_going: bool
+	output_mode: str
 
 	_task_graph: TaskGraph
 	_task_cache: TaskCache
+	_digest_cache: FileDigestCache
+	_task_loader: t.Optional['TaskLoader']
+	_build_state: BuildState
+	_listing_cache: DirectoryListingCache
+	_history: TaskHistory
+	_results: t.Dict[Task, TaskResult]
+	_cancelled: threading.Event
 
-	def __init__(self, this_task: Task, task_graph: TaskGraph, task_cache: TaskCache, properties: t.Dict[str, str]) -> None:
+	def __init__(self, this_task: Task, task_graph: TaskGraph, task_cache: TaskCache, properties: t.Dict[str, str], jobs: int = 1, digest_cache: FileDigestCache = None, task_loader: 'TaskLoader' = None, build_state: BuildState = None, listing_cache: DirectoryListingCache = None, lazy: bool = False, history: TaskHistory = None, results: t.Dict[Task, TaskResult] = None, keep_going: bool = False, cancelled: threading.Event = None, output_mode: str = PREFIXED) -> None:
 		self.this_task = this_task
 		self._task_graph = task_graph
 		self._task_cache = task_cache
 		self.properties = properties
+		self.jobs = jobs
+		self.lazy = lazy
+		self.keep_going = keep_going
+		self.output_mode = output_mode
+		self._digest_cache = digest_cache if digest_cache is not None else FileDigestCache()
+		self._task_loader = task_loader
+		self._build_state = build_state if build_state is not None else BuildState()
+		# Shared by every task of the run to list directories only once while globbing inputs and outputs. It is invalidated
+		# whenever an action runs or outputs are restored, since either may change any directory.
+		self._listing_cache = listing_cache if listing_cache is not None else DirectoryListingCache()
+		self._history = history if history is not None else TaskHistory()
+		self._results = results if results is not None else dict()
+		# Set once a task fails, unless the run keeps going. It is shared by the contexts of every action in the run, so the
+		# whole run stops: no other task starts, and processes started with xtask.util.run are terminated.
+		self._cancelled = cancelled if cancelled is not None else threading.Event()
+
+	@property
+	def working_directory(self) -> Path:
+		# The directory relative paths of this context's task are resolved against, whatever the process's working directory is.
+		return self.this_task.working_directory_path
 
 	def task(self, task_name: str) -> Task:
 		if ':' in task_name:
@@ -28,44 +111,233 @@ class Context():
 		else:
 			task_group, task_name = self.this_task.group, task_name
 
-		for task in self._task_graph.all_tasks:
-			if task.name == task_name and task.group == task_group:
-				return task
+		task = self._task_graph.task(f'{task_group}:{task_name}')
+		if task is not None:
+			return task
+
+		# The graph may only hold the tasks needed for the current invocation, so load the rest of the project's tasks.
+		if self._task_loader is not None and f'{task_group}:{task_name}' in self._task_loader.manifest.tasks:
+			self._task_graph = self._task_loader.full_graph()
+			return self.task(f'{task_group}:{task_name}')
 
 		return None
 
+	@property
+	def results(self) -> t.Dict[Task, TaskResult]:
+		return dict(self._results)
+
+	def result(self, task: Task) -> t.Optional[TaskResult]:
+		# How the task's latest execution through this context (or the contexts of actions it executed) ended, if it executed.
+		return self._results.get(task)
+
 	def execute(self, *tasks: Task, use_cache=True, with_dependencies=True) -> None:
+		# Raises a TaskFailedError if any of the tasks (or their dependencies) failed, so an action executing other tasks fails
+		# along with them.
 		if with_dependencies:
-			for task, finalizer in self._task_graph.subgraph(*tasks).topological_order():
-				self._execute(task, use_cache=use_cache)
-				finalizer()
+			task_graph = self._task_graph.subgraph(*tasks)
+			self.execute_graph(task_graph, use_cache=use_cache)
+			executed_tasks = task_graph.all_tasks
 		else:
 			for task in tasks:
-				self._execute(task, use_cache=use_cache)
+				if not self._execute(task, use_cache=use_cache) and not self.keep_going:
+					break
+			executed_tasks = tasks
+		failed_tasks = [task for task in executed_tasks if self.result(task) is not None and self.result(task).status == FAILED]
+		if failed_tasks:
+			raise TaskFailedError(failed_tasks)
+
+	def execute_graph(self, task_graph: TaskGraph, use_cache=True) -> None:
+		# Executes every task of the graph, e.g. a subgraph of this context's graph. Unlike execute, failed tasks don't raise:
+		# how each task ended is in results.
+		# An action executing other tasks while holding the action lock must run them on the same thread.
+		jobs = 1 if getattr(_action_state, 'locked', False) else self.jobs
+		input_hashes = dict()
+		if self.lazy and use_cache:
+			with trace.span('plan', 'startup'):
+				input_hashes = self._lazy_input_hashes(task_graph)
+				task_graph = task_graph.restrict(self._required_tasks(task_graph, input_hashes))
+		# Tasks on the longest chain of estimated durations go first, so the slowest chain doesn't hold up the end of the run.
+		priorities = critical_paths(task_graph, self._history.estimates(task_graph.all_tasks)) if jobs > 1 else None
+		scheduler = Scheduler(task_graph, jobs=jobs, priorities=priorities, keep_going=self.keep_going)
+		# Processes started by actions share the jobs of the invocation through the jobserver.
+		with jobserver.serve(self.jobs):
+			try:
+				not_executed = scheduler.run(lambda task: self._execute(task, use_cache=use_cache, input_hash=input_hashes.get(task)))
+			except KeyboardInterrupt:
+				# Processes started with xtask.util.run are in sessions of their own, so the interrupt doesn't reach those
+				# started on other threads: cancelling the run terminates them.
+				self._cancelled.set()
+				raise
+		for task in not_executed:
+			logging.info(f'Not executing {task}, since ' + ('one of its dependencies failed' if self.keep_going else 'another task failed'))
+			self._results[task] = TaskResult(SKIPPED if self.keep_going else CANCELLED, 0.0)
 
-	def _execute(self, task: Task, use_cache=True) -> None:
+	def _lazy_input_hashes(self, task_graph: TaskGraph) -> t.Dict[Task, int]:
+		# Computes the input hash of every task before anything executes, so that outputs of dependencies never need to be on
+		# disk. Inputs produced by dependencies are left out of a task's own inputs, and the input hashes of its dependencies
+		# are hashed in their place. Tasks that can't be hashed up front (those not using the cache, or depending on one that
+		# produces outputs without caching them) are hashed as usual when they execute.
+		input_hashes: t.Dict[Task, int] = dict()
+		unhashable: t.Set[Task] = set()
+		upstream_outputs: t.Dict[Task, t.Set[str]] = dict()
+		for task, done in task_graph.topological_order():
+			upstream_outputs[task] = set()
+			for dependency in task.dependencies:
+				upstream_outputs[task].update(upstream_outputs[dependency], dependency.outputs(self._listing_cache))
+			if not task.use_cache:
+				# Without outputs, a task that isn't cached can't affect the inputs of the tasks depending on it.
+				if task._include_out_patterns:
+					unhashable.add(task)
+			elif any(dependency in unhashable for dependency in task.dependencies):
+				unhashable.add(task)
+			else:
+				in_hash = hashlib.md5(task.input_hash(self._digest_cache, self._listing_cache, exclude=upstream_outputs[task]).to_bytes(16, byteorder=sys.byteorder))
+				for dependency in sorted(task.dependencies, key=lambda dependency: dependency.label):
+					if dependency in input_hashes:
+						in_hash.update(input_hashes[dependency].to_bytes(16, byteorder=sys.byteorder))
+				input_hashes[task] = int.from_bytes(in_hash.digest(), byteorder=sys.byteorder)
+			done()
+		return input_hashes
+
+	def _required_tasks(self, task_graph: TaskGraph, input_hashes: t.Dict[Task, int]) -> t.Set[Task]:
+		# Only the outputs of the tasks that were asked for are needed. The outputs of their dependencies are only needed if
+		# they have to execute their action, because they are neither up to date nor cached (or can't be hashed up front).
+		depended_on = {dependency for task in task_graph.all_tasks for dependency in task.dependencies}
+		required = {task for task in task_graph.all_tasks if task not in depended_on}
+		cached = self._task_cache.contains_many(input_hashes.values()) if self._task_cache is not None else set()
+		pending = list(required)
+		while pending:
+			task = pending.pop()
+			input_hash = input_hashes.get(task)
+			if input_hash is not None and (input_hash in cached or self._build_state.is_up_to_date(task, input_hash)):
+				continue
+			for dependency in task.dependencies:
+				if dependency not in required:
+					required.add(dependency)
+					pending.append(dependency)
+		for task in task_graph.all_tasks:
+			if task not in required:
+				logging.info(f'Skipping {task}, since its outputs are not needed')
+		return required
+
+	def _execute(self, task: Task, use_cache=True, input_hash: int = None) -> bool:
+		# Returns whether the task succeeded.
+		start = time.perf_counter()
+		with trace.span(task.label, 'task', label=task.label):
+			status = self._execute_task(task, use_cache=use_cache, input_hash=input_hash)
+		self._results[task] = TaskResult(status, time.perf_counter() - start)
+		if status in (FAILED, CANCELLED):
+			if not self.keep_going:
+				self._cancelled.set()
+			return False
+		return True
+
+	def _execute_task(self, task: Task, use_cache=True, input_hash: int = None) -> str:
 		logging.info(f'Preparing to execute: {task}')
 		working_directory = str(task.working_directory_path)
-		with working_dir(working_directory):
-			if use_cache and self._task_cache is not None and task.use_cache:
-				task_input_hash = task.input_hash()
-				logging.info(f'Checking task cache for {task} with input hash {task_input_hash}')
-				if task_input_hash in self._task_cache:
-					logging.info(f'Found an entry for {task} with input hash {task_input_hash}')
-					logging.info(f'Copying outputs cached for {task} to {working_directory}')
-					self._task_cache.copy_to(task_input_hash, working_directory)
+		if self._cancelled.is_set():
+			return CANCELLED
+		output = TaskOutput(task.label, self.output_mode)
+		if not use_cache or not task.use_cache:
+			return self._run_action(task, output)
+
+		if input_hash is not None:
+			task_input_hash = input_hash
+		else:
+			with trace.span('hash inputs', label=task.label):
+				task_input_hash = task.input_hash(self._digest_cache, self._listing_cache)
+		metrics.record_input_hash(task.label, task_input_hash)
+		with trace.span('check up to date', label=task.label):
+			up_to_date = self._build_state.is_up_to_date(task, task_input_hash)
+		if up_to_date:
+			logging.info(f'{task} is up to date with input hash {task_input_hash}')
+			return UP_TO_DATE
+
+		if self._task_cache is not None:
+			logging.info(f'Checking task cache for {task} with input hash {task_input_hash}')
+			with trace.span('cache lookup', label=task.label):
+				cached = task_input_hash in self._task_cache
+			if cached:
+				logging.info(f'Found an entry for {task} with input hash {task_input_hash}')
+				logging.info(f'Copying outputs cached for {task} to {working_directory}')
+				with trace.span('cache restore', label=task.label):
+					restored = self._task_cache.copy_to(task_input_hash, working_directory)
+				self._listing_cache.invalidate()
+				if restored:
+					metrics.count(metrics.CACHE_HITS)
 					logging.info(f'Successfully copied outputs cached for {task} to {working_directory}')
-				else:
-					logging.info(f'Could not find outputs in task cache for {task} with input hash {task_input_hash}')
-					task._execute(self._clone_for_task(task))
-					output_file_names = task.outputs()
-					logging.info(f'Caching the following output files under input hash {task_input_hash}:')
-					for output_file_name in output_file_names:
-						logging.info(f'\t- {output_file_name}')
-					self._task_cache.put(task_input_hash, [(file_name, Path(file_name).read_bytes()) for file_name in output_file_names])
-					logging.info('Caching successful')
-			else:
-				task._execute(self._clone_for_task(task))
-		
+					self._build_state.record(task, task_input_hash)
+					# What the action wrote when it produced these outputs (e.g. compiler warnings) is shown again.
+					log = self._task_cache.get_log(task_input_hash)
+					if log:
+						logging.info(f'Replaying the output of {task} from the task cache')
+						output.replay(log)
+						output.finish()
+					return RESTORED
+				# The entry was removed (e.g. evicted) between the lookup and the copy, so this is a miss after all.
+				logging.info(f'The entry for {task} with input hash {task_input_hash} is no longer in the task cache')
+			metrics.count(metrics.CACHE_MISSES)
+			if not cached:
+				logging.info(f'Could not find outputs in task cache for {task} with input hash {task_input_hash}')
+			status = self._run_action(task, output)
+			if status != EXECUTED:
+				# Whatever a failed action left behind is never cached.
+				self._build_state.forget(task)
+				return status
+			with trace.span('collect outputs', label=task.label):
+				output_file_paths = [Path(file_name) for file_name in task.outputs(self._listing_cache) if Path(file_name).is_file()]
+			logging.info(f'Caching the following output files under input hash {task_input_hash}:')
+			for output_file_path in output_file_paths:
+				logging.info(f'\t- {output_file_path}')
+			# Store outputs relative to the working directory so they can be restored into it later. The cache reads
+			# each file in chunks, so outputs are never held in memory as a whole.
+			with trace.span('cache put', label=task.label):
+				self._task_cache.put(task_input_hash, [(str(file_path.relative_to(task.working_directory_path)), file_path) for file_path in output_file_paths], compression=task._compression, log=output.log)
+			logging.info('Caching successful')
+		else:
+			status = self._run_action(task, output)
+
+		if status == EXECUTED:
+			self._build_state.record(task, task_input_hash)
+		else:
+			self._build_state.forget(task)
+		return status
+
+	def _run_action(self, task: Task, output: TaskOutput) -> str:
+		# Returns EXECUTED, FAILED, or CANCELLED if another task failed before the action could finish.
+		if task.thread_safe:
+			with task_directory(task.working_directory_path):
+				return self._run_action_in_directory(task, output)
+		with trace.span('wait for action lock', label=task.label):
+			_action_lock.acquire()
+		try:
+			with working_dir(str(task.working_directory_path)), task_directory(task.working_directory_path):
+				was_locked = getattr(_action_state, 'locked', False)
+				_action_state.locked = True
+				try:
+					return self._run_action_in_directory(task, output)
+				finally:
+					_action_state.locked = was_locked
+		finally:
+			_action_lock.release()
+
+	def _run_action_in_directory(self, task: Task, output: TaskOutput) -> str:
+		try:
+			with ExitStack() as job_slot:
+				with trace.span('wait for job slot', label=task.label):
+					job_slot.enter_context(jobserver.slot())
+				# Another task may have failed while this one waited for the action lock or a job.
+				if self._cancelled.is_set():
+					return CANCELLED
+				with trace.span('run action', label=task.label), cancellation(self._cancelled):
+					start = time.perf_counter()
+					succeeded = task._execute(self._clone_for_task(task), output)
+			if succeeded:
+				self._history.record(task, time.perf_counter() - start)
+				return EXECUTED
+			return CANCELLED if self._cancelled.is_set() else FAILED
+		finally:
+			self._listing_cache.invalidate()
+
 	def _clone_for_task(self, task: Task) -> 'Context':
-		return Context(task, self._task_graph, self._task_cache, self.properties)
\ No newline at end of file
+		return Context(task, self._task_graph, self._task_cache, self.properties, jobs=self.jobs, digest_cache=self._digest_cache, task_loader=self._task_loader, build_state=self._build_state, listing_cache=self._listing_cache, lazy=self.lazy, history=self._history, results=self._results, keep_going=self.keep_going, cancelled=self._cancelled, output_mode=self.output_mode)
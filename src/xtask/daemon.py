@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+import typing as t
+from pathlib import Path
+
+import xtask.constants as const
+from xtask.client import connect, daemon_socket_path, peer_uid, send_request
+from xtask.project import Project
+
+# The largest number of file descriptors a request may carry: the client's stdin, stdout and stderr.
+_MAX_FDS = 3
+# How often, in seconds, the daemon looks for finished invocations while no request arrives.
+_POLL_INTERVAL = 1.0
+
+
+class Daemon():
+	# Serves invocations of xtask for one project over a Unix socket (see xtask.client), keeping everything that is
+	# expensive to load in memory between them: imported task files, the task manifest, file digests and the build state.
+	#
+	# Each invocation executes in a process forked from the daemon, so it starts with all of that already loaded, and with
+	# the client's own stdin, stdout, stderr, working directory and environment. Forking also keeps invocations from
+	# changing the daemon's state: whatever they change is saved to disk, and read again by the daemon once they finish.
+	# When task files (or modules they import) change, the daemon executes itself again, since imported modules can't be
+	# reliably unloaded.
+
+	project: Project
+	socket_path: Path
+
+	_listener: socket.socket
+	_running: bool
+	_children: t.Set[int]
+	_stat_keys: t.Dict[Path, t.Optional[t.Tuple[int, int]]]
+
+	def __init__(self, project: Project, listener: socket.socket = None):
+		self.project = project
+		self.socket_path = Path(daemon_socket_path(str(project.root_path)))
+		if listener is None:
+			self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+			self.socket_path.unlink(missing_ok=True)
+			listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			# Only the current user may connect, whichever directory the socket is in.
+			previous_umask = os.umask(0o077)
+			try:
+				listener.bind(str(self.socket_path))
+			finally:
+				os.umask(previous_umask)
+			listener.listen()
+		self._listener = listener
+		self._running = False
+		self._children = set()
+		self._load()
+
+	def serve_forever(self) -> None:
+		logging.info(f'Serving "{self.project.root_path}" at "{self.socket_path}" with process {os.getpid()}')
+		self._running = True
+		signal.signal(signal.SIGTERM, lambda *_: setattr(self, '_running', False))
+		while self._running:
+			ready, _, _ = select.select([self._listener], [], [], _POLL_INTERVAL)
+			if self._reap_children():
+				self.project.reload_state()
+				self._preload_state()
+			if not ready:
+				continue
+			if self._is_stale():
+				# The pending connection stays queued on the socket, which the new daemon inherits.
+				self._restart()
+			connection, _ = self._listener.accept()
+			with connection:
+				uid = peer_uid(connection)
+				if uid is not None and uid != os.getuid():
+					logging.warning(f'Refused a connection from another user ({uid})')
+					continue
+				self._handle(connection)
+		self._listener.close()
+		self.socket_path.unlink(missing_ok=True)
+		logging.info('Stopped the daemon')
+
+	def _load(self) -> None:
+		# Every task file is loaded up front, so no invocation has to.
+		self.project.task_loader.discover()
+		self.project.task_loader.full_graph()
+		self._preload_state()
+		self._stat_keys = {path: _stat_key(path) for path in self._watched_paths()}
+
+	def _preload_state(self) -> None:
+		self.project.digest_cache.preload()
+		self.project.build_state.preload()
+		self.project.history.preload()
+
+	def _watched_paths(self) -> t.List[Path]:
+		# The task manifest is saved again whenever an invocation discovers task files, e.g. because one was added.
+		return [self.project.settings_file_path, self.project.state_directory_path / const.TASK_MANIFEST_FILE_NAME]
+
+	def _is_stale(self) -> bool:
+		if not self.project.task_loader.manifest.is_valid():
+			return True
+		return any(_stat_key(path) != stat_key for path, stat_key in self._stat_keys.items())
+
+	def _restart(self) -> None:
+		logging.info('Task files changed, restarting the daemon')
+		# The new daemon wouldn't know about the invocations still executing, which would be left as zombies once they finish.
+		self._reap_children()
+		if self._children:
+			logging.info(f'Waiting for {len(self._children)} invocations to finish before restarting')
+			for process_id in self._children:
+				os.waitpid(process_id, 0)
+			self._children.clear()
+		self._listener.set_inheritable(True)
+		os.execv(sys.executable, [sys.executable, '-m', 'xtask', 'daemon', 'run', '--listen-fd', str(self._listener.fileno())])
+
+	def _handle(self, connection: socket.socket) -> None:
+		message, fds, _, _ = socket.recv_fds(connection, 4, _MAX_FDS)
+		try:
+			if len(message) < 4:
+				return
+			length = struct.unpack('!I', message)[0]
+			body = b''
+			while len(body) < length:
+				chunk = connection.recv(length - len(body))
+				if not chunk:
+					return
+				body += chunk
+			request = json.loads(body)
+			if request.get('command') == 'status':
+				_reply(connection, {'pid': os.getpid(), 'root': str(self.project.root_path), 'running': len(self._children)})
+			elif request.get('command') == 'stop':
+				self._running = False
+				_reply(connection, {'pid': os.getpid()})
+			elif len(fds) == 3:
+				self._fork(connection, request, fds)
+		finally:
+			for fd in fds:
+				os.close(fd)
+
+	def _fork(self, connection: socket.socket, request: t.Dict[str, t.Any], fds: t.List[int]) -> None:
+		process_id = os.fork()
+		if process_id != 0:
+			self._children.add(process_id)
+			return
+		exit_code = 1
+		try:
+			self._listener.close()
+			# A process group of its own, so the client can interrupt it along with everything it starts.
+			os.setpgid(0, 0)
+			_reply(connection, {'pid': os.getpid()})
+			exit_code = self._execute(request, fds)
+		except KeyboardInterrupt:
+			traceback.print_exc()
+			exit_code = 130
+		except BaseException:
+			traceback.print_exc()
+		finally:
+			try:
+				sys.stdout.flush()
+				sys.stderr.flush()
+				_reply(connection, {'exit_code': exit_code})
+			finally:
+				os._exit(0)
+
+	def _execute(self, request: t.Dict[str, t.Any], fds: t.List[int]) -> int:
+		# Runs in the forked process, as if xtask had been invoked by the client.
+		from xtask.__main__ import main as xtask_main
+		for target_fd, fd in enumerate(fds):
+			os.dup2(fd, target_fd)
+		sys.stdin = open(0, 'r', closefd=False)
+		sys.stdout = open(1, 'w', buffering=1, closefd=False)
+		sys.stderr = open(2, 'w', buffering=1, closefd=False)
+		os.chdir(request['cwd'])
+		os.environ.clear()
+		os.environ.update(request['environment'])
+		signal.signal(signal.SIGTERM, signal.SIG_DFL)
+		sys.argv = ['xtask', *request['argv']]
+		# The daemon's own log handlers write to its log file.
+		logging.root.handlers.clear()
+		# Commands that aren't known make the invocation discover task files again, in case one was added. The daemon
+		# restarts once the invocation saves the task manifest it found.
+		self.project.task_loader.invalidate()
+		try:
+			xtask_main(request['argv'], project=self.project)
+		except SystemExit as e:
+			return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+		return 0
+
+	def _reap_children(self) -> bool:
+		reaped = False
+		for process_id in list(self._children):
+			if os.waitpid(process_id, os.WNOHANG)[0] != 0:
+				self._children.discard(process_id)
+				reaped = True
+		return reaped
+
+def request(root_path: Path, command: str) -> t.Optional[t.Dict[str, t.Any]]:
+	# Sends a command (status or stop) to the daemon serving the project, returning its reply, or None if there is no daemon.
+	connection = connect(str(root_path))
+	if connection is None:
+		return None
+	with connection:
+		send_request(connection, {'command': command})
+		line = connection.makefile('r').readline()
+	return json.loads(line) if line else None
+
+def _reply(connection: socket.socket, reply: t.Dict[str, t.Any]) -> None:
+	connection.sendall((json.dumps(reply) + '\n').encode())
+
+def _stat_key(path: Path) -> t.Optional[t.Tuple[int, int]]:
+	try:
+		stat_result = path.stat()
+	except FileNotFoundError:
+		return None
+	return (stat_result.st_size, stat_result.st_mtime_ns)
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+import xtask.metrics as metrics
+
+CHUNK_SIZE = 1024 * 1024
+
+# Filesystems only record modification times so precisely. A file modified within this many seconds of being hashed could
+# be modified again without its stat changing, so its digest is not remembered.
+_RACY_WINDOW_SECONDS = 2
+
+
+def file_digest(file_path: str | Path) -> bytes:
+	start = time.perf_counter()
+	digest = hashlib.md5()
+	size = 0
+	with open(file_path, 'rb') as file:
+		while chunk := file.read(CHUNK_SIZE):
+			digest.update(chunk)
+			size += len(chunk)
+	metrics.count(metrics.HASHED_FILES)
+	metrics.count(metrics.HASHED_BYTES, size)
+	metrics.count(metrics.HASHING_SECONDS, time.perf_counter() - start)
+	return digest.digest()
+
+class FileDigestCache():
+	# Remembers the digest of every file it hashes, keyed by the file's path and its size, modification time and inode. Files
+	# whose stat is unchanged since they were last hashed reuse the stored digest instead of being read again.
+
+	_file_path: t.Optional[Path]
+	_entries: t.Optional[t.Dict[str, t.List]]
+	_dirty: bool
+	_lock: threading.Lock
+
+	def __init__(self, file_path: str | Path = None):
+		self._file_path = Path(file_path) if file_path else None
+		self._entries = None
+		self._dirty = False
+		self._lock = threading.Lock()
+
+	def digest(self, file_path: str | Path) -> bytes:
+		key = str(file_path)
+		stat_result = os.stat(key)
+		stat_key = [stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino]
+		with self._lock:
+			entry = self._load().get(key)
+		if entry is not None and entry[:3] == stat_key:
+			metrics.count(metrics.DIGEST_CACHE_HITS)
+			return bytes.fromhex(entry[3])
+
+		digest = file_digest(key)
+		if time.time_ns() - stat_result.st_mtime_ns > _RACY_WINDOW_SECONDS * 1_000_000_000:
+			with self._lock:
+				self._entries[key] = stat_key + [digest.hex()]
+				self._dirty = True
+		return digest
+
+	def preload(self) -> None:
+		# Reads the stored digests now, rather than when the first file is hashed.
+		with self._lock:
+			self._load()
+
+	def save(self) -> None:
+		with self._lock:
+			if not self._dirty or self._file_path is None:
+				return
+			self._file_path.parent.mkdir(parents=True, exist_ok=True)
+			file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(self._file_path.parent), prefix='.tmp-')
+			with os.fdopen(file_descriptor, 'w') as temp_file:
+				json.dump(self._entries, temp_file)
+			os.replace(temp_file_name, str(self._file_path))
+			self._dirty = False
+
+	def _load(self) -> t.Dict[str, t.List]:
+		if self._entries is None:
+			self._entries = dict()
+			if self._file_path is not None:
+				try:
+					self._entries = json.loads(self._file_path.read_text())
+				except FileNotFoundError:
+					pass
+				except ValueError:
+					logging.warning(f'Ignoring the corrupt file digest cache "{self._file_path}"')
+		return self._entries
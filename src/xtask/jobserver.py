@@ -0,0 +1,115 @@
+import os
+import select
+import threading
+import typing as t
+from contextlib import contextmanager
+
+
+class Jobserver():
+	# A pool of job tokens shared with child processes through the GNU make jobserver protocol: a pipe holding one byte per
+	# token, whose file descriptors are named in MAKEFLAGS. make, ninja (in pipe mode) and cargo read a token from the pipe
+	# before starting each job beyond their first, and write it back when the job is done, so nested builds share xtask's
+	# jobs instead of each sizing their parallelism to every CPU.
+	#
+	# Like make, xtask holds one implicit token of its own, so the pipe only holds jobs - 1 tokens. Every action executes
+	# with a token, which the processes it starts inherit as their own implicit token.
+
+	jobs: int
+
+	_read_fd: int
+	_write_fd: int
+	_implicit_lock: threading.Lock
+	_holding: threading.local
+
+	def __init__(self, jobs: int):
+		if jobs < 1:
+			raise RuntimeError(f'Cannot create a jobserver with {jobs} jobs. At least one job is required.')
+		self.jobs = jobs
+		self._read_fd, self._write_fd = os.pipe()
+		os.write(self._write_fd, b'+' * (jobs - 1))
+		self._implicit_lock = threading.Lock()
+		self._holding = threading.local()
+
+	@property
+	def pass_fds(self) -> t.Tuple[int, int]:
+		return (self._read_fd, self._write_fd)
+
+	def environment(self, environment: t.Dict[str, str] = None) -> t.Dict[str, str]:
+		# Returns the environment with MAKEFLAGS pointing at this jobserver. Any -j or jobserver flags already in MAKEFLAGS
+		# (e.g. when xtask itself runs under make) are replaced, but other flags are kept. Both the old and the new spelling of
+		# the jobserver flag are given, so any version of make understands it.
+		environment = dict(os.environ if environment is None else environment)
+		flags = [flag for flag in environment.get('MAKEFLAGS', '').split() if not flag.startswith(('-j', '--jobserver'))]
+		flags += [f'-j{self.jobs}', f'--jobserver-fds={self._read_fd},{self._write_fd}', f'--jobserver-auth={self._read_fd},{self._write_fd}']
+		environment['MAKEFLAGS'] = ' ' + ' '.join(flags)
+		return environment
+
+	@contextmanager
+	def slot(self) -> t.Iterator[None]:
+		# Holds a token while the body runs. A thread that already holds one (an action executing other tasks) keeps using
+		# it, since waiting for a second token with only one job would never end.
+		depth = getattr(self._holding, 'depth', 0)
+		if depth:
+			self._holding.depth = depth + 1
+			try:
+				yield
+			finally:
+				self._holding.depth = depth
+			return
+
+		token = None if self._implicit_lock.acquire(blocking=False) else self._read_token()
+		self._holding.depth = 1
+		try:
+			yield
+		finally:
+			self._holding.depth = 0
+			if token is None:
+				self._implicit_lock.release()
+			else:
+				# Tokens must be returned as they were read, since some clients give meaning to their value.
+				os.write(self._write_fd, token)
+
+	def close(self) -> None:
+		os.close(self._read_fd)
+		os.close(self._write_fd)
+
+	def _read_token(self) -> bytes:
+		# make may switch the pipe (which it shares with xtask) to non-blocking, so wait until a token can be read.
+		while True:
+			select.select([self._read_fd], [], [])
+			try:
+				token = os.read(self._read_fd, 1)
+			except BlockingIOError:
+				continue
+			if token:
+				return token
+
+# The jobserver of the current invocation, if any. run() is called from within actions, which know nothing about the
+# invocation, so the jobserver is process-wide rather than passed around.
+_jobserver: t.Optional[Jobserver] = None
+
+def current() -> t.Optional[Jobserver]:
+	return _jobserver
+
+@contextmanager
+def serve(jobs: int) -> t.Iterator[t.Optional[Jobserver]]:
+	# Creates the jobserver for the duration of the body, unless one already exists. There is no jobserver on Windows, where
+	# make uses a named semaphore instead of a pipe.
+	global _jobserver
+	if _jobserver is not None or os.name == 'nt':
+		yield _jobserver
+		return
+	_jobserver = Jobserver(jobs)
+	try:
+		yield _jobserver
+	finally:
+		_jobserver.close()
+		_jobserver = None
+
+@contextmanager
+def slot() -> t.Iterator[None]:
+	if _jobserver is None:
+		yield
+		return
+	with _jobserver.slot():
+		yield
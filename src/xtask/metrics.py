@@ -0,0 +1,254 @@
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+import typing as t
+from pathlib import Path
+
+# Counters kept for each run, in the order they are reported.
+CACHE_HITS = 'cache_hits'
+CACHE_MISSES = 'cache_misses'
+CACHE_BYTES_READ = 'cache_bytes_read'
+CACHE_BYTES_WRITTEN = 'cache_bytes_written'
+INPUT_FILES = 'input_files'
+INPUT_HASH_SECONDS = 'input_hash_seconds'
+HASHED_FILES = 'hashed_files'
+HASHED_BYTES = 'hashed_bytes'
+HASHING_SECONDS = 'hashing_seconds'
+DIGEST_CACHE_HITS = 'digest_cache_hits'
+COUNTERS = [CACHE_HITS, CACHE_MISSES, CACHE_BYTES_READ, CACHE_BYTES_WRITTEN, INPUT_FILES, INPUT_HASH_SECONDS, HASHED_FILES, HASHED_BYTES, HASHING_SECONDS, DIGEST_CACHE_HITS]
+
+# A project's metrics history is trimmed once it grows past MAX_HISTORY_SIZE bytes, keeping the newest runs: at most
+# MAX_RUNS of them, in at most half of MAX_HISTORY_SIZE, so that it only needs trimming again after many more runs.
+MAX_RUNS = 1000
+MAX_HISTORY_SIZE = 16 * 1024 * 1024
+
+
+class RunMetrics():
+	# Counters, time per phase and the input hash of every task for one run of xtask. Recorded from wherever the work happens
+	# (hashing, the task cache, the context), so they are process-wide like the tracer, and kept even when not tracing.
+
+	_start: float
+	_start_perf: float
+	_counters: t.Dict[str, float]
+	_phases: t.Dict[str, float]
+	_input_hashes: t.Dict[str, str]
+	# Per compression method of cache archives: [files, original bytes, compressed bytes, seconds].
+	_compression: t.Dict[str, t.List[float]]
+	_lock: threading.Lock
+
+	def __init__(self):
+		self._start = time.time()
+		self._start_perf = time.perf_counter()
+		self._counters = {name: 0 for name in COUNTERS}
+		self._phases = dict()
+		self._input_hashes = dict()
+		self._compression = dict()
+		self._lock = threading.Lock()
+
+	def count(self, name: str, amount: float = 1) -> None:
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + amount
+
+	def record_phase(self, name: str, seconds: float) -> None:
+		# Phases of tasks executing concurrently overlap, so their times add up to more than the duration of the run.
+		with self._lock:
+			self._phases[name] = self._phases.get(name, 0.0) + seconds
+
+	def record_input_hash(self, label: str, input_hash: int) -> None:
+		with self._lock:
+			self._input_hashes[label] = str(input_hash)
+
+	def record_compression(self, method: str, original_size: int, compressed_size: int, seconds: float) -> None:
+		with self._lock:
+			totals = self._compression.setdefault(method, [0, 0, 0, 0.0])
+			totals[0] += 1
+			totals[1] += original_size
+			totals[2] += compressed_size
+			totals[3] += seconds
+
+	def as_dict(self, targets: t.List[str], succeeded: bool, tasks: t.Dict[str, t.Tuple[str, float]]) -> t.Dict[str, t.Any]:
+		# The run as stored in the metrics history, given how each task ended (its status and duration).
+		with self._lock:
+			counters = dict(self._counters)
+			phases = dict(self._phases)
+			input_hashes = dict(self._input_hashes)
+			compression = {method: {'files': totals[0], 'original_bytes': totals[1], 'compressed_bytes': totals[2], 'seconds': totals[3]} for method, totals in self._compression.items()}
+		statuses: t.Dict[str, int] = dict()
+		for status, _ in tasks.values():
+			statuses[status] = statuses.get(status, 0) + 1
+		return {
+			'timestamp': self._start,
+			'duration': time.perf_counter() - self._start_perf,
+			'targets': targets,
+			'succeeded': succeeded,
+			'statuses': statuses,
+			'counters': counters,
+			'phases': phases,
+			'compression': compression,
+			'tasks': {label: {'status': status, 'duration': duration, 'input_hash': input_hashes.get(label)} for label, (status, duration) in tasks.items()},
+		}
+
+# The metrics of the current run, if one was started.
+_metrics: t.Optional[RunMetrics] = None
+
+def start() -> RunMetrics:
+	global _metrics
+	_metrics = RunMetrics()
+	return _metrics
+
+def current() -> t.Optional[RunMetrics]:
+	return _metrics
+
+def count(name: str, amount: float = 1) -> None:
+	if _metrics is not None:
+		_metrics.count(name, amount)
+
+def record_input_hash(label: str, input_hash: int) -> None:
+	if _metrics is not None:
+		_metrics.record_input_hash(label, input_hash)
+
+def record_compression(method: str, original_size: int, compressed_size: int, seconds: float) -> None:
+	if _metrics is not None:
+		_metrics.record_compression(method, original_size, compressed_size, seconds)
+
+def save_run(run: t.Dict[str, t.Any], history_path: Path) -> None:
+	# Appends the run to the history, one run per line. The line is written at once to the file opened for appending, so
+	# concurrent invocations don't lose each other's runs.
+	history_path.parent.mkdir(parents=True, exist_ok=True)
+	with open(history_path, 'ab') as history_file:
+		history_file.write((json.dumps(run) + '\n').encode())
+		history_size = history_file.tell()
+	if history_size > MAX_HISTORY_SIZE:
+		_trim_history(history_path)
+
+def _trim_history(history_path: Path) -> None:
+	# Lines are kept as they are, without parsing them. A run appended by another invocation while trimming may be lost.
+	lines = history_path.read_bytes().splitlines(keepends=True)[-MAX_RUNS:]
+	kept_lines = list()
+	kept_size = 0
+	for line in reversed(lines):
+		kept_size += len(line)
+		if kept_size > MAX_HISTORY_SIZE // 2 and kept_lines:
+			break
+		kept_lines.append(line)
+	_write_atomic(history_path, b''.join(reversed(kept_lines)).decode('utf-8', errors='replace'))
+
+def load_runs(file_paths: t.Iterable[Path]) -> t.List[t.Dict[str, t.Any]]:
+	# Reads runs from metrics histories or from files written with --metrics, ordered by when they started. Unreadable
+	# lines are skipped, e.g. a run interrupted while being written by an older version.
+	runs = list()
+	for file_path in file_paths:
+		try:
+			text = Path(file_path).read_text()
+		except FileNotFoundError:
+			continue
+		try:
+			# A single run, as written with --metrics.
+			file_runs = [json.loads(text)]
+		except ValueError:
+			file_runs = list()
+			for line in text.splitlines():
+				try:
+					file_runs.append(json.loads(line))
+				except ValueError:
+					continue
+		runs.extend(run for run in file_runs if isinstance(run, dict) and 'timestamp' in run)
+	return sorted(runs, key=lambda run: run['timestamp'])
+
+def save_json(run: t.Dict[str, t.Any], file_path: Path) -> None:
+	_write_atomic(file_path, json.dumps(run, indent='\t'))
+
+def save_prometheus(run: t.Dict[str, t.Any], file_path: Path) -> None:
+	# Writes the run in the Prometheus text format, e.g. for the textfile collector of node_exporter, which requires the file
+	# to be replaced atomically.
+	lines = list()
+	def metric(name: str, description: str, samples: t.List[t.Tuple[str, float]]) -> None:
+		lines.append(f'# HELP xtask_{name} {description}')
+		lines.append(f'# TYPE xtask_{name} gauge')
+		lines.extend(f'xtask_{name}{labels} {value}' for labels, value in samples)
+	counters = run['counters']
+	metric('run_timestamp_seconds', 'When the last run started.', [('', run['timestamp'])])
+	metric('run_duration_seconds', 'How long the last run took.', [('', run['duration'])])
+	metric('run_succeeded', 'Whether every task of the last run succeeded.', [('', int(run['succeeded']))])
+	metric('tasks', 'Tasks of the last run, by how they ended.', [(f'{{status="{status}"}}', amount) for status, amount in sorted(run['statuses'].items())])
+	metric('cache_hits', 'Tasks restored from the task cache.', [('', counters.get(CACHE_HITS, 0))])
+	metric('cache_misses', 'Tasks not found in the task cache, which executed.', [('', counters.get(CACHE_MISSES, 0))])
+	metric('cache_read_bytes', 'Bytes read from the task cache.', [('', counters.get(CACHE_BYTES_READ, 0))])
+	metric('cache_written_bytes', 'Bytes written to the task cache.', [('', counters.get(CACHE_BYTES_WRITTEN, 0))])
+	metric('hashed_bytes', 'Bytes of input files read to hash them.', [('', counters.get(HASHED_BYTES, 0))])
+	metric('hashing_seconds', 'Time spent reading and hashing input files.', [('', counters.get(HASHING_SECONDS, 0))])
+	metric('phase_seconds', 'Time spent in each phase, added up across tasks.', [(f'{{phase="{phase}"}}', seconds) for phase, seconds in sorted(run['phases'].items())])
+	compression = sorted(run.get('compression', {}).items())
+	metric('cache_compressed_files', 'Files written to task cache archives, by compression method.', [(f'{{method="{method}"}}', totals['files']) for method, totals in compression])
+	metric('cache_uncompressed_bytes', 'Size of the files written to task cache archives before compression, by method.', [(f'{{method="{method}"}}', totals['original_bytes']) for method, totals in compression])
+	metric('cache_compressed_bytes', 'Size of the files written to task cache archives after compression, by method.', [(f'{{method="{method}"}}', totals['compressed_bytes']) for method, totals in compression])
+	metric('cache_compression_seconds', 'Time spent writing files to task cache archives, by compression method.', [(f'{{method="{method}"}}', totals['seconds']) for method, totals in compression])
+	_write_atomic(file_path, '\n'.join(lines) + '\n')
+
+def summary(runs: t.List[t.Dict[str, t.Any]], limit: int = 10) -> str:
+	# Aggregates runs to show whether the task cache pays for itself, how durations evolve, and which tasks keep getting
+	# a new input hash (e.g. because an input changes on every run).
+	if not runs:
+		return 'No runs were recorded yet.'
+	durations = [run['duration'] for run in runs]
+	totals = {name: sum(run['counters'].get(name, 0) for run in runs) for name in COUNTERS}
+	statuses: t.Dict[str, int] = dict()
+	phases: t.Dict[str, float] = dict()
+	task_durations: t.Dict[str, t.List[float]] = dict()
+	task_input_hashes: t.Dict[str, t.List[str]] = dict()
+	compression: t.Dict[str, t.Dict[str, float]] = dict()
+	for run in runs:
+		for status, amount in run['statuses'].items():
+			statuses[status] = statuses.get(status, 0) + amount
+		# Runs recorded by older versions have no compression results.
+		for method, method_totals in run.get('compression', {}).items():
+			totals_of_method = compression.setdefault(method, {'files': 0, 'original_bytes': 0, 'compressed_bytes': 0, 'seconds': 0.0})
+			for name, value in method_totals.items():
+				totals_of_method[name] = totals_of_method.get(name, 0) + value
+		for phase, seconds in run['phases'].items():
+			phases[phase] = phases.get(phase, 0.0) + seconds
+		for label, task in run['tasks'].items():
+			task_durations.setdefault(label, list()).append(task['duration'])
+			if task['input_hash'] is not None:
+				task_input_hashes.setdefault(label, list()).append(task['input_hash'])
+	lookups = totals[CACHE_HITS] + totals[CACHE_MISSES]
+	first, last = time.strftime('%Y-%m-%d %H:%M', time.localtime(runs[0]['timestamp'])), time.strftime('%Y-%m-%d %H:%M', time.localtime(runs[-1]['timestamp']))
+	lines = [f'{len(runs)} runs from {first} to {last}, {sum(run["succeeded"] for run in runs)} succeeded']
+	lines.append(f'\tDuration: median {statistics.median(durations):.2f} s, min {min(durations):.2f} s, max {max(durations):.2f} s, last {durations[-1]:.2f} s')
+	lines.append('\tTasks: ' + ', '.join(f'{amount} {status}' for status, amount in sorted(statuses.items(), key=lambda item: item[1], reverse=True)))
+	lines.append(f'\tTask cache: {totals[CACHE_HITS] / lookups if lookups else 0:.0%} hit rate ({int(totals[CACHE_HITS])} hits, {int(totals[CACHE_MISSES])} misses), {_megabytes(totals[CACHE_BYTES_READ])} read, {_megabytes(totals[CACHE_BYTES_WRITTEN])} written')
+	if compression:
+		lines.append('\tCompression: ' + ', '.join(f'{method} {int(method_totals["files"])} files, {_megabytes(method_totals["original_bytes"])} -> {_megabytes(method_totals["compressed_bytes"])} ({method_totals["compressed_bytes"] / method_totals["original_bytes"] if method_totals["original_bytes"] else 1.0:.0%}) in {method_totals["seconds"]:.2f} s' for method, method_totals in sorted(compression.items())))
+	throughput = totals[HASHED_BYTES] / totals[HASHING_SECONDS] if totals[HASHING_SECONDS] else 0
+	lines.append(f'\tHashing: {int(totals[INPUT_FILES])} input files in {totals[INPUT_HASH_SECONDS]:.2f} s, {int(totals[HASHED_FILES])} read ({_megabytes(totals[HASHED_BYTES])} at {_megabytes(throughput)}/s), {int(totals[DIGEST_CACHE_HITS])} from the digest cache')
+	lines.append('Time by phase:')
+	lines.extend(f'\t{seconds:10.2f} s  {phase}' for phase, seconds in sorted(phases.items(), key=lambda item: item[1], reverse=True)[:limit])
+	lines.append('Slowest tasks (median, last):')
+	slowest = sorted(task_durations.items(), key=lambda item: statistics.median(item[1]), reverse=True)[:limit]
+	lines.extend(f'\t{statistics.median(label_durations):10.2f} s  {label_durations[-1]:8.2f} s  {label}' for label, label_durations in slowest)
+	# Input hashes that differ from the previous run's. A task that is never up to date nor restored changes its input hash
+	# on (almost) every run.
+	changes = {label: sum(1 for previous, current in zip(hashes, hashes[1:]) if previous != current) for label, hashes in task_input_hashes.items() if len(hashes) > 1}
+	unstable = sorted(((label, changed) for label, changed in changes.items() if changed), key=lambda item: item[1], reverse=True)[:limit]
+	if unstable:
+		lines.append('Most changed input hashes:')
+		lines.extend(f'\t{changed:4} of {len(task_input_hashes[label]) - 1} runs  {label}' for label, changed in unstable)
+	return '\n'.join(lines)
+
+def _megabytes(size: float) -> str:
+	return f'{size / (1024 * 1024):.1f} MB'
+
+def _write_atomic(file_path: Path, content: str) -> None:
+	file_path.parent.mkdir(parents=True, exist_ok=True)
+	file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(file_path.parent), prefix='.tmp-')
+	try:
+		with os.fdopen(file_descriptor, 'w') as temp_file:
+			temp_file.write(content)
+		os.chmod(temp_file_name, 0o644)
+		os.replace(temp_file_name, str(file_path))
+	except BaseException:
+		Path(temp_file_name).unlink(missing_ok=True)
+		raise
@@ -0,0 +1,254 @@
+import fnmatch
+import functools
+import os
+import re
+import threading
+import typing as t
+from pathlib import Path
+
+# Each state is the position of the next segment to match in one of the patterns: (pattern index, segment index).
+_State = t.Tuple[int, int]
+_Entry = t.Tuple[str, bool, bool]
+
+_RECURSIVE = '**'
+_MAGIC_CHARACTERS = re.compile(r'[*?[]')
+_FLAGS = re.IGNORECASE if os.name == 'nt' else 0
+_SEPARATORS = re.compile(r'[\\/]' if os.name == 'nt' else '/')
+
+
+class _Pattern(list):
+	# The segments of a compiled pattern, either literal names, "**" or regular expressions. Like with Path.glob, a pattern
+	# ending with a separator (e.g. "src/*/") only matches directories.
+
+	directory_only: bool
+
+	def __init__(self, segments: t.Iterable[str | re.Pattern], directory_only: bool):
+		super().__init__(segments)
+		self.directory_only = directory_only
+
+class DirectoryListingCache():
+	# Remembers the entries of every directory listed while matching, so tasks sharing a working directory don't list the
+	# same directories again. Anything that changes the filesystem must invalidate the cache. Listings that were started
+	# before an invalidation are never returned after it, even if they finish later.
+
+	_listings: t.Dict[str, t.Tuple[int, t.List[_Entry]]]
+	_generation: int
+	_lock: threading.Lock
+
+	def __init__(self):
+		self._listings = dict()
+		self._generation = 0
+		self._lock = threading.Lock()
+
+	def list(self, directory: str) -> t.List[_Entry]:
+		generation = self._generation
+		listing = self._listings.get(directory)
+		if listing is not None and listing[0] == generation:
+			return listing[1]
+		entries = _list_directory(directory)
+		with self._lock:
+			if generation == self._generation:
+				self._listings[directory] = (generation, entries)
+		return entries
+
+	def invalidate(self) -> None:
+		with self._lock:
+			self._generation += 1
+			self._listings.clear()
+
+class PathMatcher():
+	# Matches include and exclude glob patterns (with the same semantics as Path.glob) in a single walk of a directory tree.
+	# Only directories that some include pattern can still match beneath are entered, and directories matching an exclude
+	# pattern that ends with "**" are pruned along with everything inside of them.
+
+	_include: t.List[_Pattern]
+	_exclude: t.List[_Pattern]
+	_fallback_include: t.List[str]
+	_fallback_exclude: t.List[str]
+
+	def __init__(self, include: t.Iterable[str], exclude: t.Iterable[str] = ()):
+		self._include, self._fallback_include = _compile_patterns(include)
+		self._exclude, self._fallback_exclude = _compile_patterns(exclude)
+
+	def glob(self, root_path: Path, listing_cache: DirectoryListingCache = None) -> t.List[str]:
+		list_directory = listing_cache.list if listing_cache is not None else _list_directory
+		root = str(root_path)
+		matches = set()
+		include_states = self._closure(self._include, {(index, 0) for index in range(len(self._include))})
+		exclude_states = self._closure(self._exclude, {(index, 0) for index in range(len(self._exclude))})
+		# A pattern like "**" matches the root directory itself.
+		if self._accepts(self._include, include_states) and not self._accepts(self._exclude, exclude_states):
+			matches.add(root)
+		pending = [(root, include_states, exclude_states, False)]
+		while pending:
+			directory, include_states, exclude_states, via_symlink = pending.pop()
+			for name, is_dir, is_symlink in self._entries(directory, include_states, list_directory):
+				next_exclude_states, excluded, pruned = self._advance(self._exclude, exclude_states, name, is_dir, is_symlink)
+				if pruned:
+					continue
+				next_include_states, included, _ = self._advance(self._include, include_states, name, is_dir, is_symlink)
+				path = os.path.join(directory, name)
+				if included and not excluded:
+					# Matches are resolved like Path.resolve() would, which only changes paths that go through a symlink. The
+					# resolved path must not be excluded either.
+					match = os.path.realpath(path) if via_symlink or is_symlink else path
+					if match is path or not self._excludes_real_path(root, match):
+						matches.add(match)
+				if is_dir and next_include_states:
+					pending.append((path, next_include_states, next_exclude_states, via_symlink or is_symlink))
+
+		for pattern in self._fallback_include:
+			matches.update(str(path.resolve()) for path in root_path.glob(pattern))
+		for pattern in self._fallback_exclude:
+			matches.difference_update(str(path.resolve()) for path in root_path.glob(pattern))
+		return list(matches)
+
+	def matches(self, root_path: Path, path: Path) -> bool:
+		# Whether a path (which need not exist, e.g. a deleted file) would be matched by glob(root_path), judging by its name
+		# alone. Every component but the last is taken to be a directory, and the last to be a file.
+		root = str(root_path)
+		relative_path = os.path.relpath(str(path), root)
+		if relative_path.startswith(os.pardir) or relative_path == os.curdir:
+			included = excluded = False
+		else:
+			names = relative_path.split(os.sep)
+			include_states = self._closure(self._include, {(index, 0) for index in range(len(self._include))})
+			exclude_states = self._closure(self._exclude, {(index, 0) for index in range(len(self._exclude))})
+			excluded = False
+			for depth, name in enumerate(names):
+				is_dir = depth < len(names) - 1
+				exclude_states, excluded, pruned = self._advance(self._exclude, exclude_states, name, is_dir, False)
+				if pruned:
+					return False
+				include_states, included, _ = self._advance(self._include, include_states, name, is_dir, False)
+				if not include_states:
+					break
+		if self._fallback_include or self._fallback_exclude:
+			# Patterns left to Path.glob can only be matched against what is on disk.
+			path = str(Path(path).resolve())
+			included = included or any(str(match.resolve()) == path for pattern in self._fallback_include for match in root_path.glob(pattern))
+			excluded = excluded or any(str(match.resolve()) == path for pattern in self._fallback_exclude for match in root_path.glob(pattern))
+		return included and not excluded
+
+	def literal_prefixes(self) -> t.Optional[t.List[t.Tuple[str, ...]]]:
+		# The leading directory names of each include pattern, before any wildcard. Every path the patterns match lies in one
+		# of these directories, relative to the root. Returns None if some pattern is left to Path.glob, since it may match
+		# anywhere.
+		if self._fallback_include:
+			return None
+		prefixes = list()
+		for segments in self._include:
+			prefix = list()
+			for segment in segments[:-1]:
+				if not isinstance(segment, str) or segment == _RECURSIVE:
+					break
+				prefix.append(segment)
+			prefixes.append(tuple(prefix))
+		return prefixes
+
+	def _entries(self, directory: str, include_states: t.Set[_State], list_directory: t.Callable[[str], t.List[_Entry]]) -> t.Iterable[_Entry]:
+		# When every pattern continues with a literal name, there is no need to list the directory: just look the names up.
+		names = set()
+		for pattern_index, segment_index in include_states:
+			segments = self._include[pattern_index]
+			if segment_index == len(segments):
+				continue
+			if not isinstance(segments[segment_index], str) or segments[segment_index] == _RECURSIVE:
+				return list_directory(directory)
+			names.add(segments[segment_index])
+		entries = list()
+		for name in names:
+			path = os.path.join(directory, name)
+			if os.path.lexists(path):
+				entries.append((name, os.path.isdir(path), os.path.islink(path)))
+		return entries
+
+	def _advance(self, patterns: t.List[_Pattern], states: t.Set[_State], name: str, is_dir: bool, is_symlink: bool) -> t.Tuple[t.Set[_State], bool, bool]:
+		# Returns the states after matching an entry, whether the entry matches a pattern, and whether everything beneath the
+		# entry matches a pattern too (because it matched one ending with "**").
+		next_states = set()
+		for pattern_index, segment_index in states:
+			segments = patterns[pattern_index]
+			if segment_index == len(segments):
+				continue
+			segment = segments[segment_index]
+			if segment == _RECURSIVE:
+				# Like Path.glob, "**" only matches directories and does not follow symlinks.
+				if is_dir and not is_symlink:
+					next_states.add((pattern_index, segment_index))
+			# Every segment but the last can only match directories.
+			elif (is_dir or segment_index == len(segments) - 1) and _match_segment(segment, name):
+				next_states.add((pattern_index, segment_index + 1))
+		next_states = self._closure(patterns, next_states)
+		matched = False
+		recursive = False
+		for pattern_index, segment_index in next_states:
+			segments = patterns[pattern_index]
+			if segment_index == len(segments) and (is_dir or not segments.directory_only):
+				matched = True
+				recursive = recursive or (is_dir and segments[-1] == _RECURSIVE)
+		return next_states, matched, recursive
+
+	def _excludes_real_path(self, root: str, real_path: str) -> bool:
+		relative_path = os.path.relpath(real_path, root)
+		if not self._exclude or relative_path.startswith(os.pardir):
+			return False
+		states = self._closure(self._exclude, {(index, 0) for index in range(len(self._exclude))})
+		if relative_path == os.curdir:
+			return self._accepts(self._exclude, states)
+		names = relative_path.split(os.sep)
+		for depth, name in enumerate(names):
+			# A resolved path has no symlinks in it, and all but its last component are directories.
+			states, excluded, pruned = self._advance(self._exclude, states, name, depth < len(names) - 1 or os.path.isdir(real_path), False)
+			if pruned:
+				return True
+		return excluded
+
+	def _accepts(self, patterns: t.List[_Pattern], states: t.Set[_State]) -> bool:
+		return any(segment_index == len(patterns[pattern_index]) for pattern_index, segment_index in states)
+
+	def _closure(self, patterns: t.List[_Pattern], states: t.Set[_State]) -> t.Set[_State]:
+		# "**" also matches zero directories, so a state before it is also a state after it.
+		closure = set(states)
+		pending = list(states)
+		while pending:
+			pattern_index, segment_index = pending.pop()
+			segments = patterns[pattern_index]
+			if segment_index < len(segments) and segments[segment_index] == _RECURSIVE and (pattern_index, segment_index + 1) not in closure:
+				closure.add((pattern_index, segment_index + 1))
+				pending.append((pattern_index, segment_index + 1))
+		return closure
+
+@functools.lru_cache(maxsize=1024)
+def path_matcher(include: t.Tuple[str, ...], exclude: t.Tuple[str, ...] = ()) -> PathMatcher:
+	return PathMatcher(include, exclude)
+
+def _compile_patterns(patterns: t.Iterable[str]) -> t.Tuple[t.List[_Pattern], t.List[str]]:
+	compiled = list()
+	fallback = list()
+	for pattern in patterns:
+		segments = [segment for segment in _SEPARATORS.split(pattern) if segment and segment != '.']
+		# Patterns leaving the root directory or anchored elsewhere are rare enough to leave to Path.glob.
+		if not segments or '..' in segments or Path(pattern).is_absolute() or Path(pattern).drive:
+			fallback.append(pattern)
+			continue
+		compiled.append(_Pattern((segment if segment == _RECURSIVE or not _MAGIC_CHARACTERS.search(segment) else re.compile(fnmatch.translate(segment), _FLAGS) for segment in segments), directory_only=_SEPARATORS.match(pattern[-1]) is not None))
+	return compiled, fallback
+
+def _match_segment(segment: str | re.Pattern, name: str) -> bool:
+	if isinstance(segment, str):
+		return segment == name or (_FLAGS != 0 and segment.lower() == name.lower())
+	return segment.match(name) is not None
+
+def _list_directory(directory: str) -> t.List[_Entry]:
+	entries = list()
+	try:
+		with os.scandir(directory) as iterator:
+			for entry in iterator:
+				try:
+					entries.append((entry.name, entry.is_dir(), entry.is_symlink()))
+				except OSError:
+					continue
+	except (FileNotFoundError, NotADirectoryError, PermissionError):
+		pass
+	return entries
@@ -0,0 +1,123 @@
+import sys
+import typing as t
+from pathlib import Path
+
+import xtask.constants as const
+from xtask.build_state import BuildState
+from xtask.compression import CompressionPolicy
+from xtask.context import Context
+from xtask.file_digest import FileDigestCache
+from xtask.http_cache import HttpTaskCache
+from xtask.settings import Settings
+from xtask.task_history import TaskHistory
+from xtask.task_cache import BackgroundTaskCache, ContentAddressedTaskCache, DirectoryTaskCache, TaskCache
+from xtask.task import Task
+from xtask.task_graph import TaskGraph
+from xtask.task_manifest import TaskLoader
+
+
+class Project():
+
+	root_path: Path
+	settings_file_path: Path
+	settings: Settings
+	state_directory_path: Path
+	task_cache: t.Optional[TaskCache]
+	digest_cache: FileDigestCache
+	build_state: BuildState
+	history: TaskHistory
+
+	_task_loader: t.Optional[TaskLoader]
+
+	def __init__(self, root_path: Path):
+		self.root_path = root_path
+		self.settings_file_path = root_path / const.ROOT_SETTINGS_FILE_NAME
+		if self.settings_file_path.exists():
+			self.settings = Settings.load(self.settings_file_path)
+		else:
+			self.settings = Settings()
+		self.state_directory_path = root_path / const.STATE_DIRECTORY_NAME
+		self.reload_state()
+		self._task_loader = None
+
+		extension_path = self.extension_path
+		if extension_path is not None and str(extension_path) not in sys.path:
+			sys.path.insert(0, str(extension_path))
+
+	@classmethod
+	def find(cls, start_path: Path) -> 'Project':
+		# Search upwards in directories for a root settings file. If one is not found, then just use the starting directory as the root.
+		current_path = start_path
+		while not (current_path / const.ROOT_SETTINGS_FILE_NAME).exists():
+			if current_path == current_path.parent:
+				return Project(start_path)
+			current_path = current_path.parent
+		return Project(current_path)
+
+	@property
+	def cache_path(self) -> t.Optional[Path]:
+		# Relative locations in the settings file are relative to the project root, not to wherever xtask was invoked from.
+		if not self.settings.cache_location:
+			return None
+		return (self.root_path / self.settings.cache_location).resolve()
+
+	@property
+	def extension_path(self) -> t.Optional[Path]:
+		if not self.settings.extension_location or not (self.root_path / self.settings.extension_location).is_dir():
+			return None
+		return (self.root_path / self.settings.extension_location).resolve()
+
+	@property
+	def task_loader(self) -> TaskLoader:
+		# Created on first use, since commands that don't deal with tasks shouldn't pay for discovering them.
+		if self._task_loader is None:
+			excluded_directories = [self.state_directory_path] + ([self.cache_path] if self.cache_path else [])
+			manifest_path = self.state_directory_path / const.TASK_MANIFEST_FILE_NAME if self.settings.cache_task_discovery else None
+			self._task_loader = TaskLoader(self.root_path, manifest_path=manifest_path, excluded_directories=excluded_directories, source_roots=[self.extension_path] if self.extension_path else [])
+		return self._task_loader
+
+	def reload_state(self) -> None:
+		# Reads the local state and the task cache again, e.g. after another process changed them. Loaded tasks are kept.
+		self.task_cache = self._create_task_cache()
+		if self.task_cache is not None and self.settings.cache_background_writes:
+			self.task_cache = BackgroundTaskCache(self.task_cache)
+		self.digest_cache = FileDigestCache(self.state_directory_path / const.DIGEST_CACHE_FILE_NAME)
+		self.build_state = BuildState(self.state_directory_path / const.BUILD_STATE_FILE_NAME)
+		self.history = TaskHistory(self.state_directory_path / const.TASK_HISTORY_FILE_NAME)
+
+	def create_context(self, this_task: Task, task_graph: TaskGraph, properties: t.Dict[str, str], jobs: int = 1, lazy: bool = False, keep_going: bool = False, output_mode: str = None) -> Context:
+		# A context executing tasks of the graph with the project's caches and state. The output mode defaults to the one in
+		# the settings.
+		return Context(this_task, task_graph, self.task_cache, properties, jobs=jobs, digest_cache=self.digest_cache, task_loader=self.task_loader, build_state=self.build_state, lazy=lazy, history=self.history, keep_going=keep_going, output_mode=output_mode if output_mode is not None else self.settings.task_output)
+
+	def close(self) -> None:
+		self.digest_cache.save()
+		self.build_state.save()
+		self.history.save()
+		if self.task_cache is not None:
+			self.task_cache.close()
+
+	def _create_task_cache(self) -> t.Optional[TaskCache]:
+		if self.settings.cache_type == 'http':
+			if not self.settings.cache_url:
+				raise RuntimeError(f'The "http" cache type requires a "cache_url" in "{self.settings_file_path}".')
+			local_cache_path = self.cache_path or self.state_directory_path / const.REMOTE_CACHE_DIRECTORY_NAME
+			local_cache_path.mkdir(parents=True, exist_ok=True)
+			local_cache = DirectoryTaskCache(str(local_cache_path), max_size=self.settings.cache_max_size_bytes, max_age=self.settings.cache_max_age_seconds, compression=self._compression_policy())
+			return HttpTaskCache(self.settings.cache_url, local_cache)
+
+		cache_path = self.cache_path
+		if cache_path is None or not cache_path.is_dir():
+			return None
+		if self.settings.cache_type == 'directory':
+			return DirectoryTaskCache(str(cache_path), max_size=self.settings.cache_max_size_bytes, max_age=self.settings.cache_max_age_seconds, compression=self._compression_policy())
+		elif self.settings.cache_type == 'content-addressed':
+			return ContentAddressedTaskCache(str(cache_path), link_mode=self.settings.cache_link_mode, max_size=self.settings.cache_max_size_bytes, max_age=self.settings.cache_max_age_seconds)
+		else:
+			raise RuntimeError(f'Unknown cache type "{self.settings.cache_type}" in "{self.settings_file_path}". Valid values are: directory, content-addressed, http')
+
+	def _compression_policy(self) -> CompressionPolicy:
+		try:
+			return CompressionPolicy(self.settings.cache_compression, self.settings.cache_compression_level)
+		except RuntimeError as e:
+			raise RuntimeError(f'{e} (in "{self.settings_file_path}")')
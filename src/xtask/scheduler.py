@@ -0,0 +1,114 @@
+import heapq
+import typing as t
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from xtask.task import Task
+from xtask.task_graph import TaskGraph
+
+
+# Dispatches the tasks of a task graph to a pool of workers as soon as all of their dependencies are done. When more tasks
+# are ready than there are free workers, those with the highest priority go first.
+#
+# Once a task fails, nothing new is dispatched (and the tasks in flight are left to finish or be cancelled by whoever
+# executes them), unless the scheduler keeps going: then only the tasks depending on a failed task, directly or not, are
+# left out, and every independent branch still executes.
+class Scheduler():
+
+	jobs: int
+	keep_going: bool
+
+	_task_graph: TaskGraph
+	_priorities: t.Dict[Task, float]
+
+	def __init__(self, task_graph: TaskGraph, jobs: int = 1, priorities: t.Dict[Task, float] = None, keep_going: bool = False):
+		if jobs < 1:
+			raise RuntimeError(f'Cannot schedule tasks with {jobs} jobs. At least one job is required.')
+		self.jobs = jobs
+		self.keep_going = keep_going
+		self._task_graph = task_graph
+		self._priorities = priorities if priorities is not None else dict()
+
+	def run(self, execute_task: t.Callable[[Task], bool]) -> t.List[Task]:
+		# Executes the tasks, each returning whether it succeeded, and returns the tasks that were never executed because
+		# a task failed.
+		sorter = self._task_graph.sorter()
+		executed: t.Set[Task] = set()
+		# Tasks that failed, and tasks left out because they depend on one.
+		doomed: t.Set[Task] = set()
+		if self.jobs == 1:
+			# Nothing can run concurrently, so avoid the overhead of a pool and execute on the calling thread.
+			while sorter.is_active() and (self.keep_going or not doomed):
+				for task in sorter.get_ready():
+					if self._is_doomed(task, doomed):
+						doomed.add(task)
+					elif self.keep_going or not doomed:
+						executed.add(task)
+						if not execute_task(task):
+							doomed.add(task)
+					sorter.done(task)
+			return [task for task in self._task_graph.all_tasks if task not in executed]
+
+		# A heap of (negated priority, order of readiness, task), so ties keep the order tasks became ready in.
+		ready: t.List[t.Tuple[float, int, Task]] = list()
+		readiness = 0
+		in_flight: t.Dict[Future, Task] = dict()
+		with ThreadPoolExecutor(max_workers=self.jobs, thread_name_prefix='xtask-worker') as pool:
+			while sorter.is_active() and (self.keep_going or not doomed or in_flight):
+				for task in sorter.get_ready():
+					if self._is_doomed(task, doomed):
+						# Its dependents become ready, and are left out too.
+						doomed.add(task)
+						sorter.done(task)
+					else:
+						heapq.heappush(ready, (-self._priorities.get(task, 0.0), readiness, task))
+						readiness += 1
+				while ready and len(in_flight) < self.jobs and (self.keep_going or not doomed):
+					task = heapq.heappop(ready)[2]
+					executed.add(task)
+					in_flight[pool.submit(execute_task, task)] = task
+				if not in_flight:
+					continue
+				finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+				for future in finished:
+					task = in_flight.pop(future)
+					# Re-raise any error from the worker. Leaving the pool's context waits for the remaining in-flight tasks.
+					if not future.result():
+						doomed.add(task)
+					sorter.done(task)
+		return [task for task in self._task_graph.all_tasks if task not in executed]
+
+	def _is_doomed(self, task: Task, doomed: t.Set[Task]) -> bool:
+		return any(dependency in doomed for dependency in self._task_graph.dependencies(task))
+
+def critical_paths(task_graph: TaskGraph, estimates: t.Dict[Task, float]) -> t.Dict[Task, float]:
+	# Returns, for every task, the estimated time from when it starts until everything depending on it is done: its own
+	# estimate plus the longest remaining path through the tasks that depend on it. Starting the tasks with the longest
+	# remaining path first keeps the slowest chain of tasks from holding up the end of a run.
+	order: t.List[Task] = list()
+	for task, done in task_graph.topological_order():
+		order.append(task)
+		done()
+	remaining: t.Dict[Task, float] = dict()
+	for task in reversed(order):
+		remaining[task] = estimates[task] + max((remaining[dependent] for dependent in task_graph.direct_dependents(task)), default=0.0)
+	return remaining
+
+def simulate(task_graph: TaskGraph, estimates: t.Dict[Task, float], jobs: int) -> float:
+	# Estimates how long the scheduler takes to execute the graph with the given number of jobs, if every task takes as long
+	# as estimated.
+	priorities = critical_paths(task_graph, estimates)
+	sorter = task_graph.sorter()
+	ready: t.List[t.Tuple[float, int, Task]] = list()
+	readiness = 0
+	running: t.List[t.Tuple[float, int, Task]] = list()
+	now = 0.0
+	while sorter.is_active():
+		for task in sorter.get_ready():
+			heapq.heappush(ready, (-priorities[task], readiness, task))
+			readiness += 1
+		while ready and len(running) < jobs:
+			_, order, task = heapq.heappop(ready)
+			heapq.heappush(running, (now + estimates[task], order, task))
+		now, _, task = heapq.heappop(running)
+		sorter.done(task)
+	return now
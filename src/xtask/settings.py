@@ -1,16 +1,47 @@
 import json
+import re
+import typing as t
 from dataclasses import dataclass
 from pathlib import Path
 
+_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
 
 @dataclass
 class Settings():
 	
 	cache_location: str = None
+	cache_type: str = 'directory'
+	cache_url: str = None
+	cache_link_mode: str = 'auto'
+	cache_max_size: int | str = None
+	cache_max_age_days: float = None
+	cache_background_writes: bool = True
+	cache_compression: str = 'stored'
+	cache_compression_level: int = None
+	cache_task_discovery: bool = True
 	extension_location: str = None
 	log_level: str = 'info'
+	task_output: str = 'prefixed'
 
 	@classmethod
 	def load(cls, file_path: Path) -> 'Settings':
 		config = json.loads(file_path.read_text())
 		return Settings(**config)
+
+	@property
+	def cache_max_size_bytes(self) -> t.Optional[int]:
+		return parse_size(self.cache_max_size) if self.cache_max_size is not None else None
+
+	@property
+	def cache_max_age_seconds(self) -> t.Optional[float]:
+		return self.cache_max_age_days * 24 * 60 * 60 if self.cache_max_age_days is not None else None
+
+def parse_size(size: int | str) -> int:
+	# Accepts a number of bytes, or a string such as "512M", "10 GB" or "1.5GiB".
+	if isinstance(size, int):
+		return size
+	match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?\s*', str(size), flags=re.IGNORECASE)
+	if not match:
+		raise RuntimeError(f'Unable to parse the size "{size}". Expected a number of bytes or a size such as "10GB".')
+	return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
@@ -3,6 +3,7 @@ import inspect
 import logging
 import struct
 import sys
+import time
 import traceback
 import typing as t
 from pathlib import Path
@@ -10,6 +11,12 @@ from pathlib import Path
 import colorama
 
 import xtask.constants as const
+import xtask.metrics as metrics
+import xtask.task_output as task_output
+from xtask.compression import CompressionPolicy
+from xtask.file_digest import FileDigestCache, file_digest
+from xtask.path_matcher import DirectoryListingCache
+from xtask.task_output import TaskOutput
 from xtask.util import *
 
 if t.TYPE_CHECKING:
@@ -22,6 +29,9 @@ class Task():
 	working_directory_path: Path
 	use_cache: bool
 	file_path: Path
+	# Whether the action only resolves paths through the helpers of xtask.util, so that it can run concurrently with other
+	# actions instead of inside of its working directory.
+	thread_safe: bool
 
 	_unresolved_dependencies: t.List[str]
 	_dependencies: t.List[str]
@@ -30,6 +40,7 @@ class Task():
 	_exclude_src_patterns: t.List[str]
 	_include_out_patterns: t.List[str]
 	_exclude_out_patterns: t.List[str]
+	_compression: t.Optional[CompressionPolicy]
 	_action: t.Callable
 
 	def __init__(self, 
@@ -39,13 +50,15 @@ class Task():
 				working_directory_path: Path,
 				use_cache: bool,
 				action: t.Callable[['Context'], None],
-				file_path: int):
+				file_path: int,
+				thread_safe: bool = False):
 		self.name = name
 		self.group = group
 		self.doc = doc
 		self.working_directory_path = working_directory_path
 		self.file_path = file_path
 		self.use_cache = use_cache
+		self.thread_safe = thread_safe
 		self._unresolved_dependencies = list()
 		self._dependencies = None
 		self._additional_inputs = list()
@@ -53,6 +66,7 @@ class Task():
 		self._exclude_src_patterns = list()
 		self._include_out_patterns = list()
 		self._exclude_out_patterns = list()
+		self._compression = None
 		self._action = action
 
 	@property
@@ -65,11 +79,11 @@ class Task():
 			raise RuntimeError(f'Cannot access the dependencies of this task, {self}, before it is finished being configured.')
 		return self._dependencies
 
-	def inputs(self) -> t.List[str]:
-		return xglob(include=self._include_src_patterns, exclude=self._exclude_src_patterns, root_dir=str(self.working_directory_path))
+	def inputs(self, listing_cache: DirectoryListingCache = None) -> t.List[str]:
+		return xglob(include=self._include_src_patterns, exclude=self._exclude_src_patterns, root_dir=str(self.working_directory_path), listing_cache=listing_cache)
 
-	def outputs(self) -> t.List[str]:
-		return xglob(include=self._include_out_patterns, exclude=self._exclude_out_patterns, root_dir=str(self.working_directory_path))
+	def outputs(self, listing_cache: DirectoryListingCache = None) -> t.List[str]:
+		return xglob(include=self._include_out_patterns, exclude=self._exclude_out_patterns, root_dir=str(self.working_directory_path), listing_cache=listing_cache)
 	
 	def copy_outputs(self, destination_directory: str | Path, include: str = '*', exclude: str = '', keep_structure: bool = False):
 		files_to_copy = list()
@@ -79,44 +93,46 @@ class Task():
 				files_to_copy.append(file_path)
 		copy(files_to_copy, destination_directory, keep_structure_relative_to=(self.working_directory_path if keep_structure else None))
 
-	def input_hash(self) -> int:
+	def input_hash(self, digest_cache: FileDigestCache = None, listing_cache: DirectoryListingCache = None, exclude: t.Collection[str] = ()) -> int:
 		logging.debug(f'Hashing inputs for {self}')
+		start = time.perf_counter()
 		in_hash = hashlib.md5()
+		digest = digest_cache.digest if digest_cache is not None else file_digest
 
 		logging.debug(f'Updating with file hash {self.file_path}')
-		in_hash.update(self.file_path.read_bytes())
+		in_hash.update(digest(self.file_path))
 
 		logging.debug(f'Updating hash with files:')
-		for input_file in sorted(self.inputs()):
+		# Inputs produced by dependencies may be excluded, and are then never hashed.
+		input_files = sorted(input_file for input_file in self.inputs(listing_cache) if input_file not in exclude)
+		metrics.count(metrics.INPUT_FILES, len(input_files))
+		for input_file in input_files:
 			logging.debug(f'\t- "{input_file}"')
-			in_hash.update(Path(input_file).read_bytes())
+			in_hash.update(digest(input_file))
 
 		logging.debug('Updating hash with additionl inputs')
 		for additional_input in self._additional_inputs:
 			in_hash.update(additional_input)
 
+		metrics.count(metrics.INPUT_HASH_SECONDS, time.perf_counter() - start)
 		return int.from_bytes(in_hash.digest(), byteorder=sys.byteorder)
 	
-	def _execute(self, ctx: 'Context') -> None:
+	def _execute(self, ctx: 'Context', output: TaskOutput = None) -> bool:
+		# Everything the action writes goes to its output, which shows it on the terminal and records it.
+		output = output if output is not None else TaskOutput(self.label)
 		try:
-			print(colorama.Style.BRIGHT + colorama.Fore.CYAN)
-			print('==================================================')
-			print(f'| Executing {self}')
-			print('--------------------------------------------------')
-			print(colorama.Style.RESET_ALL)
-			self._action(ctx)
-			print(colorama.Style.BRIGHT + colorama.Fore.GREEN)
-			print('--------------------------------------------------')
-			print(f'| Successfully executed {self}')
-			print('==================================================')
-			print(colorama.Style.RESET_ALL)
-		except Exception:
-			traceback.print_exc()
-			print(colorama.Style.BRIGHT + colorama.Fore.RED)
-			print('--------------------------------------------------')
-			print(f'| Failed to execute {self}')
-			print('==================================================')
-			print(colorama.Style.RESET_ALL)
+			output.announce(_banner(colorama.Fore.CYAN, '==================================================', f'| Executing {self}', '--------------------------------------------------'))
+			with task_output.capture(output):
+				try:
+					self._action(ctx)
+				except Exception:
+					traceback.print_exc()
+					output.announce(_banner(colorama.Fore.RED, '--------------------------------------------------', f'| Failed to execute {self}', '=================================================='))
+					return False
+			output.announce(_banner(colorama.Fore.GREEN, '--------------------------------------------------', f'| Successfully executed {self}', '=================================================='))
+			return True
+		finally:
+			output.finish()
 
 
 	def __hash__(self) -> int:
@@ -134,7 +150,10 @@ class Task():
 	def __repr__(self) -> str:
 		return f'[{self.label}]'
 
-def task(name: str, use_cache: bool = False) -> t.Callable[..., Task]:
+def _banner(color: str, *lines: str) -> str:
+	return '\n'.join([colorama.Style.BRIGHT + color, *lines, colorama.Style.RESET_ALL, ''])
+
+def task(name: str, use_cache: bool = False, thread_safe: bool = False) -> t.Callable[..., Task]:
 	def inner(func):
 		# Gets the most recent *.tasks file in the call stack, which should be the task file we are meant to be defined in.
 		# Tasks can be defined inside of functions and inside *.py files that may be imported from anywhere. Thus, we look back
@@ -163,7 +182,8 @@ def task(name: str, use_cache: bool = False) -> t.Callable[..., Task]:
 						working_directory_path=dir_path, 
 						use_cache=use_cache, 
 						action=func,
-						file_path=file_path)
+						file_path=file_path,
+						thread_safe=thread_safe)
 
 		all_tasks.append(new_task)
 		return new_task
@@ -215,6 +235,16 @@ def outputs(include: t.Iterable[str] = None, exclude: t.Iterable[str] = None):
 		return task
 	return inner
 
+def compression(method: str, level: int = None):
+	# Overrides how the task's outputs are compressed in the task cache, e.g. "stored" for outputs that are compressed already
+	# or "lzma" for large text files. See the "cache_compression" setting.
+	compression_policy = CompressionPolicy(method, level)
+
+	def inner(task: Task):
+		task._compression = compression_policy
+		return task
+	return inner
+
 def dependencies(*tasks):
 	def inner(task: Task):
 		task._unresolved_dependencies.extend(tasks)
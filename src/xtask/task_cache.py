@@ -1,52 +1,697 @@
 import abc
+import errno
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
 import typing as t
 from pathlib import Path
-from zipfile import ZipFile
+from zipfile import ZIP_DEFLATED, ZipFile
+
+import xtask.metrics as metrics
+import xtask.trace as trace
+from xtask.compression import CompressionPolicy, CompressionStats
+
+if sys.platform == 'linux':
+    import fcntl
+
+
+CHUNK_SIZE = 1024 * 1024
+# The name an entry's log is stored under, next to its files. It is never restored along with them.
+LOG_FILE_NAME = '.xtask-output.log'
 
 
 class TaskCache(abc.ABC):
 
+    # Files are never loaded into memory as a whole: get() yields an open stream for each cached file (only valid until the
+    # next file is yielded) and put() takes the path of each file to cache, along with the relative name to cache it under.
+    # put() may also be given a compression policy for the entry, overriding the cache's own (where it compresses at all),
+    # and the log of the action that produced the files, which get_log() returns for the entry. copy_to() returns whether the
+    # entry was restored, since it may be gone by then, e.g. evicted by another process sharing the cache.
+
     @abc.abstractmethod
-    def get(self, input_hash: int) -> t.List[t.Tuple[str, bytes]]: ...
+    def get(self, input_hash: int) -> t.Optional[t.Iterator[t.Tuple[str, t.BinaryIO]]]: ...
     
     @abc.abstractmethod
-    def copy_to(self, input_hash: int, target_dir: str) -> None: ...
+    def copy_to(self, input_hash: int, target_dir: str) -> bool: ...
     
     @abc.abstractmethod
-    def put(self, input_hash: int, files: t.List[t.Tuple[str, bytes]]) -> None: ...
+    def put(self, input_hash: int, files: t.List[t.Tuple[str, Path]], compression: CompressionPolicy = None, log: str = None) -> None: ...
     
     @abc.abstractmethod
     def __contains__(self, input_hash: int) -> bool: ...
-        
+
+    def get_log(self, input_hash: int) -> t.Optional[str]:
+        # Returns the log stored with the entry for an input hash, if there is one.
+        return None
+
+    def contains_many(self, input_hashes: t.Iterable[int]) -> t.Set[int]:
+        # Returns which of the input hashes have an entry. Remote caches answer this with a single request.
+        return {input_hash for input_hash in input_hashes if input_hash in self}
+
+    def remove(self, input_hash: int) -> None:
+        # Removes the entry for an input hash, if there is one.
+        pass
+
+    def gc(self, max_size: int = None, max_age: float = None) -> None:
+        # Evicts entries according to the given size (in bytes) and age (in seconds) limits, or the cache's own limits when
+        # not given. Caches without limits have nothing to do.
+        pass
+
+    def close(self) -> None:
+        # Persists any state the cache keeps in memory. Called once xtask is done with the cache.
+        pass
+
+class CacheIndex():
+    # Tracks the size and last access time of every entry in a cache directory, so eviction doesn't need to stat every entry.
+    # The index is only advisory: it is rebuilt from the directory when missing, and merged with the copy on disk when saved,
+    # since several processes may share the same cache directory. The total size and the oldest access time are kept up to
+    # date as entries change, so whether anything needs evicting is known without going through every entry.
+
+    FILE_NAME = 'index.json'
+
+    _file_path: Path
+    _scan: t.Callable[[], t.Iterable[str]]
+    _measure: t.Callable[[str], t.Optional[int]]
+    _entries: t.Optional[t.Dict[str, t.List[float]]]
+    _removed: t.Set[str]
+    _dirty: bool
+    _total_size: int
+    # No entry was accessed before this time. Accesses only move forward, so it may lag behind the oldest entry, until the
+    # next time evictions are selected.
+    _oldest_access: t.Optional[float]
+    _lock: threading.Lock
+
+    def __init__(self, directory_path: Path, scan: t.Callable[[], t.Iterable[str]], measure: t.Callable[[str], t.Optional[int]]):
+        self._file_path = directory_path / self.FILE_NAME
+        self._scan = scan
+        self._measure = measure
+        self._entries = None
+        self._removed = set()
+        self._dirty = False
+        self._total_size = 0
+        self._oldest_access = None
+        self._lock = threading.Lock()
+
+    @property
+    def total_size(self) -> int:
+        with self._lock:
+            self._load()
+            return self._total_size
+
+    def needs_eviction(self, max_size: t.Optional[int], max_age: t.Optional[float]) -> bool:
+        with self._lock:
+            self._load()
+            if max_size is not None and self._total_size > max_size:
+                return True
+            return max_age is not None and self._oldest_access is not None and time.time() - self._oldest_access > max_age
+
+    def touch(self, key: str) -> None:
+        with self._lock:
+            entry = self._load().get(key)
+            if entry is None:
+                # Added by another process since the index was loaded.
+                size = self._measure(key)
+                if size is None:
+                    return
+                self._set(key, size, time.time())
+            else:
+                entry[1] = time.time()
+            self._dirty = True
+
+    def add(self, key: str, size: int) -> None:
+        with self._lock:
+            self._load()
+            self._set(key, size, time.time())
+            self._removed.discard(key)
+            self._dirty = True
+
+    def remove(self, key: str) -> None:
+        with self._lock:
+            entry = self._load().pop(key, None)
+            if entry is not None:
+                self._total_size -= entry[0]
+            self._removed.add(key)
+            self._dirty = True
+
+    def select_evictions(self, max_size: t.Optional[int], max_age: t.Optional[float]) -> t.List[str]:
+        # Returns the keys to evict, least recently used first: every entry older than the max age, then as many of the
+        # remaining entries as needed to fit within the max size.
+        with self._lock:
+            now = time.time()
+            least_recently_used = sorted(self._load().items(), key=lambda item: item[1][1])
+            evictions = list()
+            if max_age is not None:
+                evictions.extend(key for key, (_, last_access) in least_recently_used if now - last_access > max_age)
+                least_recently_used = [(key, entry) for key, entry in least_recently_used if now - entry[1] <= max_age]
+            if max_size is not None:
+                total_size = sum(size for _, (size, _) in least_recently_used)
+                evicted = 0
+                for key, (size, _) in least_recently_used:
+                    if total_size <= max_size:
+                        break
+                    evictions.append(key)
+                    total_size -= size
+                    evicted += 1
+                least_recently_used = least_recently_used[evicted:]
+            self._oldest_access = least_recently_used[0][1][1] if least_recently_used else None
+            return evictions
+
+    def save(self) -> None:
+        with self._lock:
+            if not self._dirty:
+                return
+            for key, entry in (self._read() or dict()).items():
+                if key in self._removed:
+                    continue
+                if key not in self._entries:
+                    self._set(key, entry[0], entry[1])
+                else:
+                    self._entries[key][1] = max(self._entries[key][1], entry[1])
+            file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(self._file_path.parent), prefix='.tmp-')
+            with os.fdopen(file_descriptor, 'w') as temp_file:
+                json.dump(self._entries, temp_file)
+            os.chmod(temp_file_name, 0o644)
+            os.replace(temp_file_name, str(self._file_path))
+            self._removed.clear()
+            self._dirty = False
+
+    def _load(self) -> t.Dict[str, t.List[float]]:
+        if self._entries is None:
+            entries = self._read()
+            self._entries = dict()
+            if entries is None:
+                logging.info(f'Rebuilding the task cache index "{self._file_path}"')
+                entries = dict()
+                for key in self._scan():
+                    size = self._measure(key)
+                    if size is not None:
+                        entries[key] = [size, time.time()]
+                self._dirty = True
+            for key, (size, last_access) in entries.items():
+                self._set(key, size, last_access)
+        return self._entries
+
+    def _set(self, key: str, size: int, last_access: float) -> None:
+        previous_entry = self._entries.get(key)
+        if previous_entry is not None:
+            self._total_size -= previous_entry[0]
+        self._entries[key] = [size, last_access]
+        self._total_size += size
+        if self._oldest_access is None or last_access < self._oldest_access:
+            self._oldest_access = last_access
+
+    def _read(self) -> t.Optional[t.Dict[str, t.List[float]]]:
+        try:
+            return json.loads(self._file_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
 class DirectoryTaskCache(TaskCache):
+    # Stores one zip archive per input hash. Archives are written to a temporary file and renamed into place once complete,
+    # so an entry that exists is always whole, even if xtask crashes while putting it. Files are compressed according to a
+    # compression policy, which only matters when writing: archives are read the same whatever their files were written with.
+
+    # Temporary files older than this are left over from a crash, rather than still being written by another process.
+    TEMP_FILE_GRACE_PERIOD = 60 * 60
     
     _directory_path: Path
+    _index: CacheIndex
+    _max_size: t.Optional[int]
+    _max_age: t.Optional[float]
+    _compression: CompressionPolicy
+    compression_stats: CompressionStats
     
-    def __init__(self, directory_path: str):
+    def __init__(self, directory_path: str, max_size: int = None, max_age: float = None, compression: CompressionPolicy = None):
         self._directory_path = Path(directory_path)
+        self._index = CacheIndex(self._directory_path, self._scan_entries, self._measure_entry)
+        self._max_size = max_size
+        self._max_age = max_age
+        self._compression = compression if compression is not None else CompressionPolicy()
+        self.compression_stats = CompressionStats()
     
     def __contains__(self, input_hash: int) -> bool:
         cache_file = Path(self._directory_path, str(input_hash))
-        return cache_file.exists()
+        if cache_file.exists():
+            self._index.touch(str(input_hash))
+            return True
+        return False
     
-    def get(self, input_hash: int) -> t.Optional[t.List[t.Tuple[str, bytes]]]:
+    def get(self, input_hash: int) -> t.Optional[t.Iterator[t.Tuple[str, t.BinaryIO]]]:
         cache_file = Path(self._directory_path, str(input_hash))
-        files = list()
         if cache_file.exists():
-            with ZipFile(str(cache_file.resolve()), 'r') as zip_file:
-                for file in zip_file.filelist:
-                    files.append((file.filename, zip_file.read(file)))
-            return files
+            return self._iterate_files(cache_file)
         else:
             return None
         
-    def copy_to(self, input_hash: int, target_dir: str) -> None:
+    def copy_to(self, input_hash: int, target_dir: str) -> bool:
         cache_file = Path(self._directory_path, str(input_hash))
-        if cache_file.exists():
-            with ZipFile(str(cache_file.resolve()), 'r') as zip_file:
-                zip_file.extractall(target_dir)
+        try:
+            # Once open, the archive stays readable even if it is evicted in the meantime.
+            zip_file = ZipFile(str(cache_file.resolve()), 'r')
+        except FileNotFoundError:
+            return False
+        with zip_file:
+            self._index.touch(str(input_hash))
+            metrics.count(metrics.CACHE_BYTES_READ, os.fstat(zip_file.fp.fileno()).st_size)
+            for file in zip_file.filelist:
+                if file.filename == LOG_FILE_NAME:
+                    continue
+                extracted_path = zip_file.extract(file, target_dir)
+                # ZipFile records each file's permissions when writing but does not restore them when extracting.
+                mode = stat.S_IMODE(file.external_attr >> 16)
+                if mode and not file.is_dir():
+                    os.chmod(extracted_path, mode)
+        return True
     
-    def put(self, input_hash: int, files: t.List[t.Tuple[str, bytes]]) -> None:
-        with ZipFile(str(Path(self._directory_path, str(input_hash)).resolve()), 'w') as zip_file:
-            for file_path, file_content in files:
-                zip_file.writestr(file_path, file_content)
\ No newline at end of file
+    def get_log(self, input_hash: int) -> t.Optional[str]:
+        cache_file = Path(self._directory_path, str(input_hash))
+        try:
+            with ZipFile(str(cache_file.resolve()), 'r') as zip_file:
+                return zip_file.read(LOG_FILE_NAME).decode('utf-8', errors='replace')
+        except (FileNotFoundError, KeyError):
+            return None
+
+    def put(self, input_hash: int, files: t.List[t.Tuple[str, Path]], compression: CompressionPolicy = None, log: str = None) -> None:
+        compression = compression if compression is not None else self._compression
+        file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(self._directory_path), prefix='.tmp-')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file, ZipFile(temp_file, 'w') as zip_file:
+                for file_name, source_path in files:
+                    start = time.perf_counter()
+                    method, compress_type, compress_level = compression.choose(source_path)
+                    # Copies (and compresses) the file into the archive in chunks.
+                    zip_file.write(str(source_path), arcname=file_name, compress_type=compress_type, compresslevel=compress_level)
+                    info = zip_file.infolist()[-1]
+                    self.compression_stats.record(method, info.file_size, info.compress_size, time.perf_counter() - start)
+                # Logs are always deflated, since text compresses well whatever the policy.
+                if log:
+                    zip_file.writestr(LOG_FILE_NAME, log.encode('utf-8'), compress_type=ZIP_DEFLATED)
+            os.chmod(temp_file_name, 0o644)
+            metrics.count(metrics.CACHE_BYTES_WRITTEN, os.stat(temp_file_name).st_size)
+            self.add_entry(input_hash, Path(temp_file_name))
+        except BaseException:
+            Path(temp_file_name).unlink(missing_ok=True)
+            raise
+
+    def remove(self, input_hash: int) -> None:
+        self.entry_path(input_hash).unlink(missing_ok=True)
+        self._index.remove(str(input_hash))
+
+    def entry_path(self, input_hash: int) -> Path:
+        return Path(self._directory_path, str(input_hash))
+
+    def add_entry(self, input_hash: int, archive_path: Path) -> None:
+        # Moves a complete archive (e.g. one downloaded from a remote cache) into the cache. The archive must be on the same
+        # filesystem as the cache, so the entry appears atomically.
+        cache_file = self.entry_path(input_hash)
+        os.replace(str(archive_path), str(cache_file))
+        self._index.add(str(input_hash), cache_file.stat().st_size)
+        # Only entries are evicted here. The index is saved, and left over temporary files removed, by gc() and close().
+        if self._index.needs_eviction(self._max_size, self._max_age):
+            self._evict(self._max_size, self._max_age)
+
+    def gc(self, max_size: int = None, max_age: float = None) -> None:
+        max_size = max_size if max_size is not None else self._max_size
+        max_age = max_age if max_age is not None else self._max_age
+        self._evict(max_size, max_age)
+        self._index.save()
+        grace_period_end = time.time() - self.TEMP_FILE_GRACE_PERIOD
+        for temp_file_path in self._directory_path.glob('.tmp-*'):
+            try:
+                if temp_file_path.stat().st_mtime < grace_period_end:
+                    temp_file_path.unlink()
+            except FileNotFoundError:
+                continue
+
+    def close(self) -> None:
+        self._index.save()
+        summary = self.compression_stats.summary()
+        if summary is not None:
+            logging.info(summary)
+
+    def _evict(self, max_size: t.Optional[int], max_age: t.Optional[float]) -> None:
+        for key in self._index.select_evictions(max_size, max_age):
+            logging.info(f'Evicting the entry for input hash {key} from the task cache')
+            Path(self._directory_path, key).unlink(missing_ok=True)
+            self._index.remove(key)
+
+    def _iterate_files(self, cache_file: Path) -> t.Iterator[t.Tuple[str, t.BinaryIO]]:
+        with ZipFile(str(cache_file.resolve()), 'r') as zip_file:
+            for file in zip_file.filelist:
+                if file.is_dir() or file.filename == LOG_FILE_NAME:
+                    continue
+                with zip_file.open(file) as file_stream:
+                    yield file.filename, file_stream
+
+    def _scan_entries(self) -> t.Iterable[str]:
+        return [path.name for path in self._directory_path.iterdir() if path.name.isdigit()]
+
+    def _measure_entry(self, key: str) -> t.Optional[int]:
+        try:
+            return Path(self._directory_path, key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+class ContentAddressedTaskCache(TaskCache):
+    # Stores every output file once as a blob named after its content digest, plus a small manifest per input hash that maps
+    # relative paths to blobs. Restoring an entry links the blobs into place instead of copying their contents.
+    #
+    # Blobs are made read-only, because a hardlinked output shares its data with the blob. A task that rewrites a restored
+    # output in place (instead of replacing it) would otherwise silently corrupt the cache.
+
+    LINK_MODES = ('auto', 'reflink', 'hardlink', 'copy')
+    BLOB_GRACE_PERIOD = 60 * 60
+    _EXECUTABLE_SUFFIX = '-x'
+
+    # The FICLONE ioctl from <linux/fs.h>, which clones a file's extents on copy-on-write filesystems (btrfs, xfs, ...).
+    _FICLONE = 0x40049409
+
+    _directory_path: Path
+    _blobs_path: Path
+    _manifests_path: Path
+    _link_mode: str
+    _can_reflink: bool
+    _can_hardlink: bool
+    _index: CacheIndex
+    _max_size: t.Optional[int]
+    _max_age: t.Optional[float]
+
+    def __init__(self, directory_path: str, link_mode: str = 'auto', max_size: int = None, max_age: float = None):
+        if link_mode not in self.LINK_MODES:
+            raise RuntimeError(f'Unknown cache link mode "{link_mode}". Valid values are: {", ".join(self.LINK_MODES)}')
+        self._directory_path = Path(directory_path)
+        self._blobs_path = self._directory_path / 'blobs'
+        self._manifests_path = self._directory_path / 'manifests'
+        self._blobs_path.mkdir(parents=True, exist_ok=True)
+        self._manifests_path.mkdir(parents=True, exist_ok=True)
+        self._link_mode = link_mode
+        self._can_reflink = link_mode in ('auto', 'reflink') and sys.platform == 'linux'
+        self._can_hardlink = link_mode in ('auto', 'hardlink')
+        # Entry sizes count every blob an entry references, so blobs shared between entries are counted more than once.
+        self._index = CacheIndex(self._directory_path, self._scan_entries, self._measure_entry)
+        self._max_size = max_size
+        self._max_age = max_age
+
+    def __contains__(self, input_hash: int) -> bool:
+        if self._manifest_path(input_hash).exists():
+            self._index.touch(str(input_hash))
+            return True
+        return False
+
+    def get(self, input_hash: int) -> t.Optional[t.Iterator[t.Tuple[str, t.BinaryIO]]]:
+        manifest = self._read_manifest(input_hash)
+        if manifest is None:
+            return None
+        return self._iterate_files(manifest)
+
+    def copy_to(self, input_hash: int, target_dir: str) -> bool:
+        manifest = self._read_manifest(input_hash)
+        if manifest is None:
+            return False
+        self._index.touch(str(input_hash))
+        target_dir_path = Path(target_dir)
+        for file_name, blob_name in manifest.items():
+            if file_name == LOG_FILE_NAME:
+                continue
+            destination_path = target_dir_path / file_name
+            destination_path.parent.mkdir(parents=True, exist_ok=True)
+            # Never write through an existing file, since it may itself be a hardlink to another blob.
+            destination_path.unlink(missing_ok=True)
+            try:
+                self._restore_blob(self._blob_path(blob_name), destination_path)
+            except FileNotFoundError:
+                # The blob was removed by a concurrent gc. Whatever was restored so far is overwritten by the action.
+                return False
+            metrics.count(metrics.CACHE_BYTES_READ, destination_path.stat().st_size)
+        return True
+
+    def get_log(self, input_hash: int) -> t.Optional[str]:
+        manifest = self._read_manifest(input_hash)
+        if manifest is None or LOG_FILE_NAME not in manifest:
+            return None
+        return self._blob_path(manifest[LOG_FILE_NAME]).read_text(encoding='utf-8', errors='replace')
+
+    def put(self, input_hash: int, files: t.List[t.Tuple[str, Path]], compression: CompressionPolicy = None, log: str = None) -> None:
+        # Blobs are never compressed, since they are linked into place as they are.
+        manifest = dict()
+        for file_name, source_path in files:
+            # Executable files get their own blob, since a blob's mode is shared by every file linked to it.
+            executable = os.access(str(source_path), os.X_OK)
+            blob_name = self._digest(source_path) + (self._EXECUTABLE_SUFFIX if executable else '')
+            blob_path = self._blob_path(blob_name)
+            if blob_path.exists():
+                # Refresh the blob's modification time so a concurrent garbage collection treats it as recently written.
+                os.utime(str(blob_path))
+            else:
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                self._copy_atomic(Path(source_path), blob_path, mode=0o555 if executable else 0o444)
+                metrics.count(metrics.CACHE_BYTES_WRITTEN, blob_path.stat().st_size)
+            manifest[Path(file_name).as_posix()] = blob_name
+        if log:
+            log_content = log.encode('utf-8')
+            blob_name = hashlib.sha256(log_content).hexdigest()
+            blob_path = self._blob_path(blob_name)
+            if not blob_path.exists():
+                blob_path.parent.mkdir(parents=True, exist_ok=True)
+                self._write_atomic(blob_path, log_content, mode=0o444)
+            manifest[LOG_FILE_NAME] = blob_name
+        # The manifest is written last, so an entry only becomes visible once all of its blobs exist.
+        self._write_atomic(self._manifest_path(input_hash), json.dumps(manifest, indent='\t').encode('utf-8'), mode=0o644)
+        self._index.add(str(input_hash), sum(self._blob_path(blob_name).stat().st_size for blob_name in set(manifest.values())))
+        # The index is only saved by gc() and close().
+        if self._index.needs_eviction(self._max_size, self._max_age):
+            self._evict(self._max_size, self._max_age)
+
+    def gc(self, max_size: int = None, max_age: float = None) -> None:
+        max_size = max_size if max_size is not None else self._max_size
+        max_age = max_age if max_age is not None else self._max_age
+        self._evict(max_size, max_age)
+        self._index.save()
+
+    def _evict(self, max_size: t.Optional[int], max_age: t.Optional[float]) -> None:
+        evictions = self._index.select_evictions(max_size, max_age)
+        for key in evictions:
+            logging.info(f'Evicting the entry for input hash {key} from the task cache')
+            self._manifest_path(key).unlink(missing_ok=True)
+            self._index.remove(key)
+        if evictions:
+            self._remove_unreferenced_blobs()
+
+    def remove(self, input_hash: int) -> None:
+        # Blobs are left for the next garbage collection, since other entries may share them.
+        self._manifest_path(input_hash).unlink(missing_ok=True)
+        self._index.remove(str(input_hash))
+
+    def close(self) -> None:
+        self._index.save()
+
+    def _remove_unreferenced_blobs(self) -> None:
+        referenced_blobs = set()
+        for manifest_path in self._manifests_path.glob('*.json'):
+            try:
+                referenced_blobs.update(json.loads(manifest_path.read_text()).values())
+            except (FileNotFoundError, ValueError):
+                continue
+        # Blobs written recently may belong to an entry that another process has not finished putting yet.
+        grace_period_end = time.time() - self.BLOB_GRACE_PERIOD
+        for blob_path in self._blobs_path.glob('*/*'):
+            if blob_path.name in referenced_blobs:
+                continue
+            try:
+                if blob_path.stat().st_mtime < grace_period_end:
+                    blob_path.unlink()
+            except FileNotFoundError:
+                continue
+
+    def _scan_entries(self) -> t.Iterable[str]:
+        return [path.stem for path in self._manifests_path.glob('*.json')]
+
+    def _measure_entry(self, key: str) -> t.Optional[int]:
+        try:
+            manifest = json.loads(self._manifest_path(key).read_text())
+            return sum(self._blob_path(blob_name).stat().st_size for blob_name in set(manifest.values()))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _iterate_files(self, manifest: t.Dict[str, str]) -> t.Iterator[t.Tuple[str, t.BinaryIO]]:
+        for file_name, blob_name in manifest.items():
+            if file_name == LOG_FILE_NAME:
+                continue
+            with open(self._blob_path(blob_name), 'rb') as blob_stream:
+                yield file_name, blob_stream
+
+    def _digest(self, file_path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as file:
+            while chunk := file.read(CHUNK_SIZE):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _blob_path(self, blob_name: str) -> Path:
+        return self._blobs_path / blob_name[:2] / blob_name
+
+    def _manifest_path(self, input_hash: int) -> Path:
+        return self._manifests_path / f'{input_hash}.json'
+
+    def _read_manifest(self, input_hash: int) -> t.Optional[t.Dict[str, str]]:
+        manifest_path = self._manifest_path(input_hash)
+        if not manifest_path.exists():
+            return None
+        return json.loads(manifest_path.read_text())
+
+    def _write_atomic(self, file_path: Path, content: bytes, mode: int = None) -> None:
+        file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(file_path.parent), prefix='.tmp-')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file:
+                temp_file.write(content)
+            if mode is not None:
+                os.chmod(temp_file_name, mode)
+            os.replace(temp_file_name, str(file_path))
+        except BaseException:
+            Path(temp_file_name).unlink(missing_ok=True)
+            raise
+
+    def _copy_atomic(self, source_path: Path, file_path: Path, mode: int) -> None:
+        file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(file_path.parent), prefix='.tmp-')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as temp_file, open(source_path, 'rb') as source_file:
+                shutil.copyfileobj(source_file, temp_file, CHUNK_SIZE)
+            os.chmod(temp_file_name, mode)
+            os.replace(temp_file_name, str(file_path))
+        except BaseException:
+            Path(temp_file_name).unlink(missing_ok=True)
+            raise
+
+    def _restore_blob(self, blob_path: Path, destination_path: Path) -> None:
+        if self._can_reflink:
+            try:
+                self._reflink(blob_path, destination_path)
+                return
+            except FileNotFoundError:
+                raise
+            except OSError as e:
+                if self._link_mode == 'reflink':
+                    raise
+                logging.debug(f'Unable to reflink from the task cache ({e}), falling back to hardlinks')
+                self._can_reflink = False
+        if self._can_hardlink:
+            try:
+                os.link(str(blob_path), str(destination_path))
+                return
+            except OSError as e:
+                if self._link_mode == 'hardlink' or e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP):
+                    raise
+                logging.debug(f'Unable to hardlink from the task cache ({e}), falling back to copies')
+                self._can_hardlink = False
+        shutil.copyfile(str(blob_path), str(destination_path))
+        os.chmod(str(destination_path), stat.S_IMODE(blob_path.stat().st_mode) | stat.S_IWUSR)
+
+    def _reflink(self, blob_path: Path, destination_path: Path) -> None:
+        with open(blob_path, 'rb') as source_file, open(destination_path, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), self._FICLONE, source_file.fileno())
+            except OSError:
+                destination_file.close()
+                destination_path.unlink(missing_ok=True)
+                raise
+        # A reflinked file is an independent copy, so it can stay writable.
+        os.chmod(str(destination_path), stat.S_IMODE(blob_path.stat().st_mode) | stat.S_IWUSR)
+
+class BackgroundTaskCache(TaskCache):
+    # Wraps another task cache so that puts happen on a background thread, overlapping with the tasks that execute next.
+    # At most max_pending puts wait in the queue; beyond that, put() blocks until the writer catches up. Since outputs are
+    # read later than they were produced, each output's stat is recorded when queued and checked again around the write: an
+    # entry whose outputs changed in the meantime (e.g. because another task rewrote them) is discarded rather than cached.
+
+    _cache: TaskCache
+    _queue: queue.Queue
+    _pending: t.Set[int]
+    _writer: t.Optional[threading.Thread]
+    _lock: threading.Lock
+
+    def __init__(self, cache: TaskCache, max_pending: int = 8):
+        self._cache = cache
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._pending = set()
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def __contains__(self, input_hash: int) -> bool:
+        # Entries still being written are not hits yet.
+        return input_hash in self._cache
+
+    def contains_many(self, input_hashes: t.Iterable[int]) -> t.Set[int]:
+        return self._cache.contains_many(input_hashes)
+
+    def get(self, input_hash: int) -> t.Optional[t.Iterator[t.Tuple[str, t.BinaryIO]]]:
+        return self._cache.get(input_hash)
+
+    def copy_to(self, input_hash: int, target_dir: str) -> bool:
+        return self._cache.copy_to(input_hash, target_dir)
+
+    def get_log(self, input_hash: int) -> t.Optional[str]:
+        return self._cache.get_log(input_hash)
+
+    def put(self, input_hash: int, files: t.List[t.Tuple[str, Path]], compression: CompressionPolicy = None, log: str = None) -> None:
+        with self._lock:
+            if input_hash in self._pending:
+                return
+            self._pending.add(input_hash)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_entries, name='xtask-cache-writer', daemon=True)
+                self._writer.start()
+        self._queue.put((input_hash, files, compression, log, self._fingerprint(files)))
+
+    def remove(self, input_hash: int) -> None:
+        self._cache.remove(input_hash)
+
+    def gc(self, max_size: int = None, max_age: float = None) -> None:
+        self.flush()
+        self._cache.gc(max_size=max_size, max_age=max_age)
+
+    def flush(self) -> None:
+        # Waits until every queued entry has been written.
+        if self._pending:
+            logging.info(f'Waiting for {len(self._pending)} entries to be written to the task cache')
+        self._queue.join()
+
+    def close(self) -> None:
+        self.flush()
+        self._cache.close()
+
+    def _write_entries(self) -> None:
+        while True:
+            input_hash, files, compression, log, fingerprint = self._queue.get()
+            try:
+                if self._fingerprint(files) != fingerprint:
+                    logging.warning(f'Not caching the outputs for input hash {input_hash}, since they changed before they could be cached')
+                    continue
+                with trace.span('cache write', input_hash=str(input_hash)):
+                    self._cache.put(input_hash, files, compression=compression, log=log)
+                if self._fingerprint(files) != fingerprint:
+                    logging.warning(f'Not caching the outputs for input hash {input_hash}, since they changed while being cached')
+                    self._cache.remove(input_hash)
+            except Exception:
+                logging.exception(f'Unable to cache the outputs for input hash {input_hash}')
+            finally:
+                with self._lock:
+                    self._pending.discard(input_hash)
+                self._queue.task_done()
+
+    def _fingerprint(self, files: t.List[t.Tuple[str, Path]]) -> t.List[t.Optional[t.Tuple[int, int, int]]]:
+        fingerprint = list()
+        for _, source_path in files:
+            try:
+                stat_result = os.stat(str(source_path))
+                fingerprint.append((stat_result.st_size, stat_result.st_mtime_ns, stat_result.st_ino))
+            except FileNotFoundError:
+                fingerprint.append(None)
+        return fingerprint
@@ -6,17 +6,26 @@ from xtask.util import *
 
 
 class TaskGraph():
-	
-	_graph: t.Dict[Task, t.Collection[Task]]
-	
+	# An immutable graph of tasks, indexed by label and in both directions so that lookups and closures never scan every
+	# task. Subgraphs share the tasks of the graph they were taken from and are built from its index, without resolving
+	# any dependency again.
+
+	_graph: t.Dict[Task, t.Tuple[Task, ...]]
+	_all_tasks: t.Tuple[Task, ...]
+	# The reverse edges and the label index are built on first use, since many graphs (e.g. subgraphs only executed) never
+	# need them.
+	_dependents: t.Optional[t.Dict[Task, t.Tuple[Task, ...]]]
+	_tasks_by_label: t.Optional[t.Dict[str, Task]]
+	# The dependency closure of single tasks, filled in as they are asked for.
+	_closures: t.Dict[Task, t.FrozenSet[Task]]
+
 	def __init__(self, tasks: t.Collection[Task]):
-		graph: t.Dict[Task, t.List[Task]] = dict()
 		name_and_group_to_task_map: t.Dict[t.Tuple[str, str], Task] = dict()
 		for task in tasks:
-			if graph.get(task) is None:
-				graph[task] = list()
-			name_and_group_to_task_map[(task.name, task.group)] = task
-		for task in graph.keys():
+			name_and_group_to_task_map.setdefault((task.name, task.group), task)
+		graph: t.Dict[Task, t.Tuple[Task, ...]] = dict()
+		for task in name_and_group_to_task_map.values():
+			dependencies = list()
 			for dependency in task._unresolved_dependencies:
 				if ':' in dependency:
 					dep_group, dep_name = dependency.split(':')
@@ -25,34 +34,112 @@ class TaskGraph():
 				dep_task = name_and_group_to_task_map.get((dep_name, dep_group))
 				if not dep_task:
 					raise RuntimeError(f'Could not find a task named "{dep_name}" in group "{dep_group}".')
-				graph[task].append(dep_task)
+				dependencies.append(dep_task)
+			graph[task] = tuple(dependencies)
 		# We mutate the task class here, because tasks should rarely be used outside of a task graph (since dependencies would be meaningless)
 		# so this is still a part of "configuring" all tasks.
 		for task, deps in graph.items():
-			task._dependencies = deps
+			task._dependencies = list(deps)
+		self._set_graph(graph)
+
+	@classmethod
+	def _from_adjacency(cls, graph: t.Dict[Task, t.Tuple[Task, ...]]) -> 'TaskGraph':
+		# Builds a graph from already resolved dependencies, leaving the tasks themselves untouched.
+		task_graph = cls.__new__(cls)
+		task_graph._set_graph(graph)
+		return task_graph
+
+	def _set_graph(self, graph: t.Dict[Task, t.Tuple[Task, ...]]) -> None:
 		self._graph = graph
-	
+		self._all_tasks = tuple(graph)
+		self._dependents = None
+		self._tasks_by_label = None
+		self._closures = dict()
+
+	def _dependents_index(self) -> t.Dict[Task, t.Tuple[Task, ...]]:
+		if self._dependents is None:
+			dependents: t.Dict[Task, t.List[Task]] = {task: list() for task in self._graph}
+			for task, dependencies in self._graph.items():
+				for dependency in dependencies:
+					dependents[dependency].append(task)
+			self._dependents = {task: tuple(task_dependents) for task, task_dependents in dependents.items()}
+		return self._dependents
+
 	@property
-	def all_tasks(self) -> t.List[Task]:
-		return list(self._graph.keys())
-	
-	def subgraph(self, *tasks: Task):
-		# Use recursion to add a task then all of its dependencies to the subgraph.
-		# Since doing so uses the same function, it ensures the dependencies of each dependency
-		# are added to the subgraph. So on and so forth...
+	def all_tasks(self) -> t.Sequence[Task]:
+		return self._all_tasks
+
+	def __contains__(self, task: Task) -> bool:
+		return task in self._graph
+
+	def __len__(self) -> int:
+		return len(self._graph)
+
+	def task(self, label: str) -> t.Optional[Task]:
+		if self._tasks_by_label is None:
+			self._tasks_by_label = {task.label: task for task in self._graph}
+		return self._tasks_by_label.get(label)
+
+	def dependencies(self, task: Task) -> t.Sequence[Task]:
+		# The dependencies of a task within this graph, which may hold fewer of them than the task itself does.
+		return self._graph[task]
+
+	def direct_dependents(self, task: Task) -> t.Sequence[Task]:
+		return self._dependents_index()[task]
+
+	def closure(self, *tasks: Task) -> t.FrozenSet[Task]:
+		# Returns the given tasks and all of their dependencies, directly or not. The closure of a single task is remembered,
+		# and reused whenever a later walk reaches that task.
+		if len(tasks) == 1 and tasks[0] in self._closures:
+			return self._closures[tasks[0]]
+		task_set: t.Set[Task] = set()
+		pending = list(tasks)
+		while pending:
+			task = pending.pop()
+			if task in task_set:
+				continue
+			known_closure = self._closures.get(task)
+			if known_closure is not None:
+				task_set.update(known_closure)
+				continue
+			task_set.add(task)
+			pending.extend(self._graph[task])
+		closure = frozenset(task_set)
+		if len(tasks) == 1:
+			self._closures[tasks[0]] = closure
+		return closure
+
+	def subgraph(self, *tasks: Task) -> 'TaskGraph':
+		# The given tasks and all of their dependencies. Since a closure holds every dependency of its tasks, their edges are
+		# kept as they are.
+		closure = self.closure(*tasks)
+		return TaskGraph._from_adjacency({task: dependencies for task, dependencies in self._graph.items() if task in closure})
+
+	def dependents(self, *tasks: Task) -> t.Set[Task]:
+		# Returns the given tasks and every task in this graph that depends on them, directly or not.
 		task_set = set()
-		def add_task_and_dependencies(task: Task):
+		pending = [task for task in tasks if task in self._graph]
+		dependents = self._dependents_index()
+		while pending:
+			task = pending.pop()
 			if task not in task_set:
 				task_set.add(task)
-				for dependency in task.dependencies:
-					add_task_and_dependencies(dependency)
-		for t in tasks:
-			add_task_and_dependencies(t)
-		return TaskGraph(list(task_set))
+				pending.extend(dependents[task])
+		return task_set
 
-	def topological_order(self) -> None:
+	def restrict(self, tasks: t.Collection[Task]) -> 'TaskGraph':
+		# Returns a graph of only the given tasks, keeping the order between them but ignoring any of their other dependencies.
+		# Unlike the constructor, the tasks are not configured again, since their dependencies are unchanged.
+		task_set = tasks if isinstance(tasks, (set, frozenset)) else set(tasks)
+		return TaskGraph._from_adjacency({task: tuple(dependency for dependency in dependencies if dependency in task_set) for task, dependencies in self._graph.items() if task in task_set})
+
+	def sorter(self) -> graphlib.TopologicalSorter:
 		sorter = graphlib.TopologicalSorter(self._graph)
 		sorter.prepare()
+		return sorter
+
+	def topological_order(self) -> None:
+		sorter = self.sorter()
 		while sorter.is_active():
 			for task in sorter.get_ready():
-				yield task, lambda: sorter.done(task)
\ No newline at end of file
+				yield task, lambda task=task: sorter.done(task)
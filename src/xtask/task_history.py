@@ -0,0 +1,80 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import typing as t
+from pathlib import Path
+
+from xtask.task import Task
+
+
+class TaskHistory():
+	# Remembers how long each task's action took to execute, keyed by task label, to estimate how long it will take next time.
+	# Estimates are a moving average, so they follow a task as it gets slower or faster without jumping on a single outlier.
+
+	# How much the latest duration weighs in the estimate.
+	SMOOTHING = 0.5
+	# The estimate for tasks that have never executed, when no task has executed either.
+	DEFAULT_ESTIMATE = 1.0
+
+	_file_path: t.Optional[Path]
+	_entries: t.Optional[t.Dict[str, t.Dict[str, float]]]
+	_dirty: bool
+	_lock: threading.Lock
+
+	def __init__(self, file_path: str | Path = None):
+		self._file_path = Path(file_path) if file_path else None
+		self._entries = None
+		self._dirty = False
+		self._lock = threading.Lock()
+
+	def record(self, task: Task, duration: float) -> None:
+		with self._lock:
+			entry = self._load().get(task.label)
+			if entry is None:
+				self._entries[task.label] = {'duration': duration, 'runs': 1}
+			else:
+				entry['duration'] = self.SMOOTHING * duration + (1 - self.SMOOTHING) * entry['duration']
+				entry['runs'] += 1
+			self._dirty = True
+
+	def duration(self, task: Task) -> t.Optional[float]:
+		with self._lock:
+			entry = self._load().get(task.label)
+		return entry['duration'] if entry is not None else None
+
+	def estimates(self, tasks: t.Iterable[Task]) -> t.Dict[Task, float]:
+		# Tasks without a history are estimated to take as long as the average task that has one.
+		with self._lock:
+			entries = self._load()
+			default = sum(entry['duration'] for entry in entries.values()) / len(entries) if entries else self.DEFAULT_ESTIMATE
+			return {task: entries[task.label]['duration'] if task.label in entries else default for task in tasks}
+
+	def preload(self) -> None:
+		# Reads the recorded durations now, rather than when the first estimate is needed.
+		with self._lock:
+			self._load()
+
+	def save(self) -> None:
+		with self._lock:
+			if not self._dirty or self._file_path is None:
+				return
+			self._file_path.parent.mkdir(parents=True, exist_ok=True)
+			file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(self._file_path.parent), prefix='.tmp-')
+			with os.fdopen(file_descriptor, 'w') as temp_file:
+				json.dump(self._entries, temp_file, indent='\t')
+			os.replace(temp_file_name, str(self._file_path))
+			self._dirty = False
+
+	def _load(self) -> t.Dict[str, t.Dict[str, float]]:
+		if self._entries is None:
+			self._entries = dict()
+			if self._file_path is not None:
+				try:
+					self._entries = json.loads(self._file_path.read_text())
+				except FileNotFoundError:
+					pass
+				except ValueError:
+					logging.warning(f'Ignoring the corrupt task history "{self._file_path}"')
+		return self._entries
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import typing as t
+from pathlib import Path
+
+import xtask.constants as const
+import xtask.trace as trace
+from xtask.task import Task
+from xtask.task_file import TaskFile
+from xtask.task_graph import TaskGraph
+
+
+class TaskManifest():
+	# A record of every task file in a project and the tasks each one declares, which lets the command line be built and a task's
+	# dependencies be found without executing every task file. The manifest stays valid as long as the stat of every source file
+	# that was executed while declaring tasks (task files and the modules they import from the project) is unchanged. New task
+	# files are picked up by rediscovering whenever a task that is not in the manifest is requested.
+
+	VERSION = 1
+
+	root_path: Path
+	tasks: t.Dict[str, t.Dict[str, t.Any]]
+
+	_sources: t.Dict[str, t.List[int]]
+
+	def __init__(self, root_path: Path, tasks: t.Dict[str, t.Dict[str, t.Any]], sources: t.Dict[str, t.List[int]]):
+		self.root_path = root_path
+		self.tasks = tasks
+		self._sources = sources
+
+	@property
+	def task_file_paths(self) -> t.List[Path]:
+		return sorted({Path(entry['file']) for entry in self.tasks.values()})
+
+	def is_valid(self) -> bool:
+		for source, stat_key in self._sources.items():
+			if _stat_key(source) != stat_key:
+				logging.debug(f'The task manifest is out of date because "{source}" changed')
+				return False
+		return True
+
+	def dependency_closure(self, *labels: str) -> t.Tuple[t.Set[str], t.Set[str]]:
+		# Returns the labels of the given tasks and all of their dependencies, along with any of those labels that are not in the manifest.
+		closure = set()
+		missing = set()
+		pending = list(labels)
+		while pending:
+			label = pending.pop()
+			if label in closure or label in missing:
+				continue
+			entry = self.tasks.get(label)
+			if entry is None:
+				missing.add(label)
+				continue
+			closure.add(label)
+			pending.extend(entry['dependencies'])
+		return closure, missing
+
+	def replace_task_file(self, task_file: TaskFile) -> None:
+		# Replaces the tasks declared by a task file that was loaded again after changing.
+		self.tasks = {label: entry for label, entry in self.tasks.items() if entry['file'] != str(task_file.file_path)}
+		for task in task_file.tasks:
+			self.tasks[task.label] = _task_entry(task_file, task)
+		self._sources[str(task_file.file_path)] = _stat_key(task_file.file_path)
+
+	@classmethod
+	def load(cls, file_path: Path, root_path: Path) -> t.Optional['TaskManifest']:
+		try:
+			content = json.loads(file_path.read_text())
+		except (FileNotFoundError, ValueError):
+			return None
+		if content.get('version') != cls.VERSION or content.get('root') != str(root_path):
+			return None
+		return TaskManifest(root_path, content['tasks'], content['sources'])
+
+	def save(self, file_path: Path) -> None:
+		file_path.parent.mkdir(parents=True, exist_ok=True)
+		file_descriptor, temp_file_name = tempfile.mkstemp(dir=str(file_path.parent), prefix='.tmp-')
+		with os.fdopen(file_descriptor, 'w') as temp_file:
+			json.dump({'version': self.VERSION, 'root': str(self.root_path), 'tasks': self.tasks, 'sources': self._sources}, temp_file, indent='\t')
+		os.replace(temp_file_name, str(file_path))
+
+	@classmethod
+	def from_task_files(cls, root_path: Path, task_files: t.Iterable[TaskFile], imported_module_files: t.Iterable[str], source_roots: t.Iterable[Path]) -> 'TaskManifest':
+		tasks = dict()
+		sources = dict()
+		for task_file in task_files:
+			sources[str(task_file.file_path)] = _stat_key(task_file.file_path)
+			for task in task_file.tasks:
+				tasks[task.label] = _task_entry(task_file, task)
+		# Task files can import helpers from the project that declare tasks on their behalf, so those are sources as well.
+		# Installed packages are not, even when the environment lives inside of the project.
+		source_roots = [source_root.resolve() for source_root in source_roots]
+		for module_file in imported_module_files:
+			module_path = Path(module_file).resolve()
+			if 'site-packages' not in module_path.parts and any(module_path.is_relative_to(source_root) for source_root in source_roots):
+				sources[str(module_path)] = _stat_key(module_path)
+		return TaskManifest(root_path, tasks, sources)
+
+class TaskLoader():
+	# Loads task files on demand. With a manifest, only the task files declaring the requested tasks and their dependencies
+	# are executed. Without one (or when it is out of date), every task file in the project is discovered and executed.
+
+	root_path: Path
+	manifest: TaskManifest
+
+	_manifest_path: t.Optional[Path]
+	_excluded_directories: t.Set[Path]
+	_source_roots: t.List[Path]
+	_task_files: t.Dict[Path, TaskFile]
+	_imported_module_files: t.Set[str]
+	_discovered: bool
+
+	def __init__(self, root_path: Path, manifest_path: Path = None, excluded_directories: t.Iterable[Path] = (), source_roots: t.Iterable[Path] = ()):
+		self.root_path = root_path
+		self._manifest_path = manifest_path
+		self._excluded_directories = {path.resolve() for path in excluded_directories}
+		self._source_roots = [root_path, *source_roots]
+		self._task_files = dict()
+		self._imported_module_files = set()
+		self._discovered = False
+		with trace.span('load task manifest', 'startup'):
+			manifest = TaskManifest.load(manifest_path, root_path) if manifest_path else None
+			manifest_is_valid = manifest is not None and manifest.is_valid()
+		if manifest_is_valid:
+			logging.debug(f'Using the task manifest "{manifest_path}"')
+			self.manifest = manifest
+		else:
+			self.discover()
+
+	@property
+	def is_up_to_date(self) -> bool:
+		# Whether the manifest comes from discovering every task file during this run.
+		return self._discovered
+
+	def discover(self) -> None:
+		logging.debug(f'Discovering task files under "{self.root_path}"')
+		with trace.span('find task files', 'startup'):
+			task_file_paths = self._find_task_file_paths()
+		visited_directories = set()
+		for task_file_path in task_file_paths:
+			if task_file_path.parent in visited_directories:
+				raise RuntimeError(f'Unable to load the task file "{task_file_path}" because a task file from the same directory has already been loaded.')
+			visited_directories.add(task_file_path.parent)
+			if task_file_path not in self._task_files:
+				self._load_task_file(task_file_path)
+		# Forget task files that no longer exist.
+		self._task_files = {path: task_file for path, task_file in self._task_files.items() if path in task_file_paths}
+		self.manifest = TaskManifest.from_task_files(self.root_path, self._task_files.values(), self._imported_module_files, self._source_roots)
+		self._discovered = True
+		if self._manifest_path:
+			self.manifest.save(self._manifest_path)
+
+	def invalidate(self) -> None:
+		# Makes the next lookup of a task missing from the manifest discover task files again, in case one was added since
+		# they were discovered. Loaded task files are kept.
+		self._discovered = False
+
+	def graph(self, *labels: str) -> TaskGraph:
+		# Builds a task graph holding the given tasks and all of their dependencies, loading only the task files needed to do so.
+		closure, missing = self.manifest.dependency_closure(*labels)
+		if missing and not self._discovered:
+			logging.debug(f'The task manifest is missing the tasks {", ".join(sorted(missing))}, discovering task files again')
+			self.discover()
+			closure, missing = self.manifest.dependency_closure(*labels)
+		if missing:
+			raise RuntimeError(f'Could not find the tasks: {", ".join(sorted(missing))}')
+		for task_file_path in sorted({Path(self.manifest.tasks[label]['file']) for label in closure}):
+			if task_file_path not in self._task_files:
+				self._load_task_file(task_file_path)
+		with trace.span('construct graph', 'startup'):
+			return TaskGraph([task for task in self._loaded_tasks() if task.label in closure])
+
+	def reload(self, task_file_path: Path) -> None:
+		# Executes a task file again after it changed. Graphs built before reloading keep the task file's previous tasks.
+		self._load_task_file(task_file_path)
+		self.manifest.replace_task_file(self._task_files[task_file_path])
+		if self._manifest_path:
+			self.manifest.save(self._manifest_path)
+
+	def full_graph(self) -> TaskGraph:
+		return self.graph(*self.manifest.tasks.keys())
+
+	def _loaded_tasks(self) -> t.List[Task]:
+		return [task for task_file in self._task_files.values() for task in task_file.tasks]
+
+	def _load_task_file(self, task_file_path: Path) -> TaskFile:
+		logging.debug(f'Loading task file from path: "{task_file_path}"')
+		modules_before = set(sys.modules)
+		with trace.span('load task file', 'startup', file=str(task_file_path)):
+			task_file = TaskFile.load(task_file_path)
+		self._imported_module_files.update(getattr(sys.modules[name], '__file__', None) or '' for name in set(sys.modules) - modules_before)
+		self._imported_module_files.discard('')
+		self._task_files[task_file_path] = task_file
+		logging.debug(f'Successfully loaded a task file from "{task_file_path}" with tasks: {",".join([str(task) for task in task_file.tasks])}')
+		return task_file
+
+	def _find_task_file_paths(self) -> t.List[Path]:
+		task_file_paths = list()
+		for directory, directory_names, file_names in os.walk(self.root_path):
+			directory_path = Path(directory)
+			# Never descend into xtask's own state or cache directories, which can be large.
+			directory_names[:] = [name for name in directory_names if (directory_path / name).resolve() not in self._excluded_directories]
+			task_file_paths.extend((directory_path / name).resolve() for name in file_names if name.endswith(const.TASKS_FILE_EXTENSION))
+		return sorted(task_file_paths)
+
+def _task_entry(task_file: TaskFile, task: Task) -> t.Dict[str, t.Any]:
+	return {
+		'file': str(task_file.file_path),
+		'doc': task.doc,
+		'working_directory': str(task.working_directory_path),
+		'dependencies': [_resolve_label(task, dependency) for dependency in task._unresolved_dependencies],
+	}
+
+def _resolve_label(task: Task, dependency: str) -> str:
+	return dependency if ':' in dependency else f'{task.group}:{dependency}'
+
+def _stat_key(file_path: str | Path) -> t.Optional[t.List[int]]:
+	try:
+		stat_result = os.stat(file_path)
+	except OSError:
+		return None
+	return [stat_result.st_size, stat_result.st_mtime_ns]
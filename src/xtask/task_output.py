@@ -0,0 +1,153 @@
+import codecs
+import sys
+import threading
+import typing as t
+from contextlib import contextmanager
+
+# How the output of actions is shown while tasks execute. Either way, it is recorded per task, to be stored in the task
+# cache along with the task's outputs.
+PREFIXED = 'prefixed'
+GROUPED = 'grouped'
+MODES = [PREFIXED, GROUPED]
+
+# Serializes writes to the terminal, so lines from concurrent tasks never interleave.
+_terminal_lock = threading.Lock()
+# The output of the action executing on each thread.
+_current = threading.local()
+# The streams sys.stdout and sys.stderr were, while they are replaced to capture the output of actions.
+_terminal_streams: t.Optional[t.Tuple[t.TextIO, t.TextIO]] = None
+_capture_count = 0
+_capture_lock = threading.Lock()
+
+
+class TaskOutput():
+	# The output of one task's action: what it printed and what the processes it started with xtask.util.run wrote, to both
+	# stdout and stderr. It is either streamed to the terminal line by line, each line prefixed with the task's label, or
+	# held back and printed as one block once the task is done. Announcements (e.g. the banners around an action) are shown
+	# the same way, but aren't part of the recorded log.
+
+	label: str
+	mode: str
+
+	_log: t.List[str]
+	_held: t.List[str]
+	_partial_line: str
+	_lock: threading.Lock
+
+	def __init__(self, label: str, mode: str = PREFIXED):
+		if mode not in MODES:
+			raise RuntimeError(f'Unknown task output mode "{mode}". Valid values are: {", ".join(MODES)}')
+		self.label = label
+		self.mode = mode
+		self._log = list()
+		self._held = list()
+		self._partial_line = ''
+		self._lock = threading.Lock()
+
+	@property
+	def log(self) -> str:
+		with self._lock:
+			return ''.join(self._log)
+
+	def write(self, text: str) -> None:
+		self._show(text, record=True)
+
+	def announce(self, text: str) -> None:
+		with self._lock:
+			if self.mode == GROUPED:
+				self._held.append(text)
+				return
+			# The last line written so far goes first, so it stays above the announcement.
+			partial_line, self._partial_line = self._partial_line, ''
+		_write_terminal((f'[{self.label}] {partial_line}\n' if partial_line else '') + text)
+
+	def replay(self, log: str) -> None:
+		# Shows a log recorded by an earlier execution of the task, e.g. one restored from the task cache.
+		self._show(log, record=False)
+
+	def _show(self, text: str, record: bool) -> None:
+		with self._lock:
+			if record:
+				self._log.append(text)
+			if self.mode == GROUPED:
+				self._held.append(text)
+				return
+			lines = (self._partial_line + text).split('\n')
+			self._partial_line = lines.pop()
+		if lines:
+			_write_terminal(''.join(f'[{self.label}] {line}\n' for line in lines))
+
+	def finish(self) -> None:
+		# Shows whatever is still held back: the last line if it didn't end with a newline, or the whole block.
+		with self._lock:
+			held, self._held = self._held, list()
+			partial_line, self._partial_line = self._partial_line, ''
+		if partial_line:
+			_write_terminal(f'[{self.label}] {partial_line}\n')
+		if held:
+			_write_terminal(''.join(held))
+
+class _CapturingStream():
+	# Replaces sys.stdout or sys.stderr while actions execute, passing writes on to the output of the action executing on the
+	# calling thread, or to the terminal from any other thread.
+
+	_stream: t.TextIO
+
+	def __init__(self, stream: t.TextIO):
+		self._stream = stream
+
+	def write(self, text: str) -> int:
+		output = current()
+		if output is None:
+			return self._stream.write(text)
+		output.write(text)
+		return len(text)
+
+	def flush(self) -> None:
+		if current() is None:
+			self._stream.flush()
+
+	def __getattr__(self, name: str) -> t.Any:
+		return getattr(self._stream, name)
+
+def current() -> t.Optional[TaskOutput]:
+	return getattr(_current, 'output', None)
+
+@contextmanager
+def capture(output: TaskOutput):
+	# Records everything written to sys.stdout and sys.stderr on this thread into the output.
+	global _terminal_streams, _capture_count
+	with _capture_lock:
+		if _capture_count == 0:
+			_terminal_streams = (sys.stdout, sys.stderr)
+			sys.stdout, sys.stderr = _CapturingStream(sys.stdout), _CapturingStream(sys.stderr)
+		_capture_count += 1
+	previous_output = current()
+	_current.output = output
+	try:
+		yield
+	finally:
+		_current.output = previous_output
+		with _capture_lock:
+			_capture_count -= 1
+			if _capture_count == 0:
+				sys.stdout, sys.stderr = _terminal_streams
+				_terminal_streams = None
+
+def pump(stream: t.BinaryIO, output: TaskOutput) -> None:
+	# Writes what a process writes to a pipe into the output, as it arrives, and closes the pipe once it is done.
+	decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+	with stream:
+		try:
+			while chunk := stream.read1(64 * 1024):
+				output.write(decoder.decode(chunk))
+		except (OSError, ValueError):
+			# The pipe was closed, because the process was terminated.
+			return
+	output.write(decoder.decode(b'', final=True))
+
+def _write_terminal(text: str) -> None:
+	stream = _terminal_streams[0] if _terminal_streams is not None else sys.stdout
+	with _terminal_lock:
+		stream.write(text)
+		stream.flush()
@@ -0,0 +1,100 @@
+import json
+import os
+import threading
+import time
+import typing as t
+from contextlib import contextmanager
+from pathlib import Path
+
+import xtask.metrics as metrics
+
+
+class Tracer():
+	# Records spans of time as Chrome trace events, which can be opened in chrome://tracing or https://ui.perfetto.dev. Each
+	# thread gets its own track, so tasks executing on different workers show up side by side.
+
+	_start: int
+	_events: t.List[t.Dict[str, t.Any]]
+	_thread_names: t.Dict[int, str]
+	_lock: threading.Lock
+
+	def __init__(self):
+		self._start = time.perf_counter_ns()
+		self._events = list()
+		self._thread_names = dict()
+		self._lock = threading.Lock()
+
+	@contextmanager
+	def span(self, name: str, category: str, **args: t.Any) -> t.Iterator[None]:
+		start = time.perf_counter_ns()
+		try:
+			yield
+		finally:
+			end = time.perf_counter_ns()
+			thread = threading.current_thread()
+			event = {'name': name, 'cat': category, 'ph': 'X', 'ts': (start - self._start) / 1000, 'dur': (end - start) / 1000, 'pid': os.getpid(), 'tid': thread.ident, 'args': args}
+			with self._lock:
+				self._thread_names.setdefault(thread.ident, thread.name)
+				self._events.append(event)
+
+	def save(self, file_path: Path) -> None:
+		with self._lock:
+			metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': ident, 'args': {'name': name}} for ident, name in self._thread_names.items()]
+			events = metadata + list(self._events)
+		file_path.parent.mkdir(parents=True, exist_ok=True)
+		file_path.write_text(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+
+	def summary(self, limit: int = 10) -> str:
+		# The slowest tasks, and the total time spent in each phase across all tasks.
+		with self._lock:
+			events = list(self._events)
+		task_durations = sorted(((event['name'], event['dur']) for event in events if event['cat'] == 'task'), key=lambda item: item[1], reverse=True)
+		phase_durations: t.Dict[str, float] = dict()
+		phase_counts: t.Dict[str, int] = dict()
+		for event in events:
+			if event['cat'] in ('phase', 'startup'):
+				phase_durations[event['name']] = phase_durations.get(event['name'], 0) + event['dur']
+				phase_counts[event['name']] = phase_counts.get(event['name'], 0) + 1
+		lines = [f'Slowest tasks:']
+		lines.extend(f'\t{duration / 1000:10.1f} ms  {name}' for name, duration in task_durations[:limit])
+		lines.append('Time by phase:')
+		lines.extend(f'\t{duration / 1000:10.1f} ms  {name} ({phase_counts[name]}x)' for name, duration in sorted(phase_durations.items(), key=lambda item: item[1], reverse=True))
+		return '\n'.join(lines)
+
+# The tracer of the current invocation, if tracing was asked for. Spans are recorded from wherever the work happens, so
+# the tracer is process-wide rather than passed around.
+_tracer: t.Optional[Tracer] = None
+
+def start_tracing() -> Tracer:
+	global _tracer
+	_tracer = Tracer()
+	return _tracer
+
+def span(name: str, category: str = 'phase', **args: t.Any) -> t.ContextManager[None]:
+	# Phases are also timed for the metrics of the run, if any.
+	run_metrics = metrics.current() if category != 'task' else None
+	if run_metrics is None:
+		return _tracer.span(name, category, **args) if _tracer is not None else _NULL_SPAN
+	return _timed_span(run_metrics, name, category, args)
+
+@contextmanager
+def _timed_span(run_metrics: metrics.RunMetrics, name: str, category: str, args: t.Dict[str, t.Any]) -> t.Iterator[None]:
+	start = time.perf_counter()
+	try:
+		if _tracer is None:
+			yield
+		else:
+			with _tracer.span(name, category, **args):
+				yield
+	finally:
+		run_metrics.record_phase(name, time.perf_counter() - start)
+
+class _NullSpan():
+
+	def __enter__(self) -> None:
+		pass
+
+	def __exit__(self, *_) -> None:
+		pass
+
+_NULL_SPAN = _NullSpan()
@@ -1,11 +1,28 @@
 import logging
 import os
 import shutil
+import signal
 import subprocess
+import threading
+import time
 import typing as t
 from contextlib import contextmanager
 from pathlib import Path
 
+import xtask.jobserver as jobserver
+import xtask.task_output as task_output
+from xtask.path_matcher import DirectoryListingCache, path_matcher
+
+# The directory of the task whose action is executing on each thread. Relative paths given to the helpers below are resolved
+# against it rather than against the working directory of the process, which actions executing concurrently can't share.
+_task_directory = threading.local()
+# The event cancelling the run of the action executing on each thread, which terminates the processes it started.
+_cancellation = threading.local()
+# How often, in seconds, a process started while an event can cancel it checks whether it should be terminated.
+_CANCELLATION_POLL_INTERVAL = 0.1
+# How long, in seconds, to wait for the output of a stopped process to be pumped before leaving the pump behind.
+_PUMP_STOP_TIMEOUT = 1.0
+
 
 @contextmanager
 def working_dir(working_directory: str):
@@ -15,18 +32,43 @@ def working_dir(working_directory: str):
 		yield
 	finally:
 		os.chdir(starting_directory)
-		
-def xglob(include: t.Iterable[str], exclude: t.Iterable[str] = list(), root_dir: str = None) -> t.List[str]:
-	root_dir_path = Path(root_dir).resolve() if root_dir else Path.cwd()
-	include_files = set()
-	for pattern in include:
-		include_files.update([str(p.resolve()) for p in root_dir_path.glob(pattern)])
-	exclude_files = set()
-	for pattern in exclude:
-		exclude_files.update([str(p.resolve()) for p in root_dir_path.glob(pattern)])
-	return list(include_files.difference(exclude_files))
-
-def copy(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structure_relative_to: str | Path = None):
+
+@contextmanager
+def task_directory(directory: str | Path):
+	# Makes the helpers on this thread resolve relative paths against the directory, without changing the working directory
+	# of the process.
+	previous_directory = getattr(_task_directory, 'path', None)
+	_task_directory.path = Path(directory).resolve()
+	try:
+		yield
+	finally:
+		_task_directory.path = previous_directory
+
+@contextmanager
+def cancellation(event: threading.Event):
+	# Makes processes started with run() on this thread terminate once the event is set.
+	previous_event = getattr(_cancellation, 'event', None)
+	_cancellation.event = event
+	try:
+		yield
+	finally:
+		_cancellation.event = previous_event
+
+def base_directory() -> Path:
+	# The directory relative paths are resolved against: the directory of the task executing on this thread, if any, or else
+	# the working directory of the process.
+	directory = getattr(_task_directory, 'path', None)
+	return directory if directory is not None else Path.cwd()
+
+def resolve_path(path: str | Path, base_dir: str | Path = None) -> Path:
+	return (Path(base_dir) if base_dir is not None else base_directory()).joinpath(path).resolve()
+
+def xglob(include: t.Iterable[str], exclude: t.Iterable[str] = list(), root_dir: str = None, listing_cache: DirectoryListingCache = None) -> t.List[str]:
+	root_dir_path = resolve_path(root_dir) if root_dir else base_directory()
+	# All of the patterns are matched in a single walk of the directory tree, see PathMatcher.
+	return path_matcher(tuple(include), tuple(exclude)).glob(root_dir_path, listing_cache)
+
+def copy(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structure_relative_to: str | Path = None, base_dir: str | Path = None):
 	def _copy(from_path: Path, to_path: Path):
 		if from_path.is_file() and to_path.is_file():
 			to_path.parent.mkdir(parents=True, exist_ok=True)
@@ -41,17 +83,17 @@ def copy(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structu
 		else:
 			raise RuntimeError(f'Cannot copy "{from_path}" to "{to_path}"')
 
-	destination_path = Path(dst).resolve()
-	keep_structure_relative_to = Path(keep_structure_relative_to).resolve() if keep_structure_relative_to else None
+	destination_path = resolve_path(dst, base_dir)
+	keep_structure_relative_to = resolve_path(keep_structure_relative_to, base_dir) if keep_structure_relative_to else None
 	if isinstance(src, (t.List, t.Tuple, t.Set, t.Generator)):
 		if destination_path.is_file():
 			raise RuntimeError(f'Cannot copy multiple files to a single file destination: "{destination_path}"')
 		for file in src:
-			file_path = Path(file).resolve()
+			file_path = resolve_path(file, base_dir)
 			destination_file_path = (destination_path / (file_path.relative_to(keep_structure_relative_to) if keep_structure_relative_to else file_path.name)).resolve()
 			_copy(file_path, destination_file_path)
 	elif isinstance(src, (str, Path)):
-		file_path = Path(src).resolve()
+		file_path = resolve_path(src, base_dir)
 		if file_path.is_file() and destination_path.is_dir():
 			destination_file_path = (destination_path / (file_path.relative_to(keep_structure_relative_to) if keep_structure_relative_to else file_path.name)).resolve()
 		else:
@@ -62,7 +104,7 @@ def copy(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structu
 			destination_file_path = destination_path
 		_copy(file_path, destination_file_path)
 
-def move(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structure_relative_to: str | Path = None):
+def move(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structure_relative_to: str | Path = None, base_dir: str | Path = None):
 	def _move(from_path: Path, to_path: Path):
 		if from_path.is_file() and to_path.is_file():
 			to_path.parent.mkdir(parents=True, exist_ok=True)
@@ -77,17 +119,17 @@ def move(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structu
 		else:
 			raise RuntimeError(f'Cannot move "{from_path}" to "{to_path}"')
 
-	destination_path = Path(dst).resolve()
-	keep_structure_relative_to = Path(keep_structure_relative_to).resolve() if keep_structure_relative_to else None
+	destination_path = resolve_path(dst, base_dir)
+	keep_structure_relative_to = resolve_path(keep_structure_relative_to, base_dir) if keep_structure_relative_to else None
 	if isinstance(src, (t.List, t.Tuple, t.Set, t.Generator)):
 		if destination_path.is_file():
 			raise RuntimeError(f'Cannot move multiple files to a single file destination: "{destination_path}"')
 		for file in src:
-			file_path = Path(file).resolve()
+			file_path = resolve_path(file, base_dir)
 			destination_file_path = (destination_path / (file_path.relative_to(keep_structure_relative_to) if keep_structure_relative_to else file_path.name)).resolve()
 			_move(file_path, destination_file_path)
 	elif isinstance(src, (str, Path)):
-		file_path = Path(src).resolve()
+		file_path = resolve_path(src, base_dir)
 		if file_path.is_file() and destination_path.is_dir():
 			destination_file_path = (destination_path / (file_path.relative_to(keep_structure_relative_to) if keep_structure_relative_to else file_path.name)).resolve()
 		else:
@@ -98,10 +140,10 @@ def move(src: t.Iterable[str | Path] | str | Path, dst: str | Path, keep_structu
 			destination_file_path = destination_path
 		_move(file_path, destination_file_path)
 
-def delete(file_or_files: t.Iterable[str | Path] | str | Path):
+def delete(file_or_files: t.Iterable[str | Path] | str | Path, base_dir: str | Path = None):
 	if isinstance(file_or_files, (t.List, t.Tuple, t.Set, t.Generator)):
 		for file in file_or_files:
-			file_path = Path(file).resolve()
+			file_path = resolve_path(file, base_dir)
 			if file_path.exists():
 				if file_path.is_file():
 					logging.info(f'Deleting "{file_path}"')
@@ -110,7 +152,7 @@ def delete(file_or_files: t.Iterable[str | Path] | str | Path):
 					logging.info(f'Deleting "{file_path}"')
 					shutil.rmtree(str(file_path))
 	elif isinstance(file_or_files, (str, Path)):
-		file_path = Path(file_or_files).resolve()
+		file_path = resolve_path(file_or_files, base_dir)
 		if file_path.exists():
 			if file_path.is_file():
 				logging.info(f'Deleting "{file_path}"')
@@ -119,5 +161,63 @@ def delete(file_or_files: t.Iterable[str | Path] | str | Path):
 				logging.info(f'Deleting "{file_path}"')
 				shutil.rmtree(str(file_path))
 
-def run(command_or_args: str | t.List[str], shell=True, check=True, timeout=None) -> subprocess.CompletedProcess[bytes]:
-	return subprocess.run(command_or_args, shell=shell, check=check, timeout=timeout)
\ No newline at end of file
+def run(command_or_args: str | t.List[str], shell=True, check=True, timeout=None, cwd: str | Path = None) -> subprocess.CompletedProcess[bytes]:
+	# Processes start in the given directory, or in the directory of the task executing on this thread, if any.
+	if cwd is not None or getattr(_task_directory, 'path', None) is not None:
+		cwd = str(resolve_path(cwd if cwd is not None else '.'))
+	# Processes join the jobserver of the invocation, if there is one, so that builds like make -j share its jobs. Tools
+	# should be started without a -j of their own, which would make them ignore the jobserver.
+	server = jobserver.current()
+	options = dict(env=server.environment(), pass_fds=server.pass_fds) if server is not None else dict()
+	cancelled = getattr(_cancellation, 'event', None)
+	output = task_output.current()
+	if cancelled is None and output is None and timeout is None:
+		return subprocess.run(command_or_args, shell=shell, check=check, timeout=timeout, cwd=cwd, **options)
+	# While an action's output is captured, so is the output of the processes it starts, both stdout and stderr.
+	if output is not None:
+		options.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	deadline = time.monotonic() + timeout if timeout is not None else None
+	# A session of its own, so that stopping the process also stops everything it started, e.g. the commands run by a shell.
+	with subprocess.Popen(command_or_args, shell=shell, cwd=cwd, start_new_session=True, **options) as process:
+		pump = None
+		if output is not None:
+			pump = threading.Thread(target=task_output.pump, args=(process.stdout, output), name='xtask-output', daemon=True)
+			pump.start()
+		while True:
+			try:
+				return_code = process.wait(_CANCELLATION_POLL_INTERVAL)
+				break
+			except subprocess.TimeoutExpired:
+				if cancelled is not None and cancelled.is_set():
+					_stop(process, pump, kill=False)
+					raise RuntimeError(f'Terminated "{command_or_args}" because another task failed')
+				if deadline is not None and time.monotonic() >= deadline:
+					_stop(process, pump, kill=True)
+					raise subprocess.TimeoutExpired(process.args, timeout)
+			except KeyboardInterrupt:
+				# Outside of the terminal's process group, the process doesn't get the interrupt itself.
+				_stop(process, pump, kill=False)
+				raise
+		if pump is not None:
+			pump.join()
+	if check and return_code != 0:
+		raise subprocess.CalledProcessError(return_code, process.args)
+	return subprocess.CompletedProcess(process.args, return_code)
+
+def _stop(process: subprocess.Popen, pump: t.Optional[threading.Thread], kill: bool) -> None:
+	# Terminates (or kills) the process started by run, along with every process in its session.
+	if hasattr(os, 'killpg'):
+		try:
+			os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+		except ProcessLookupError:
+			pass
+	elif kill:
+		process.kill()
+	else:
+		process.terminate()
+	process.wait()
+	if pump is not None:
+		pump.join(_PUMP_STOP_TIMEOUT)
+		# A process that left the session may still hold the pipe open. Closing it here would wait for the pump's read to
+		# return, so the pump closes it once done instead.
+		process.stdout = None
\ No newline at end of file
@@ -0,0 +1,268 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+import typing as t
+from pathlib import Path
+
+from xtask.path_matcher import path_matcher
+from xtask.task import Task
+from xtask.task_graph import TaskGraph
+
+if t.TYPE_CHECKING:
+	from xtask.project import Project
+
+
+class InotifyWatcher():
+	# Watches directory trees for changes using Linux's inotify, adding watches for directories as they are created. A tree
+	# that doesn't exist yet is watched for from its closest existing parent directory. The directories of individual files
+	# are watched without their subdirectories.
+
+	# Event masks from <sys/inotify.h>.
+	IN_MODIFY = 0x00000002
+	IN_ATTRIB = 0x00000004
+	IN_CLOSE_WRITE = 0x00000008
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_Q_OVERFLOW = 0x00004000
+	IN_ISDIR = 0x40000000
+	IN_CLOEXEC = 0o2000000
+
+	_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+	_EVENT_HEADER = struct.Struct('iIII')
+
+	_libc: ctypes.CDLL
+	_file_descriptor: int
+	_directories: t.List[Path]
+	_directories_by_watch: t.Dict[int, Path]
+	# Watches covering the whole tree below their directory, rather than just the directory itself.
+	_tree_watches: t.Set[int]
+	_excluded_directories: t.Set[Path]
+
+	def __init__(self, directories: t.Iterable[Path], excluded_directories: t.Iterable[Path] = (), file_paths: t.Iterable[Path] = ()):
+		if sys.platform != 'linux':
+			raise OSError('inotify is only available on Linux')
+		self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self._file_descriptor = self._libc.inotify_init1(self.IN_CLOEXEC)
+		if self._file_descriptor < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, os.strerror(error))
+		self._directories = [Path(directory).resolve() for directory in directories]
+		self._directories_by_watch = dict()
+		self._tree_watches = set()
+		self._excluded_directories = {path.resolve() for path in excluded_directories}
+		for directory in self._directories:
+			self._watch_tree_or_parent(directory)
+		for file_path in file_paths:
+			self._watch_directory(Path(file_path).resolve().parent, tree=False)
+
+	def changes(self, timeout: float = None) -> t.Optional[t.Set[Path]]:
+		# Returns the paths changed within the timeout (an empty set if none), or None if events were lost and anything may have changed.
+		ready, _, _ = select.select([self._file_descriptor], [], [], timeout)
+		if not ready:
+			return set()
+		data = os.read(self._file_descriptor, 64 * 1024)
+		changed_paths = set()
+		offset = 0
+		while offset < len(data):
+			watch, mask, _, name_length = self._EVENT_HEADER.unpack_from(data, offset)
+			name = data[offset + self._EVENT_HEADER.size:offset + self._EVENT_HEADER.size + name_length].rstrip(b'\0')
+			offset += self._EVENT_HEADER.size + name_length
+			if mask & self.IN_Q_OVERFLOW:
+				return None
+			directory = self._directories_by_watch.get(watch)
+			if directory is None:
+				continue
+			path = directory / os.fsdecode(name) if name else directory
+			if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+				if watch in self._tree_watches:
+					self._watch_tree(path)
+				else:
+					for watched_directory in self._directories:
+						if path == watched_directory or path in watched_directory.parents:
+							self._watch_tree_or_parent(watched_directory)
+			changed_paths.add(path)
+		return changed_paths
+
+	def close(self) -> None:
+		os.close(self._file_descriptor)
+
+	def _watch_tree_or_parent(self, directory: Path) -> None:
+		if directory.is_dir():
+			self._watch_tree(directory)
+			return
+		parent = directory.parent
+		while not parent.is_dir() and parent != parent.parent:
+			parent = parent.parent
+		self._watch_directory(parent, tree=False)
+
+	def _watch_tree(self, directory: Path) -> None:
+		for current_directory, directory_names, _ in os.walk(directory):
+			current_directory_path = Path(current_directory)
+			directory_names[:] = [name for name in directory_names if (current_directory_path / name).resolve() not in self._excluded_directories]
+			self._watch_directory(current_directory_path, tree=True)
+
+	def _watch_directory(self, directory: Path, tree: bool) -> None:
+		watch = self._libc.inotify_add_watch(self._file_descriptor, os.fsencode(str(directory)), self._MASK)
+		if watch >= 0:
+			self._directories_by_watch[watch] = directory.resolve()
+			# The same directory watched again gets the same watch, which then stays a tree watch.
+			if tree:
+				self._tree_watches.add(watch)
+
+class PollingWatcher():
+	# Watches for changes by comparing snapshots of the stat of every watched file, for platforms without inotify.
+
+	_snapshot: t.Callable[[], t.Dict[str, t.Tuple[int, int]]]
+	_interval: float
+	_previous: t.Dict[str, t.Tuple[int, int]]
+
+	def __init__(self, snapshot: t.Callable[[], t.Dict[str, t.Tuple[int, int]]], interval: float = 1.0):
+		self._snapshot = snapshot
+		self._interval = interval
+		self._previous = snapshot()
+
+	def changes(self, timeout: float = None) -> t.Optional[t.Set[Path]]:
+		deadline = time.monotonic() + timeout if timeout is not None else None
+		while True:
+			time.sleep(self._interval if deadline is None else max(0.0, min(self._interval, deadline - time.monotonic())))
+			current = self._snapshot()
+			changed_paths = {Path(path) for path in current.keys() ^ self._previous.keys()}
+			changed_paths.update(Path(path) for path, stat_key in current.items() if self._previous.get(path, stat_key) != stat_key)
+			self._previous = current
+			if changed_paths or (deadline is not None and time.monotonic() >= deadline):
+				return changed_paths
+
+	def close(self) -> None:
+		pass
+
+class Watch():
+	# Keeps a task's graph in memory and executes the task whenever one of the inputs in its graph changes. Only the tasks
+	# whose inputs changed, and the tasks depending on them, are executed again. Changes to task files reload them.
+
+	_project: 'Project'
+	_label: str
+	_properties: t.Dict[str, str]
+	_jobs: int
+	_debounce: float
+	_task_graph: TaskGraph
+	_inputs_by_task: t.Dict[Task, t.Set[str]]
+	_outputs: t.Set[str]
+
+	def __init__(self, project: 'Project', label: str, properties: t.Dict[str, str], jobs: int, debounce: float = 0.2):
+		self._project = project
+		self._label = label
+		self._properties = properties
+		self._jobs = jobs
+		self._debounce = debounce
+		self._load_graph()
+
+	def run(self, poll: bool = False, poll_interval: float = 1.0) -> None:
+		self._execute(self._task_graph)
+		watcher = self._create_watcher(poll, poll_interval)
+		logging.info(f'Watching for changes to the inputs of [{self._label}]. Press Ctrl+C to stop.')
+		try:
+			while True:
+				changed_paths = watcher.changes()
+				# Wait for the changes to settle, since editors and tools often write several files (or one file several times) at once.
+				while changed_paths is not None:
+					more_changed_paths = watcher.changes(timeout=self._debounce)
+					if not more_changed_paths:
+						break
+					changed_paths.update(more_changed_paths)
+				if self._on_changes(changed_paths):
+					# The graph was reloaded and may now span other directories.
+					watcher.close()
+					watcher = self._create_watcher(poll, poll_interval)
+		except KeyboardInterrupt:
+			pass
+		finally:
+			watcher.close()
+
+	def _on_changes(self, changed_paths: t.Optional[t.Set[Path]]) -> bool:
+		# Executes whatever the changes affect, returning whether the graph was reloaded.
+		if changed_paths is None:
+			logging.info('Lost track of changes, executing everything again')
+			self._execute(self._task_graph)
+			return False
+
+		changed_files = {str(path) for path in changed_paths}
+		task_file_paths = {task.file_path for task in self._task_graph.all_tasks}
+		changed_task_files = [path for path in changed_paths if path in task_file_paths]
+		if changed_task_files:
+			for task_file_path in changed_task_files:
+				logging.info(f'Reloading the task file "{task_file_path}"')
+				try:
+					self._project.task_loader.reload(task_file_path)
+				except Exception:
+					logging.exception(f'Unable to reload the task file "{task_file_path}"')
+					return False
+			self._load_graph()
+			self._execute(self._task_graph)
+			return True
+
+		# Outputs of the graph's own tasks change whenever they execute, so those changes are never a reason to execute.
+		changed_files.difference_update(self._outputs)
+		if not changed_files:
+			return False
+		affected_tasks = set()
+		for task in self._task_graph.all_tasks:
+			previous_inputs = self._inputs_by_task[task]
+			self._inputs_by_task[task] = set(task.inputs())
+			if not changed_files.isdisjoint(previous_inputs) or not changed_files.isdisjoint(self._inputs_by_task[task]):
+				affected_tasks.add(task)
+		if affected_tasks:
+			logging.info(f'Inputs changed for: {", ".join(sorted(str(task) for task in affected_tasks))}')
+			self._execute(self._task_graph.restrict(self._task_graph.dependents(*affected_tasks)))
+		return False
+
+	def _execute(self, task_graph: TaskGraph) -> None:
+		task = self._task_graph.task(self._label)
+		context = self._project.create_context(task, self._task_graph, self._properties, jobs=self._jobs)
+		try:
+			context.execute_graph(task_graph)
+		except Exception:
+			logging.exception(f'Failed to execute [{self._label}]')
+		self._project.close()
+		self._outputs = {output for task in self._task_graph.all_tasks for output in task.outputs()}
+
+	def _load_graph(self) -> None:
+		self._task_graph = self._project.task_loader.graph(self._label)
+		self._inputs_by_task = {task: set(task.inputs()) for task in self._task_graph.all_tasks}
+		self._outputs = set()
+
+	def _create_watcher(self, poll: bool, poll_interval: float) -> InotifyWatcher | PollingWatcher:
+		if not poll:
+			# Only the directories the input patterns can match in are watched (e.g. "<working directory>/src" for
+			# "src/**/*.c"), along with the task files.
+			directories = set()
+			for task in self._task_graph.all_tasks:
+				prefixes = path_matcher(tuple(task._include_src_patterns), tuple(task._exclude_src_patterns)).literal_prefixes()
+				if prefixes is None:
+					directories.add(task.working_directory_path)
+				else:
+					directories.update(task.working_directory_path.joinpath(*prefix) for prefix in prefixes)
+			file_paths = {task.file_path for task in self._task_graph.all_tasks if task.file_path}
+			excluded_directories = [self._project.state_directory_path] + ([self._project.cache_path] if self._project.cache_path else [])
+			try:
+				return InotifyWatcher(directories, excluded_directories, file_paths)
+			except OSError as e:
+				logging.info(f'Unable to watch for changes with inotify ({e}), polling for changes instead')
+		return PollingWatcher(self._snapshot, interval=poll_interval)
+
+	def _snapshot(self) -> t.Dict[str, t.Tuple[int, int]]:
+		snapshot = dict()
+		for task in self._task_graph.all_tasks:
+			for file_path in [str(task.file_path), *task.inputs()]:
+				try:
+					stat_result = os.stat(file_path)
+				except FileNotFoundError:
+					continue
+				snapshot[file_path] = (stat_result.st_size, stat_result.st_mtime_ns)
+		return snapshot